@@ -1,60 +1,263 @@
+import atexit
+import gzip
+import io
+import multiprocessing
 import os
-import subprocess
-from flask import Flask, jsonify, request
+import queue
+import shutil
+import tempfile
+import threading
+from flask import Flask, Request, Response, jsonify, request
 from flask_cors import CORS
+from query_workers import QueryError, QueryTimeoutError, QueryWorkerPool
+import layer_store
+import llm_cache
+import metrics
+import query_events
+import streaming_asr
+import timing
+import vector_tiles
+from jobs import JobStore
+from layer_writer import encode_json
+
+# アップロードされた音声をメモリに保持する上限（バイト）。超えた分は一時ファイルに書く
+UPLOAD_SPOOL_MAX_SIZE = int(os.getenv('UPLOAD_SPOOL_MAX_SIZE', str(8 * 1024 * 1024)))
+
+class SpooledRequest(Request):
+    '''multipartのファイルをリクエストごとの SpooledTemporaryFile に受け取るリクエスト。'''
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE)
 
 app = Flask(__name__)
+app.request_class = SpooledRequest
 CORS(app)  # すべてのオリジンからのアクセスを許可
 
 @app.route('/backend-test')
 def index():
    return '<h1>Backend</h1>'
 
-# ファイルの保存先ディレクトリ
-UPLOAD_FOLDER = '../audio_to_geodata/data'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+# 常駐ワーカーの設定（ワーカー数と1リクエストあたりの制限時間）
+QUERY_WORKERS = int(os.getenv('QUERY_WORKERS', '2'))
+QUERY_TIMEOUT = float(os.getenv('QUERY_TIMEOUT', '120'))
+
+# モデルとツールを読み込み済みのワーカーを起動しておく
+# （spawnされたワーカー内でこのファイルが再importされた場合は起動しない）
+query_pool = None
+if multiprocessing.parent_process() is None:
+    query_pool = QueryWorkerPool(size=QUERY_WORKERS, timeout=QUERY_TIMEOUT)
+    atexit.register(query_pool.close)
+
+# 音声のアップロードを処理するジョブ
+upload_jobs = JobStore()
+
+def observe_request(span):
+    '''
+    終わったリクエスト（ワーカーで計測した段階を含む木）をメトリクスに記録する。
+    METRICS_SLOW_REQUEST_SECONDS 秒以上かかったリクエストは段階の木をログに出す。
+    '''
+    metrics.observe_span(span)
+    threshold = metrics.METRICS_SLOW_REQUEST_SECONDS
+    if threshold and span.name == 'request' and span.duration >= threshold:
+        app.logger.warning('Slow request (%.2f s):\n%s', span.duration, span.format())
+
+timing.add_observer(observe_request)
+
+def session_events(session, forward=None):
+    '''
+    セッションのクエリの途中経過を受け取る関数を作る。
+    layer_payload はレイヤーストアに保存し、forward には layer イベント（{'name', 'etag', 'url'}）として渡す。
+    '''
+    def on_event(event, data):
+        if event == 'layer_payload':
+            layer = layer_store.default_store.put(session, data['name'], data['payload'])
+            event, data = 'layer', {'name': data['name'], 'etag': layer.etag,
+                                    'url': f"/sessions/{session}/layers/{data['name']}"}
+        if forward is not None:
+            forward(event, data)
+    return on_event
+
+def run_query(script, query, session=None, entry='run_query'):
+    '''
+    常駐ワーカーでクエリを実行し、従来のサブプロセスと同じ形式のレスポンスを返す。
+    session を渡すと、レイヤーは共有の出力先ではなくセッションのレイヤーストアに保存する。
+    entry はクエリを渡すスクリプトの関数（文字起こし済みのテキストは run_transcript）。
+    '''
+    with timing.stage('request', endpoint=request.path) as span:
+        try:
+            if session is not None:
+                result = query_pool.run(script, query, on_event=session_events(session), session=session,
+                                        entry=entry)
+                return jsonify({'result': result, 'session': session, 'layers': layer_store.default_store.list(session)})
+            return jsonify({'result': query_pool.run(script, query, entry=entry)})
+        except QueryTimeoutError as e:
+            span.error = True
+            return jsonify({'error': str(e)}), 504
+        except QueryError as e:
+            span.error = True
+            return jsonify({'error': str(e)}), 500
+
+def stream_query(script, query, session=None):
+    '''
+    常駐ワーカーでクエリを実行し、途中経過（transcript, function_call, layer）と
+    最後の done / error をイベントとして順に返すレスポンスを作る。
+    session を渡すと、layer イベントはレイヤーの中身の代わりにレイヤーストアのURLとETagを返す。
+
+    Accept: text/event-stream の場合はSSE、それ以外はNDJSON（1行に1イベント）で返す。
+    '''
+    events = queue.Queue()
+    endpoint = request.path
+
+    def execute():
+        with timing.stage('request', endpoint=endpoint) as span:
+            try:
+                forward = lambda event, data: events.put((event, data))
+                on_event = session_events(session, forward) if session is not None else forward
+                result = query_pool.run(script, query, on_event=on_event, session=session)
+                events.put(('done', {'result': result}))
+            except QueryTimeoutError as e:
+                span.error = True
+                events.put(('error', {'error': str(e), 'status': 504}))
+            except Exception as e:
+                span.error = True
+                events.put(('error', {'error': str(e), 'status': 500}))
+            finally:
+                events.put(None)
+
+    threading.Thread(target=execute, daemon=True).start()
+    sse = request.accept_mimetypes.best == 'text/event-stream'
+
+    def generate():
+        while True:
+            item = events.get()
+            if item is None:
+                break
+            event, data = item
+            if sse:
+                yield b'event: ' + event.encode() + b'\ndata: ' + encode_json(data) + b'\n\n'
+            else:
+                yield encode_json({'event': event, 'data': data}) + b'\n'
 
-# '/upload' エンドポイント - 音声ファイルを保存する
+    response = Response(generate(), mimetype='text/event-stream' if sse else 'application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # プロキシでバッファリングさせない
+    return response
+
+def query_from_request():
+    '''POSTのJSONまたはGETのクエリ文字列から query を取り出す。'''
+    if request.method == 'GET':
+        return request.args.get('query')
+    return (request.get_json(silent=True) or {}).get('query')
+
+def session_from_request():
+    '''
+    X-Session-Id ヘッダー、クエリ文字列・JSON・フォームの session からセッションIDを取り出す。
+
+    Raises:
+    - ValueError: セッションIDが不正な場合。
+    '''
+    session = (request.headers.get('X-Session-Id') or request.args.get('session')
+               or (request.get_json(silent=True) or {}).get('session') or request.form.get('session'))
+    if session is not None and not layer_store.valid_session(session):
+        raise ValueError(f'Invalid session: {session}')
+    return session
+
+def process_audio(audio, session=None):
+    '''
+    アップロードされた音声（ファイルオブジェクト）を文字起こしし、main.py のツールを実行するジョブ。
+    文字起こしはこのプロセスで行い、バッファを一時ファイルに書き直さずにffmpegへ渡す。
+    '''
+    with timing.stage('request', endpoint='/upload'):
+        try:
+            audio.seek(0)
+            transcript = streaming_asr.transcribe_stream(audio)
+        finally:
+            audio.close()
+        if not transcript:
+            raise ValueError('No speech was recognized')
+
+        def record(event, data):
+            # レイヤーの中身はジョブの状態に含めない（ファイル・レイヤーストアから読む）
+            query_events.emit(event, {key: data[key] for key in ('name', 'etag', 'url') if key in data}
+                              if event == 'layer' else data)
+
+        on_event = session_events(session, record) if session is not None else record
+        return query_pool.run('main', transcript, on_event=on_event, session=session, entry='run_transcript')
+
+# '/upload' エンドポイント - 音声を受け取り、文字起こしと実行をバックグラウンドのジョブで行う
+# （multipartの audio フィールド、またはリクエストのボディそのものを音声として受け取る）
 @app.route('/upload', methods=['POST'])
 def upload_file():
     try:
-        if 'audio' not in request.files:
-            return jsonify({'error': 'No file part'}), 400
-        
-        file = request.files['audio']
-        
-        if file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
-        
-        # ファイルを保存
-        file_path = os.path.join(UPLOAD_FOLDER, 'recording.mp3')
-        file.save(file_path)
-
-        return jsonify({'message': 'File uploaded successfully'}), 200
+        session = session_from_request()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        with timing.stage('upload'):
+            if request.mimetype == 'multipart/form-data':
+                if 'audio' not in request.files:
+                    return jsonify({'error': 'No file part'}), 400
+
+                file = request.files['audio']
+
+                if file.filename == '':
+                    return jsonify({'error': 'No selected file'}), 400
+
+                # 受け取ったバッファをジョブに渡す（リクエストの終了時に閉じられないように差し替える）
+                audio = file.stream
+                file.stream = io.BytesIO()
+            else:
+                audio = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE)
+                shutil.copyfileobj(request.stream, audio)
+                if audio.tell() == 0:
+                    audio.close()
+                    return jsonify({'error': 'No audio data'}), 400
+
+        job = upload_jobs.submit(process_audio, audio, session)
+        response = jsonify({'message': 'File uploaded successfully', 'job_id': job.id,
+                            'status_url': f'/jobs/{job.id}'})
+        response.headers['Location'] = f'/jobs/{job.id}'
+        return response, 202
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# '/jobs/<job_id>' エンドポイント - ジョブの状態（queued, running, done, error）と途中経過・結果を返す
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Job not found: {job_id}'}), 404
+    return jsonify(job.to_dict())
+
 # Pythonスクリプトを実行するエンドポイント
 @app.route('/run-python', methods=['POST'])
 def run_python():
     try:
-        # クエリをPOSTリクエストから取得
+        session = session_from_request()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        # クエリ（音声ファイルのパス）または文字起こし済みのテキストをPOSTリクエストから取得
         data = request.get_json()
         query = data.get('query')
+        transcript = data.get('transcript')
+
+        if transcript is not None:
+            if not isinstance(transcript, str) or not transcript:
+                return jsonify({'error': 'Transcript must be a non-empty string'}), 400
+            # 常駐ワーカーでmain.pyの文字起こし済みのテキストを実行
+            return run_query('main', transcript, session, entry='run_transcript')
 
         if not query:
             return jsonify({'error': 'Query is missing'}), 400
+        if not isinstance(query, str):
+            return jsonify({'error': 'Query must be an audio file path'}), 400
 
-        # コマンドライン引数としてmain.pyにクエリを渡して実行
-        process = subprocess.Popen(['python3', 'main.py', query], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-
-        if process.returncode != 0:
-            return jsonify({'error': stderr.decode('utf-8')}), 500
-
-        return jsonify({'result': stdout.decode('utf-8')})
+        # 常駐ワーカーでmain.pyのクエリを実行
+        return run_query('main', query, session)
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -62,6 +265,11 @@ def run_python():
 # Pythonスクリプトを実行するエンドポイント
 @app.route('/run-python-string-query', methods=['POST'])
 def run_python_string_query():
+    try:
+        session = session_from_request()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     try:
         # クエリをPOSTリクエストから取得
         data = request.get_json()
@@ -70,17 +278,124 @@ def run_python_string_query():
         if not query:
             return jsonify({'error': 'Query is missing'}), 400
 
-        # コマンドライン引数としてmain.pyにクエリを渡して実行
-        process = subprocess.Popen(['python3', 'main_string_query.py', query], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-
-        if process.returncode != 0:
-            return jsonify({'error': stderr.decode('utf-8')}), 500
-
-        return jsonify({'result': stdout.decode('utf-8')})
+        # 常駐ワーカーでmain_string_query.pyのクエリを実行
+        return run_query('main_string_query', query, session)
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# 途中経過を順に返すエンドポイント（main_string_query.py / main.py）
+@app.route('/run-python-string-query/stream', methods=['GET', 'POST'])
+def run_python_string_query_stream():
+    query = query_from_request()
+    if not query:
+        return jsonify({'error': 'Query is missing'}), 400
+    try:
+        session = session_from_request()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return stream_query('main_string_query', query, session)
+
+@app.route('/run-python/stream', methods=['GET', 'POST'])
+def run_python_stream():
+    query = query_from_request()
+    if not query:
+        return jsonify({'error': 'Query is missing'}), 400
+    try:
+        session = session_from_request()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return stream_query('main', query, session)
+
+# '/sessions/<session>/layers' エンドポイント - セッションのレイヤー名とETagを返す
+@app.route('/sessions/<session>/layers')
+def list_session_layers(session):
+    if not layer_store.valid_session(session):
+        return jsonify({'error': f'Invalid session: {session}'}), 400
+    return jsonify({'session': session, 'layers': layer_store.default_store.list(session)})
+
+# '/sessions/<session>/layers/<name>' エンドポイント - セッションのレイヤーを返す
+# （If-None-Match が一致すれば304を返すため、クライアントは変わったレイヤーだけを取り直せる）
+@app.route('/sessions/<session>/layers/<name>')
+def get_session_layer(session, name):
+    if not layer_store.valid_session(session):
+        return jsonify({'error': f'Invalid session: {session}'}), 400
+    layer = layer_store.default_store.get(session, name)
+    if layer is None:
+        return jsonify({'error': f'Layer not found: {session}/{name}'}), 404
+
+    payload, etag = layer.payload, layer.etag
+    if 'gzip' in request.accept_encodings:
+        compressed = layer_store.default_store.get_gzipped(session, name)
+        if compressed is not None:
+            payload, etag = compressed, f'{layer.etag}-gzip'
+
+    response = Response(payload, mimetype=layer.content_type)
+    if etag != layer.etag:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'  # 毎回ETagで確認させる
+    return response.make_conditional(request)
+
+# '/sessions/<session>' エンドポイント - セッションのレイヤーを削除する
+@app.route('/sessions/<session>', methods=['DELETE'])
+def delete_session(session):
+    try:
+        layer_store.default_store.delete_session(session)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return '', 204
+
+# タイルのキャッシュ期間（秒）
+TILE_MAX_AGE = int(os.getenv('TILE_MAX_AGE', '86400'))
+
+# '/tiles/<layer>/<z>/<x>/<y>.pbf' エンドポイント - MBTilesのベクトルタイルを返す
+@app.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>.pbf')
+def get_tile(layer, z, x, y):
+    tileset = vector_tiles.get_tileset(layer)
+    if tileset is None:
+        return jsonify({'error': f'Tileset not found: {layer}'}), 404
+
+    data = tileset.get_tile(z, x, y)
+    if data is None:
+        # 地物のないタイル
+        response = Response(status=204)
+    else:
+        # タイルはgzip圧縮で保存しているため、対応するクライアントにはそのまま返す
+        etag = vector_tiles.tile_etag(tileset, z, x, y, data)
+        if 'gzip' in request.accept_encodings:
+            response = Response(data, mimetype='application/vnd.mapbox-vector-tile')
+            response.headers['Content-Encoding'] = 'gzip'
+            etag += '-gzip'
+        else:
+            response = Response(gzip.decompress(data), mimetype='application/vnd.mapbox-vector-tile')
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={TILE_MAX_AGE}'
+    return response.make_conditional(request)
+
+# '/tiles/<layer>.json' エンドポイント - タイルセットのTileJSONを返す
+@app.route('/tiles/<layer>.json')
+def get_tilejson(layer):
+    tileset = vector_tiles.get_tileset(layer)
+    if tileset is None:
+        return jsonify({'error': f'Tileset not found: {layer}'}), 404
+    url = request.host_url.rstrip('/') + f'/tiles/{layer}/{{z}}/{{x}}/{{y}}.pbf'
+    return jsonify(tileset.tilejson(url))
+
+# '/metrics' エンドポイント - 段階ごとの処理時間・キャッシュの命中数などをPrometheusの形式で返す
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# '/llm-cache/stats' エンドポイント - 関数呼び出しのキャッシュの命中数・失敗数（全ワーカーの累計）を返す
+@app.route('/llm-cache/stats')
+def get_llm_cache_stats():
+    cache = llm_cache.get_cache()
+    if cache is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(cache.stats(), enabled=True))
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
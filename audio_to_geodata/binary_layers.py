@@ -0,0 +1,231 @@
+import json
+import struct
+
+import numpy as np
+
+
+# ファイルの先頭のマジックナンバーと形式のバージョン
+MAGIC = b'DGLB'
+VERSION = 1
+
+# バッファの境界（Float64Arrayをコピーせずに作れるよう8バイトに揃える）
+ALIGNMENT = 8
+
+# deck.glのバイナリ形式のジオメトリの種類と、対応するshapelyのジオメトリ
+GEOMETRY_FAMILIES = {
+    'points': ('Point', ['Point', 'MultiPoint']),
+    'lines': ('LineString', ['LineString', 'MultiLineString']),
+    'polygons': ('Polygon', ['Polygon', 'MultiPolygon']),
+}
+
+
+### deck.glのバイナリ属性への変換
+def features_to_binary(gdf):
+    '''
+    GeoDataFrameをdeck.glのGeoJsonLayerが読めるバイナリ形式
+    （loaders.glの geojsonToBinary と同じ構造）の配列に変換する。
+
+    - positions: 頂点の座標（Float64, 2または3次元）
+    - pathIndices / polygonIndices / primitivePolygonIndices: 線・ポリゴン・リングの開始頂点
+    - featureIds / globalFeatureIds: 頂点ごとの地物の番号（種類内 / 全体）
+    - numericProps: 数値の属性（measuredHeightなど）を頂点ごとに並べたFloat32
+    - properties: 数値以外の属性（地物ごとの辞書）
+
+    Returns:
+    - (種類ごとの辞書, 地物数)。配列はnumpyの配列。
+    '''
+    import shapely
+
+    geometries = gdf.geometry.to_numpy() if len(gdf) else np.array([], dtype=object)
+    geometry_types = np.array([geometry.geom_type if geometry is not None and not geometry.is_empty else ''
+                               for geometry in geometries], dtype=object)
+    attributes = gdf.drop(columns=[gdf.geometry.name]) if len(gdf) else None
+    numeric_columns = [column for column in (attributes.columns if attributes is not None else [])
+                       if attributes[column].dtype.kind in 'biuf']
+    other_columns = [column for column in (attributes.columns if attributes is not None else [])
+                     if column not in numeric_columns]
+
+    families = dict()
+    for family, (binary_type, geom_types) in GEOMETRY_FAMILIES.items():
+        global_ids = np.flatnonzero(np.isin(geometry_types, geom_types))
+        if len(global_ids) == 0:
+            families[family] = _empty_family(family, binary_type, numeric_columns)
+            continue
+
+        geometry_type, coords, offsets = shapely.to_ragged_array(geometries[global_ids])
+        vertex_starts, parts = _vertex_offsets(geometry_type.name, len(global_ids), offsets)
+        counts = np.diff(vertex_starts)
+        feature_ids = np.repeat(np.arange(len(global_ids), dtype=np.uint32), counts)
+
+        result = {
+            'type': binary_type,
+            'positions': (np.ascontiguousarray(coords, dtype=np.float64), coords.shape[1]),
+            'featureIds': (feature_ids, 1),
+            'globalFeatureIds': (global_ids.astype(np.uint32)[feature_ids], 1),
+            'numericProps': {
+                column: (np.repeat(attributes[column].to_numpy(dtype=np.float32, na_value=np.nan)[global_ids], counts), 1)
+                for column in numeric_columns
+            },
+            'properties': _properties(attributes, other_columns, global_ids),
+        }
+        result.update({name: (values.astype(np.uint32), 1) for name, values in parts.items()})
+        families[family] = result
+    return families, len(gdf)
+
+
+def _vertex_offsets(geometry_type, count, offsets):
+    '''to_ragged_array のオフセットから、地物ごとの開始頂点と線・ポリゴン・リングの開始頂点を求める。'''
+    if geometry_type == 'POINT':
+        return np.arange(count + 1), dict()
+    if geometry_type == 'MULTIPOINT':
+        return offsets[0], dict()
+    if geometry_type == 'LINESTRING':
+        return offsets[0], {'pathIndices': offsets[0]}
+    if geometry_type == 'MULTILINESTRING':
+        part_offsets, geom_offsets = offsets
+        return part_offsets[geom_offsets], {'pathIndices': part_offsets}
+    if geometry_type == 'POLYGON':
+        ring_offsets, geom_offsets = offsets
+        return ring_offsets[geom_offsets], {'polygonIndices': ring_offsets[geom_offsets],
+                                            'primitivePolygonIndices': ring_offsets}
+    ring_offsets, polygon_offsets, geom_offsets = offsets
+    return ring_offsets[polygon_offsets[geom_offsets]], {'polygonIndices': ring_offsets[polygon_offsets],
+                                                         'primitivePolygonIndices': ring_offsets}
+
+
+def _empty_family(family, binary_type, numeric_columns):
+    empty = np.zeros(0, dtype=np.uint32)
+    result = {
+        'type': binary_type,
+        'positions': (np.zeros(0, dtype=np.float64), 2),
+        'featureIds': (empty, 1),
+        'globalFeatureIds': (empty, 1),
+        'numericProps': {column: (np.zeros(0, dtype=np.float32), 1) for column in numeric_columns},
+        'properties': [],
+    }
+    if family == 'lines':
+        result['pathIndices'] = (np.zeros(1, dtype=np.uint32), 1)
+    if family == 'polygons':
+        result['polygonIndices'] = (np.zeros(1, dtype=np.uint32), 1)
+        result['primitivePolygonIndices'] = (np.zeros(1, dtype=np.uint32), 1)
+    return result
+
+
+def _properties(attributes, columns, rows):
+    if not columns:
+        return [dict() for _ in rows]
+    frame = attributes[columns].iloc[rows].astype(object)
+    return frame.where(frame.notna(), None).to_dict('records')
+
+
+def records_to_binary(records):
+    '''
+    LineLayer用のレコード（line_layer.build_line_data の出力）を列ごとの配列に変換する。
+
+    - from, to: Float64の3次元座標（LineLayerの getSourcePosition / getTargetPosition）
+    - 数値の列: Float32（欠損はNaN）
+    - それ以外の列: 値のリスト
+    '''
+    columns = dict()
+    keys = list(dict.fromkeys(key for record in records for key in record))
+    for key in keys:
+        values = [record.get(key) for record in records]
+        present = [value for value in values if value is not None]
+        if key in ('from', 'to'):
+            columns[key] = (np.array(values, dtype=np.float64).reshape(len(values), -1), len(present[0]) if present else 3)
+        elif present and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+            columns[key] = (np.array([np.nan if value is None else value for value in values], dtype=np.float32), 1)
+        else:
+            columns[key] = values
+    return columns, len(records)
+
+
+### ファイル形式
+def pack(kind, length, arrays, extra):
+    '''
+    配列をまとめて1つのバイト列にする。
+
+    [MAGIC][version: uint32][ヘッダー長: uint32][ヘッダー（JSON）][バッファ...]
+    バッファ部はヘッダーの後の8バイト境界から始まる。ヘッダーには各バッファの名前・型・
+    要素数・次元とバッファ部の先頭からのオフセットを記録し、ブラウザでは ArrayBuffer から
+    コピーせずに型付き配列を作れる。
+    '''
+    entries, chunks, offset = [], [], 0
+    for name, (values, size) in arrays.items():
+        values = np.ascontiguousarray(values)
+        values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+        entries.append({'name': name, 'dtype': values.dtype.name, 'size': size,
+                        'count': int(values.size), 'offset': offset})
+        chunks.append(values.tobytes())
+        chunks.append(b'\0' * (_align(offset + values.nbytes) - offset - values.nbytes))
+        offset = _align(offset + values.nbytes)
+
+    header = dict(extra, kind=kind, length=length, buffers=entries)
+    header_bytes = json.dumps(header, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    prefix = MAGIC + struct.pack('<II', VERSION, len(header_bytes)) + header_bytes
+    return b''.join([prefix, b'\0' * (_align(len(prefix)) - len(prefix))] + chunks)
+
+
+def unpack(data):
+    '''pack で作ったバイト列を (ヘッダー, {名前: 配列}) に戻す。'''
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a binary layer')
+    version, header_length = struct.unpack_from('<II', data, len(MAGIC))
+    if version != VERSION:
+        raise ValueError(f'unsupported binary layer version: {version}')
+    header_end = len(MAGIC) + 8 + header_length
+    header = json.loads(data[len(MAGIC) + 8:header_end])
+    base = _align(header_end)
+    arrays = dict()
+    for entry in header['buffers']:
+        values = np.frombuffer(data, dtype=np.dtype(entry['dtype']).newbyteorder('<'),
+                               count=entry['count'], offset=base + entry['offset'])
+        arrays[entry['name']] = values.reshape(-1, entry['size']) if entry['size'] > 1 else values
+    return header, arrays
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+### レイヤーの変換
+def encode_features(gdf):
+    '''GeoDataFrameをバイナリのレイヤーにする。'''
+    if gdf.crs is not None and not gdf.crs.equals('EPSG:4326'):
+        gdf = gdf.to_crs(epsg=4326)
+    families, length = features_to_binary(gdf)
+
+    arrays, properties, types = dict(), dict(), dict()
+    for family, result in families.items():
+        types[family] = result['type']
+        properties[family] = result['properties']
+        for name, value in result.items():
+            if name == 'numericProps':
+                arrays.update({f'{family}.numericProps.{column}': array for column, array in value.items()})
+            elif name not in ('type', 'properties'):
+                arrays[f'{family}.{name}'] = value
+    return pack('features', length, arrays, {'types': types, 'properties': properties})
+
+
+def encode_records(records):
+    '''LineLayer用のレコードのリストをバイナリのレイヤーにする。'''
+    columns, length = records_to_binary(records)
+    arrays = {key: value for key, value in columns.items() if isinstance(value, tuple)}
+    values = {key: value for key, value in columns.items() if not isinstance(value, tuple)}
+    return pack('records', length, arrays, {'columns': values})
+
+
+def encode_layer(layer):
+    '''
+    GeoDataFrame・GeoJSONの辞書・LineLayer用のレコードのリストをバイナリのレイヤーにする。
+    '''
+    if isinstance(layer, dict):
+        import geopandas as gpd
+
+        features = layer.get('features', [])
+        if not features:
+            return encode_features(gpd.GeoDataFrame(geometry=[], crs='EPSG:4326'))
+        return encode_features(gpd.GeoDataFrame.from_features(features, crs='EPSG:4326'))
+    if isinstance(layer, list):
+        return encode_records(layer)
+    return encode_features(layer)
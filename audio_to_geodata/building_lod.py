@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import threading
+
+import geopandas as gpd
+import numpy as np
+
+import building_store
+from routing_engine import EARTH_RADIUS
+
+
+# ツールがズームを指定されなかった場合のズーム（フロントエンドの初期表示）
+DEFAULT_ZOOM = float(os.getenv('BUILDING_LOD_ZOOM', '16'))
+
+# 詳細度のレベル（ズームの下限の大きい順）
+# - tolerance: 単純化の許容誤差（m）。0なら単純化しない
+# - decimals: 座標を丸める小数点以下の桁数（6桁でおよそ10cm、5桁でおよそ1m）。Noneなら丸めない
+# - min_area: これより小さい建物（m²）を省く
+LOD_LEVELS = [
+    {'level': 0, 'min_zoom': 17, 'tolerance': 0.0, 'decimals': None, 'min_area': 0.0},
+    {'level': 1, 'min_zoom': 15, 'tolerance': 0.5, 'decimals': 6, 'min_area': 10.0},
+    {'level': 2, 'min_zoom': 13, 'tolerance': 2.0, 'decimals': 5, 'min_area': 50.0},
+    {'level': 3, 'min_zoom': 0, 'tolerance': 8.0, 'decimals': 5, 'min_area': 400.0},
+]
+
+# 各建物の面積（m²）を保持する列
+AREA_COLUMN = 'footprintArea'
+
+
+def pick_level(zoom=None):
+    '''ズームに対応する詳細度のレベルを返す。Noneなら既定のズームを使う。'''
+    zoom = DEFAULT_ZOOM if zoom is None else zoom
+    for level in LOD_LEVELS:
+        if zoom >= level['min_zoom']:
+            return level
+    return LOD_LEVELS[-1]
+
+
+### 単純化
+def simplify_geometries(geometries, tolerance, decimals):
+    '''
+    建物のジオメトリ（緯度経度）を単純化・量子化し、(ジオメトリ, 面積m²) を返す。
+
+    中心緯度の正距円筒図法（m）に投影して形状を保ったまま単純化し、
+    緯度経度に戻してから座標を丸める。
+    '''
+    import shapely
+
+    geometries = np.asarray(geometries, dtype=object)
+    if len(geometries) == 0:
+        return geometries, np.zeros(0)
+
+    lat0 = float(np.nanmean(shapely.get_coordinates(geometries)[:, 1]))
+    scale = np.array([EARTH_RADIUS * np.cos(np.radians(lat0)), EARTH_RADIUS])
+    projected = shapely.transform(geometries, lambda coords: np.radians(coords) * scale)
+    if tolerance:
+        projected = shapely.simplify(projected, tolerance, preserve_topology=True)
+    areas = shapely.area(projected)
+
+    simplified = shapely.transform(projected, lambda coords: np.degrees(coords / scale))
+    if decimals is not None:
+        simplified = shapely.transform(simplified, lambda coords: np.round(coords, decimals))
+        simplified = shapely.remove_repeated_points(simplified)
+    return simplified, areas
+
+
+def simplify_buildings(gdf, level, cull=True, keep_ids=None):
+    '''
+    建物のGeoDataFrameをレベルの詳細度にする。
+
+    Args:
+    - gdf: 建物（EPSG:4326）。
+    - level: LOD_LEVELS の要素。
+    - cull: レベルの min_area より小さい建物を省くかどうか。
+    - keep_ids: 小さくても省かない建物のbuildingId。
+
+    Returns:
+    - 単純化した建物のGeoDataFrame。
+    '''
+    if level['tolerance'] == 0 and level['decimals'] is None and not (cull and level['min_area']):
+        return gdf
+    geometries, areas = simplify_geometries(gdf.geometry.to_numpy(), level['tolerance'], level['decimals'])
+    result = gdf.set_geometry(gpd.GeoSeries(geometries, index=gdf.index, crs=gdf.crs))
+    if cull and level['min_area']:
+        keep = areas >= level['min_area']
+        if keep_ids is not None and 'buildingId' in result.columns:
+            keep |= result['buildingId'].isin(keep_ids).to_numpy()
+        result = result[keep]
+    return result[~result.geometry.is_empty]
+
+
+### 詳細度のピラミッド
+def level_root(level, root=building_store.BUILDING_STORE_DIR):
+    '''レベルのタイルストアのディレクトリ（建物ストアの lod/{level}）。'''
+    return os.path.join(root, 'lod', str(level))
+
+
+def build_pyramid(store=None, levels=None):
+    '''
+    建物ストアの各タイルを単純化・量子化したレベルごとのストアを作る。
+
+    各レベルは建物ストアと同じ構成（manifest.json と tiles/）で、建物ストアの lod/{level} に置く。
+    小さい建物の除外は検索時に行うため、面積の列（footprintArea）を持たせる。
+
+    Returns:
+    - {レベル: 建物数}。
+    '''
+    store = store or building_store.default_store
+    levels = levels or [level for level in LOD_LEVELS if level['level'] > 0]
+    manifest = store.manifest
+
+    counts = dict()
+    for level in levels:
+        root = level_root(level['level'], store.root)
+        os.makedirs(os.path.join(root, 'tiles'), exist_ok=True)
+        tiles = []
+        for tile in manifest['tiles']:
+            gdf = gpd.read_parquet(os.path.join(store.root, tile['path']))
+            geometries, areas = simplify_geometries(gdf.geometry.to_numpy(), level['tolerance'], level['decimals'])
+            gdf = gdf.set_geometry(gpd.GeoSeries(geometries, index=gdf.index, crs=gdf.crs))
+            gdf[AREA_COLUMN] = areas
+            gdf = gdf[~gdf.geometry.is_empty]
+            gdf.to_parquet(os.path.join(root, tile['path']))
+            tiles.append(dict(tile, count=len(gdf)))
+
+        level_manifest = dict(manifest, tiles=tiles, lod=level)
+        # manifestは最後に書き、作成途中のレベルが使われないようにする
+        with open(os.path.join(root, 'manifest.json'), 'w') as file:
+            json.dump(level_manifest, file, ensure_ascii=False)
+        counts[level['level']] = sum(tile['count'] for tile in tiles)
+    return counts
+
+
+# レベルごとのストア（プロセス内で共有する）
+_level_stores = dict()
+_level_stores_lock = threading.Lock()
+
+
+def level_store(level, store=None):
+    '''レベルのストアを返す。ピラミッドが作成されていない場合はNone。'''
+    store = store or building_store.default_store
+    root = level_root(level, store.root)
+    with _level_stores_lock:
+        if root not in _level_stores:
+            candidate = building_store.BuildingStore(root, store.cache_size)
+            if not candidate.available():
+                return None
+            _level_stores[root] = candidate
+        return _level_stores[root]
+
+
+def query_bbox(bbox, zoom=None, keep_ids=None, store=None):
+    '''
+    bboxと交差する建物をズームに応じた詳細度で返す。
+
+    ピラミッドがあればレベルのストアから読み、なければ建物ストアから読んで単純化する。
+    keep_ids の建物は小さくても省かない。
+    '''
+    store = store or building_store.default_store
+    level = pick_level(zoom)
+    if level['level'] == 0:
+        return store.query_bbox(bbox)
+
+    stored = level_store(level['level'], store)
+    if stored is None:
+        return simplify_buildings(store.query_bbox(bbox), level, keep_ids=keep_ids)
+
+    gdf = stored.query_bbox(bbox)
+    # どのタイルとも交差しない場合は、面積の列のない空のGeoDataFrameが返る
+    if gdf.empty or AREA_COLUMN not in gdf:
+        return gdf.drop(columns=[AREA_COLUMN], errors='ignore')
+    keep = gdf[AREA_COLUMN] >= level['min_area']
+    if keep_ids is not None:
+        keep |= gdf['buildingId'].isin(keep_ids)
+    return gdf[keep].drop(columns=[AREA_COLUMN])
+
+
+if __name__ == '__main__':
+    # python building_lod.py build
+    parser = argparse.ArgumentParser(description='建物ストアの詳細度のピラミッドを作成する')
+    parser.add_argument('command', choices=['build', 'info'])
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        for level, count in build_pyramid().items():
+            print(f'level {level}: {count:,} buildings')
+    else:
+        for level in LOD_LEVELS:
+            available = level['level'] == 0 or level_store(level['level']) is not None
+            print(f"level {level['level']}: zoom >= {level['min_zoom']}, tolerance {level['tolerance']} m, "
+                  f"min_area {level['min_area']} m², {'built' if available else 'not built'}")
@@ -0,0 +1,254 @@
+import argparse
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import geopandas as gpd
+import pandas as pd
+
+
+# PLATEAUのデータセット名
+PLATEAU_DATASET = 'plateau-tokyo23ku-2022.cloud'
+
+# タイルストアの保存先
+BUILDING_STORE_DIR = os.getenv('BUILDING_STORE_DIR', './cache/buildings')
+
+# 東京23区を覆う範囲 [西, 南, 東, 北]
+TOKYO23KU_BBOX = (139.55, 35.50, 139.93, 35.83)
+
+# タイルの大きさ（度）。0.01度はおよそ900m×1100m
+DEFAULT_TILE_SIZE = 0.01
+
+# 保存する列
+BUILDING_COLUMNS = ['buildingId', 'name', 'measuredHeight']
+
+# メモリに保持するタイル数
+TILE_CACHE_SIZE = int(os.getenv('BUILDING_TILE_CACHE_SIZE', '64'))
+
+
+def pad_bbox(bbox, min_size):
+    '''bbox [西, 南, 東, 北] を中心を保ったまま min_size [幅, 高さ]（m）以上に広げる。'''
+    minx, miny, maxx, maxy = bbox
+    center_x, center_y = (minx + maxx) / 2, (miny + maxy) / 2
+    half_width = max(maxx - minx, min_size[0] / (111320 * math.cos(math.radians(center_y)))) / 2
+    half_height = max(maxy - miny, min_size[1] / 110574) / 2
+    return [center_x - half_width, center_y - half_height, center_x + half_width, center_y + half_height]
+
+
+### PLATEAU建物データのタイルストア
+class BuildingStore:
+    '''
+    PLATEAUの建物（buildingId, name, measuredHeight, geometry）を
+    緯度経度のグリッドで分割したGeoParquetとして保持するストア。
+
+    - manifest.json: 各タイルのデータ範囲（タイル単位の空間索引）
+    - tiles/{x}_{y}.parquet: 建物。各行のbbox列（行単位の空間索引）を持つ
+    - landmarks.parquet: 名前のある建物とそのbbox
+
+    建物は代表点を含むタイルに1回だけ格納し、検索範囲と交差するタイルだけを読む。
+
+    Args:
+    - root: ストアのディレクトリ。
+    - cache_size: メモリに保持するタイル数。
+    '''
+
+    def __init__(self, root=BUILDING_STORE_DIR, cache_size=TILE_CACHE_SIZE):
+        self.root = root
+        self.cache_size = cache_size
+        self._manifest = None
+        self._landmarks = None
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.root, 'manifest.json')
+
+    def available(self):
+        '''取り込み済みのストアがあるかどうかを返す。'''
+        return os.path.exists(self.manifest_path)
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            with open(self.manifest_path) as file:
+                self._manifest = json.load(file)
+        return self._manifest
+
+    def query_bbox(self, bbox):
+        '''
+        bbox [西, 南, 東, 北] と交差する建物を返す。
+
+        Returns:
+        - 建物のGeoDataFrame（EPSG:4326）。
+        '''
+        minx, miny, maxx, maxy = bbox
+        frames = []
+        for tile in self.manifest['tiles']:
+            tminx, tminy, tmaxx, tmaxy = tile['bbox']
+            if tminx > maxx or tmaxx < minx or tminy > maxy or tmaxy < miny:
+                continue
+            gdf = self._read_tile(tile['path'])
+            hit = (gdf['minx'] <= maxx) & (gdf['maxx'] >= minx) & (gdf['miny'] <= maxy) & (gdf['maxy'] >= miny)
+            frames.append(gdf[hit])
+
+        if not frames:
+            return gpd.GeoDataFrame(columns=BUILDING_COLUMNS + ['geometry'], geometry='geometry', crs='EPSG:4326')
+        result = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), geometry='geometry', crs='EPSG:4326')
+        return result.drop(columns=['minx', 'miny', 'maxx', 'maxy'])
+
+    def landmarks(self):
+        '''名前のある建物の一覧（buildingId, name, bbox列）を返す。'''
+        if self._landmarks is None:
+            self._landmarks = pd.read_parquet(os.path.join(self.root, 'landmarks.parquet'))
+        return self._landmarks
+
+    def landmark_bbox(self, landmark):
+        '''名前が一致する建物を覆うbboxを返す。見つからない場合はNone。'''
+        landmarks = self.landmarks()
+        matched = landmarks[landmarks['name'] == landmark]
+        if matched.empty:
+            return None
+        return [matched['minx'].min(), matched['miny'].min(), matched['maxx'].max(), matched['maxy'].max()]
+
+    def area_from_landmark(self, landmark, min_size=(1000, 1000)):
+        '''
+        ランドマーク周辺の建物を返す（plateaukitの area_from_landmark に相当）。
+        ランドマークが見つからない場合はNone。
+        '''
+        bbox = self.landmark_bbox(landmark)
+        if bbox is None:
+            return None
+        return self.query_bbox(pad_bbox(bbox, min_size))
+
+    def _read_tile(self, path):
+        with self._lock:
+            gdf = self._tiles.get(path)
+            if gdf is not None:
+                self._tiles.move_to_end(path)
+                return gdf
+
+        gdf = gpd.read_parquet(os.path.join(self.root, path))
+        with self._lock:
+            self._tiles[path] = gdf
+            while len(self._tiles) > self.cache_size:
+                self._tiles.popitem(last=False)
+        return gdf
+
+
+### 取り込み
+def ingest(dataset_name=PLATEAU_DATASET, bbox=TOKYO23KU_BBOX, tile_size=DEFAULT_TILE_SIZE, root=BUILDING_STORE_DIR):
+    '''
+    PLATEAUのデータセットをタイルごとに取得し、ローカルのGeoParquetストアに保存する。
+
+    Args:
+    - dataset_name: plateaukitのデータセット名。
+    - bbox: 取り込む範囲 [西, 南, 東, 北]。
+    - tile_size: タイルの大きさ（度）。
+    - root: ストアのディレクトリ。
+
+    Returns:
+    - manifestの辞書。
+    '''
+    from plateaukit import load_dataset
+
+    dataset = load_dataset(dataset_name)
+    os.makedirs(os.path.join(root, 'tiles'), exist_ok=True)
+
+    minx, miny, maxx, maxy = bbox
+    x_range = range(math.floor(minx / tile_size), math.ceil(maxx / tile_size))
+    y_range = range(math.floor(miny / tile_size), math.ceil(maxy / tile_size))
+
+    tiles = []
+    landmarks = []
+    seen = set()
+    for tx in x_range:
+        for ty in y_range:
+            tile_bbox = [tx * tile_size, ty * tile_size, (tx + 1) * tile_size, (ty + 1) * tile_size]
+            gdf = dataset.area_from_bbox(tile_bbox).gdf
+            if gdf.empty:
+                continue
+            if gdf.crs is not None:
+                gdf = gdf.to_crs(epsg=4326)
+
+            # 代表点がこのタイルに含まれる建物だけを残す（タイル境界の重複を防ぐ）
+            points = gdf.geometry.representative_point()
+            inside = ((points.x >= tile_bbox[0]) & (points.x < tile_bbox[2])
+                      & (points.y >= tile_bbox[1]) & (points.y < tile_bbox[3]))
+            gdf = gdf[inside & ~gdf['buildingId'].isin(seen)]
+            if gdf.empty:
+                continue
+            seen.update(gdf['buildingId'])
+
+            columns = [column for column in BUILDING_COLUMNS if column in gdf.columns]
+            gdf = gpd.GeoDataFrame(gdf[columns], geometry=gdf.geometry, crs='EPSG:4326').reset_index(drop=True)
+            bounds = gdf.geometry.bounds
+            gdf[['minx', 'miny', 'maxx', 'maxy']] = bounds[['minx', 'miny', 'maxx', 'maxy']].to_numpy()
+
+            path = os.path.join('tiles', f'{tx}_{ty}.parquet')
+            gdf.to_parquet(os.path.join(root, path))
+            tiles.append({
+                'path': path,
+                'bbox': [float(bounds['minx'].min()), float(bounds['miny'].min()),
+                         float(bounds['maxx'].max()), float(bounds['maxy'].max())],
+                'count': len(gdf),
+            })
+            if 'name' in gdf.columns:
+                named = gdf[gdf['name'].notna()]
+                landmarks.append(pd.DataFrame(named[['buildingId', 'name', 'minx', 'miny', 'maxx', 'maxy']]))
+
+    landmarks_df = pd.concat(landmarks, ignore_index=True) if landmarks else pd.DataFrame(
+        columns=['buildingId', 'name', 'minx', 'miny', 'maxx', 'maxy'])
+    landmarks_df.to_parquet(os.path.join(root, 'landmarks.parquet'))
+
+    manifest = {
+        'dataset': dataset_name,
+        'bbox': list(bbox),
+        'tile_size': tile_size,
+        'tiles': tiles,
+    }
+    # manifestは最後に書き、取り込み途中のストアが使われないようにする
+    with open(os.path.join(root, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, ensure_ascii=False)
+    return manifest
+
+
+# プロセス全体で共有するストア
+default_store = BuildingStore()
+
+
+def area_gdf_from_landmark(landmark, min_size=(1000, 1000), dataset_name=PLATEAU_DATASET):
+    '''
+    ランドマーク周辺の建物のGeoDataFrameを返す。
+    ランドマークは地名辞書（表記ゆれ・あいまい一致に対応）で解決し、ローカルのストアから
+    建物を読む。取り込まれていない場合はPLATEAUのクラウドデータセットから取得する。
+    '''
+    if default_store.available():
+        import gazetteer
+
+        entry = gazetteer.resolve(landmark)
+        if entry is not None:
+            return default_store.query_bbox(pad_bbox(entry['bbox'], min_size))
+
+    from plateaukit import load_dataset
+    return load_dataset(dataset_name).area_from_landmark(landmark, min_size=list(min_size)).gdf
+
+
+if __name__ == '__main__':
+    # python building_store.py ingest [--bbox 西 南 東 北] [--tile-size 0.01]
+    parser = argparse.ArgumentParser(description='PLATEAUの建物データをローカルのGeoParquetストアに取り込む')
+    parser.add_argument('command', choices=['ingest', 'info'])
+    parser.add_argument('--dataset', default=PLATEAU_DATASET)
+    parser.add_argument('--bbox', type=float, nargs=4, default=TOKYO23KU_BBOX)
+    parser.add_argument('--tile-size', type=float, default=DEFAULT_TILE_SIZE)
+    parser.add_argument('--root', default=BUILDING_STORE_DIR)
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        manifest = ingest(args.dataset, args.bbox, args.tile_size, args.root)
+    else:
+        manifest = BuildingStore(args.root).manifest
+    count = sum(tile['count'] for tile in manifest['tiles'])
+    print(f"{len(manifest['tiles']):,} tiles, {count:,} buildings")
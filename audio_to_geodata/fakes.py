@@ -0,0 +1,84 @@
+import hashlib
+import os
+import re
+import time
+from types import SimpleNamespace
+
+
+# 関数呼び出しを生成するモデル（vertexai: Vertex AIのGemini、fake: 負荷試験用のローカルのモデル）
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'vertexai')
+
+# fake のモデルの応答時間（秒）と、クエリごとに決まるばらつき（応答時間に対する割合）
+FAKE_LLM_LATENCY = float(os.getenv('FAKE_LLM_LATENCY', '0.8'))
+FAKE_LLM_JITTER = float(os.getenv('FAKE_LLM_JITTER', '0.25'))
+
+
+def _numbers(query):
+    return [int(number) for number in re.findall(r'\d+', query)[:2]] + [0, 0]
+
+
+# クエリに含まれる語から呼び出す関数と引数を決める規則（上から順に判定する）
+# どれにも一致しない場合は、モデルに登録された関数のうち最初の規則の関数を呼ぶ
+FAKE_RULES = [
+    (('浸水', '洪水'), 'show_flood_depth',
+     lambda query: {'show_type': '浸水深削除' if ('消' in query or '削除' in query) else '浸水深表示'}),
+    (('避難所', 'シェルター'), 'show_shelters', lambda query: {}),
+    (('ビル', '建物', '建て'), 'buildbuilding',
+     lambda query: {'building_type': '小さい' if '小さ' in query else '大きい'}),
+    (('足', '+', '足し'), 'add_two_numbers', lambda query: dict(zip(('a', 'b'), _numbers(query)))),
+    (('掛', '×', '*'), 'multiply_two_numbers', lambda query: dict(zip(('a', 'b'), _numbers(query)))),
+]
+
+
+def jittered(latency, jitter, key):
+    '''key ごとに決まったばらつきを加えた応答時間（同じクエリは毎回同じ時間になる）。'''
+    if not latency or not jitter:
+        return latency
+    fraction = int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:4], 'big') / 0xFFFFFFFF
+    return max(latency * (1 + jitter * (2 * fraction - 1)), 0.0)
+
+
+### 関数呼び出しを生成するモデル
+class FakeModel:
+    '''
+    Vertex AIの GenerativeModel の代わりに、クエリの語から関数呼び出しを決めて返すモデル。
+
+    generate_content() は latency 秒（クエリごとに ±jitter の割合でばらつく）待ってから、
+    Vertex AIと同じ形（response.candidates[0].content.parts[0].function_call）の応答を返す。
+
+    Args:
+    - tool_names: モデルに登録された関数の名前。
+    - latency: 応答時間（秒）。
+    - jitter: 応答時間のばらつき（割合）。
+    - rules: 関数呼び出しを決める規則（FAKE_RULES を参照）。
+    '''
+
+    _model_name = 'fake'
+
+    def __init__(self, tool_names, latency=FAKE_LLM_LATENCY, jitter=FAKE_LLM_JITTER, rules=FAKE_RULES):
+        self.tool_names = list(tool_names)
+        self.latency = latency
+        self.jitter = jitter
+        self.rules = [rule for rule in rules if rule[1] in self.tool_names]
+        if not self.rules:
+            raise ValueError(f'No fake rules for tools: {self.tool_names}')
+
+    def function_call(self, query):
+        '''クエリから (関数名, 引数) を決める。'''
+        for keywords, name, make_args in self.rules:
+            if any(keyword in query for keyword in keywords):
+                return name, make_args(query)
+        _, name, make_args = self.rules[0]
+        return name, make_args(query)
+
+    def generate_content(self, contents):
+        query = contents if isinstance(contents, str) else contents.parts[0].text
+        time.sleep(jittered(self.latency, self.jitter, query))
+        name, args = self.function_call(query)
+        function_call = SimpleNamespace(name=name, args=args)
+        part = SimpleNamespace(function_call=function_call, text=None)
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+def use_fake_model():
+    return LLM_BACKEND == 'fake'
@@ -0,0 +1,383 @@
+import argparse
+import json
+import math
+import os
+import threading
+
+import numpy as np
+import shapely
+
+
+# 浸水深のグリッドの保存先と、既定のグリッド名
+FLOOD_RASTER_DIR = os.getenv('FLOOD_RASTER_DIR', './cache/flood')
+FLOOD_RASTER_NAME = os.getenv('FLOOD_RASTER_NAME', 'tokyo')
+
+# 浸水深の区分の境界（m）。国土交通省のハザードマップの凡例（0.5m未満、0.5〜3m、3〜5m、5〜10m、10〜20m、20m以上）
+FLOOD_DEPTH_BANDS = tuple(float(value) for value in os.getenv('FLOOD_DEPTH_BANDS', '0,0.5,3,5,10,20').split(','))
+
+# 区分のポリゴンを作るときに読むセルの上限（超える場合は間引いて読む）
+FLOOD_MAX_CELLS = int(os.getenv('FLOOD_MAX_CELLS', str(2_000_000)))
+
+# show_flood_depth で表示する範囲 [西, 南, 東, 北]
+FLOOD_VIEW_BBOX = tuple(float(value) for value in os.getenv(
+    'FLOOD_VIEW_BBOX', '139.520678,35.636177,139.552220,35.655039').split(','))
+
+# 取り込み・ゾーン統計で一度に扱うセル数
+STRIP_CELLS = 4_000_000
+
+
+def _paths(name, root):
+    return os.path.join(root, f'{name}.npy'), os.path.join(root, f'{name}.json')
+
+
+### 浸水深のグリッド
+class FloodRaster:
+    '''
+    緯度経度（EPSG:4326）の等間隔グリッドに並べた浸水深（m、浸水しないセル・範囲外はNaN）。
+
+    値はnumpyのメモリマップ（.npy）から読むため、東京全域のグリッドでもメモリに載せずに、
+    必要なセル（点の位置・建物の範囲・表示範囲）だけを読む。
+    位置情報（範囲・セルの大きさ）は同じ名前の .json に保存する。
+
+    - depth_at(): N点の浸水深
+    - zonal_stats(): 建物の外形ごとの最大・平均浸水深（セルの中心が外形に含まれるセルで集計）
+    - depth_bands(): 表示範囲の浸水深を区分したポリゴン
+
+    Args:
+    - array: 浸水深の2次元配列（行0が北端）。
+    - bounds: グリッドの範囲 [西, 南, 東, 北]。
+    '''
+
+    def __init__(self, array, bounds):
+        self.array = array
+        self.bounds = tuple(float(value) for value in bounds)
+        self.height, self.width = array.shape
+        west, south, east, north = self.bounds
+        self.dx = (east - west) / self.width
+        self.dy = (north - south) / self.height
+
+    @classmethod
+    def open(cls, name=FLOOD_RASTER_NAME, root=FLOOD_RASTER_DIR):
+        '''取り込んだグリッドをメモリマップで開く。'''
+        array_path, meta_path = _paths(name, root)
+        with open(meta_path, encoding='utf-8') as file:
+            meta = json.load(file)
+        return cls(np.load(array_path, mmap_mode='r'), meta['bounds'])
+
+    def cells(self, lats, lons):
+        '''各点を含むセルの (行, 列, グリッド内かどうか)。'''
+        west, south, east, north = self.bounds
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        rows = np.floor((north - lats) / self.dy).astype(np.int64)
+        cols = np.floor((lons - west) / self.dx).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+        return rows, cols, inside
+
+    def depth_at(self, lats, lons):
+        '''各点の浸水深（m）の配列。グリッドの範囲外・浸水しない点はNaN。'''
+        rows, cols, inside = self.cells(lats, lons)
+        depths = np.full(rows.shape, np.nan, dtype=float)
+        depths[inside] = self.array[rows[inside], cols[inside]]
+        return depths
+
+    def window(self, bbox):
+        '''範囲 [西, 南, 東, 北] を覆うセルの (行の始め, 行の終わり, 列の始め, 列の終わり)。範囲外ならNone。'''
+        west, south, east, north = self.bounds
+        row0 = max(int(math.floor((north - bbox[3]) / self.dy)), 0)
+        row1 = min(int(math.ceil((north - bbox[1]) / self.dy)), self.height)
+        col0 = max(int(math.floor((bbox[0] - west) / self.dx)), 0)
+        col1 = min(int(math.ceil((bbox[2] - west) / self.dx)), self.width)
+        if row0 >= row1 or col0 >= col1:
+            return None
+        return row0, row1, col0, col1
+
+    def read(self, bbox, max_cells=FLOOD_MAX_CELLS):
+        '''
+        範囲のセルを読み、(配列, 配列の範囲, 間引きの間隔) を返す。範囲外ならNone。
+        セル数が max_cells を超える場合は、縦横を同じ間隔で間引いて読む。
+        '''
+        window = self.window(bbox)
+        if window is None:
+            return None
+        row0, row1, col0, col1 = window
+        step = max(int(math.ceil(math.sqrt((row1 - row0) * (col1 - col0) / max_cells))), 1)
+        values = np.array(self.array[row0:row1:step, col0:col1:step], dtype=np.float32)
+        west, south, east, north = self.bounds
+        bounds = (west + col0 * self.dx, north - (row0 + values.shape[0] * step) * self.dy,
+                  west + (col0 + values.shape[1] * step) * self.dx, north - row0 * self.dy)
+        return values, bounds, step
+
+    def zonal_stats(self, geometries):
+        '''
+        建物の外形ごとの浸水深を集計した DataFrame（max_depth, mean_depth, cells）。
+
+        外形の範囲のセルの中心が外形に含まれるかをまとめて判定し、含まれるセルの値を集計する。
+        セルより小さい建物（中心を含むセルがない建物）は、外形の内部の1点の値を使う。
+        浸水しない建物の max_depth・mean_depth はNaN。
+
+        Args:
+        - geometries: 外形のGeoSeries・GeoDataFrame（結果は同じインデックスを持つ）、またはshapelyの外形の並び。
+        '''
+        import pandas as pd
+
+        index = None
+        if isinstance(geometries, pd.DataFrame):
+            geometries = geometries.geometry
+        if isinstance(geometries, pd.Series):
+            index = geometries.index
+            geometries = geometries.values
+        geoms = np.asarray(geometries, dtype=object)
+        shapely.prepare(geoms)
+        n = len(geoms)
+        max_depth = np.full(n, np.nan)
+        total = np.zeros(n)
+        valid = np.zeros(n, dtype=np.int64)
+        cells = np.zeros(n, dtype=np.int64)
+
+        # 外形ごとに、範囲を覆うセルの行・列の範囲を求める
+        west, south, east, north = self.bounds
+        bounds = shapely.bounds(geoms)
+        row0 = np.clip(np.floor((north - bounds[:, 3]) / self.dy), 0, self.height).astype(np.int64)
+        row1 = np.clip(np.floor((north - bounds[:, 1]) / self.dy) + 1, 0, self.height).astype(np.int64)
+        col0 = np.clip(np.floor((bounds[:, 0] - west) / self.dx), 0, self.width).astype(np.int64)
+        col1 = np.clip(np.floor((bounds[:, 2] - west) / self.dx) + 1, 0, self.width).astype(np.int64)
+        n_rows = np.maximum(row1 - row0, 0)
+        n_cols = np.maximum(col1 - col0, 0)
+        n_cells = np.where(np.isnan(bounds[:, 0]), 0, n_rows * n_cols)
+
+        # セル数が STRIP_CELLS 程度になるように建物を分けて処理する
+        cumulative = np.cumsum(n_cells)
+        start = 0
+        while start < n:
+            limit = (cumulative[start - 1] if start else 0) + STRIP_CELLS
+            end = max(int(np.searchsorted(cumulative, limit, side='right')), start + 1)
+            chunk = np.arange(start, end)
+            start = end
+            counts = n_cells[chunk]
+            if counts.sum() == 0:
+                continue
+            owner = np.repeat(chunk, counts)
+            offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            rows = row0[owner] + offset // n_cols[owner]
+            cols = col0[owner] + offset % n_cols[owner]
+            inside = shapely.contains_xy(geoms[owner], west + (cols + 0.5) * self.dx, north - (rows + 0.5) * self.dy)
+            owner, rows, cols = owner[inside], rows[inside], cols[inside]
+            values = np.asarray(self.array[rows, cols], dtype=float)
+            cells += np.bincount(owner, minlength=n)
+            wet = ~np.isnan(values)
+            total += np.bincount(owner[wet], weights=values[wet], minlength=n)
+            valid += np.bincount(owner[wet], minlength=n)
+            np.fmax.at(max_depth, owner[wet], values[wet])
+
+        # セルの中心を含まない小さい建物は、外形の内部の1点の値を使う
+        small = np.flatnonzero((cells == 0) & ~shapely.is_empty(geoms))
+        if len(small):
+            points = shapely.point_on_surface(geoms[small])
+            lats, lons = shapely.get_y(points), shapely.get_x(points)
+            depths = self.depth_at(lats, lons)
+            wet = ~np.isnan(depths)
+            max_depth[small[wet]] = depths[wet]
+            total[small[wet]] = depths[wet]
+            valid[small[wet]] = 1
+            cells[small[self.cells(lats, lons)[2]]] = 1
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_depth = np.where(valid > 0, total / valid, np.nan)
+        return pd.DataFrame({'max_depth': max_depth, 'mean_depth': mean_depth, 'cells': cells}, index=index)
+
+    def depth_bands(self, bbox, bands=FLOOD_DEPTH_BANDS, max_cells=FLOOD_MAX_CELLS):
+        '''
+        範囲の浸水深を bands の境界で区分し、区分ごとのポリゴンのGeoDataFrameを返す。
+
+        列は band（例: '0.5-3m'）、depth_min、depth_max（最後の区分はNaN）、
+        measuredHeight（区分内のセルの平均浸水深）。浸水するセルがなければ空のGeoDataFrame。
+        '''
+        import geopandas as gpd
+
+        columns = ['band', 'depth_min', 'depth_max', 'measuredHeight', 'geometry']
+        result = self.read(bbox, max_cells)
+        if result is None:
+            return gpd.GeoDataFrame(columns=columns, geometry='geometry', crs='EPSG:4326')
+        values, (west, south, east, north), step = result
+
+        wet = ~np.isnan(values) & (values > bands[0])
+        classes = np.where(wet, np.digitize(np.where(wet, values, bands[0]), bands), 0).astype(np.int16)
+        polygons = _polygonize(classes, west, north, self.dx * step, self.dy * step)
+
+        records = []
+        for band, geometry in sorted(polygons.items()):
+            depth_min = bands[band - 1]
+            depth_max = bands[band] if band < len(bands) else float('nan')
+            label = f'{depth_min:g}-{depth_max:g}m' if band < len(bands) else f'{depth_min:g}m-'
+            records.append({
+                'band': label,
+                'depth_min': depth_min,
+                'depth_max': depth_max,
+                'measuredHeight': float(values[classes == band].mean()),
+                'geometry': geometry,
+            })
+        return gpd.GeoDataFrame(records, columns=columns, geometry='geometry', crs='EPSG:4326')
+
+
+def _polygonize(classes, west, north, dx, dy):
+    '''区分の配列（0は対象外）から {区分: (Multi)Polygon} を作る。rasterioがあればGDALで、なければ行ごとの連続区間から作る。'''
+    try:
+        from rasterio.features import shapes
+        from rasterio.transform import from_origin
+    except ImportError:
+        shapes = None
+
+    polygons = dict()
+    if shapes is not None:
+        grouped = dict()
+        for geometry, value in shapes(classes, mask=classes > 0, transform=from_origin(west, north, dx, dy)):
+            grouped.setdefault(int(value), []).append(shapely.geometry.shape(geometry))
+        for band, parts in grouped.items():
+            polygons[band] = shapely.multipolygons(parts)
+        return polygons
+
+    # 行ごとに同じ区分が続く区間を長方形にし、区分ごとに結合する
+    height, width = classes.shape
+    starts = np.ones(classes.shape, dtype=bool)
+    starts[:, 1:] = classes[:, 1:] != classes[:, :-1]
+    rows, cols = np.nonzero(starts)
+    flat = rows * width + cols
+    lengths = np.append(flat[1:], height * width) - flat
+    values = classes[rows, cols]
+    keep = values > 0
+    rows, cols, lengths, values = rows[keep], cols[keep], lengths[keep], values[keep]
+    boxes = shapely.box(west + cols * dx, north - (rows + 1) * dy, west + (cols + lengths) * dx, north - rows * dy)
+    for band in np.unique(values):
+        polygons[int(band)] = shapely.union_all(boxes[values == band])
+    return polygons
+
+
+### 取り込み
+def create(array, bounds, name=FLOOD_RASTER_NAME, root=FLOOD_RASTER_DIR):
+    '''浸水深の2次元配列（行0が北端、浸水しないセルはNaN）をグリッドとして保存し、開いたグリッドを返す。'''
+    array_path, meta_path = _paths(name, root)
+    os.makedirs(root, exist_ok=True)
+    height, width = np.shape(array)
+    output = np.lib.format.open_memmap(array_path + '.tmp', mode='w+', dtype=np.float32, shape=(height, width))
+    strip = max(STRIP_CELLS // max(width, 1), 1)
+    for row in range(0, height, strip):
+        output[row:row + strip] = array[row:row + strip]
+    output.flush()
+    del output
+    _finish(array_path, meta_path, bounds, [])
+    return FloodRaster.open(name, root)
+
+
+def ingest(paths, name=FLOOD_RASTER_NAME, root=FLOOD_RASTER_DIR, resolution=None, bbox=None):
+    '''
+    浸水深のラスター（GeoTIFFなど、rasterioで読める形式）を緯度経度のグリッドに変換して保存する。
+
+    複数のラスターは1つのグリッドに重ね（重なるセルは深い方）、出力は行の帯ごとに書くため、
+    グリッド全体をメモリに載せない。
+
+    Args:
+    - paths: ラスターのパスのリスト。
+    - resolution: セルの大きさ（度）。省略時は最も細かいラスターに合わせる。
+    - bbox: 取り込む範囲 [西, 南, 東, 北]。省略時はすべてのラスターを覆う範囲。
+    '''
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.warp import Resampling, reproject, transform_bounds
+
+    sources = [rasterio.open(path) for path in paths]
+    try:
+        source_bounds = [transform_bounds(source.crs, 'EPSG:4326', *source.bounds) for source in sources]
+        if bbox is None:
+            bbox = (min(b[0] for b in source_bounds), min(b[1] for b in source_bounds),
+                    max(b[2] for b in source_bounds), max(b[3] for b in source_bounds))
+        if resolution is None:
+            resolution = min(min((b[2] - b[0]) / source.width, (b[3] - b[1]) / source.height)
+                             for b, source in zip(source_bounds, sources))
+        west, south, east, north = bbox
+        width = int(math.ceil((east - west) / resolution))
+        height = int(math.ceil((north - south) / resolution))
+
+        array_path, meta_path = _paths(name, root)
+        os.makedirs(root, exist_ok=True)
+        output = np.lib.format.open_memmap(array_path + '.tmp', mode='w+', dtype=np.float32, shape=(height, width))
+        strip_rows = max(STRIP_CELLS // width, 1)
+        for row in range(0, height, strip_rows):
+            rows = min(strip_rows, height - row)
+            strip_north = north - row * resolution
+            strip_south = strip_north - rows * resolution
+            strip = np.full((rows, width), np.nan, dtype=np.float32)
+            for source, b in zip(sources, source_bounds):
+                if b[1] >= strip_north or b[3] <= strip_south or b[0] >= east or b[2] <= west:
+                    continue
+                part = np.full((rows, width), np.nan, dtype=np.float32)
+                reproject(
+                    source=rasterio.band(source, 1),
+                    destination=part,
+                    src_nodata=source.nodata,
+                    dst_transform=from_origin(west, strip_north, resolution, resolution),
+                    dst_crs='EPSG:4326',
+                    dst_nodata=np.nan,
+                    resampling=Resampling.nearest,
+                )
+                np.fmax(strip, part, out=strip)
+            # 浸水しないセル（0以下）はNaNにする
+            strip[strip <= 0] = np.nan
+            output[row:row + rows] = strip
+        output.flush()
+        del output
+    finally:
+        for source in sources:
+            source.close()
+
+    bounds = (west, north - height * resolution, west + width * resolution, north)
+    _finish(array_path, meta_path, bounds, [os.path.basename(path) for path in paths])
+    return FloodRaster.open(name, root)
+
+
+def _finish(array_path, meta_path, bounds, sources):
+    # 書き終えてから置き換える（読み込み中のプロセスが書きかけのファイルを開かないように）
+    os.replace(array_path + '.tmp', array_path)
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump({'bounds': list(bounds), 'crs': 'EPSG:4326', 'units': 'm', 'sources': sources}, file)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+# プロセス内で開いたグリッド
+_rasters = dict()
+_rasters_lock = threading.Lock()
+
+
+def get_raster(name=FLOOD_RASTER_NAME, root=FLOOD_RASTER_DIR):
+    '''取り込んだグリッドを返す（プロセス内で一度だけ開く）。取り込まれていない場合はNone。'''
+    key = (name, root)
+    with _rasters_lock:
+        if key not in _rasters:
+            if not all(os.path.exists(path) for path in _paths(name, root)):
+                return None
+            _rasters[key] = FloodRaster.open(name, root)
+        return _rasters[key]
+
+
+if __name__ == '__main__':
+    # python flood_raster.py ingest depth1.tif depth2.tif [--resolution 0.00005]
+    # python flood_raster.py depth 35.73 139.71
+    parser = argparse.ArgumentParser(description='浸水深のラスターをメモリマップのグリッドに取り込む・調べる')
+    parser.add_argument('command', choices=['ingest', 'info', 'depth'])
+    parser.add_argument('args', nargs='*')
+    parser.add_argument('--name', default=FLOOD_RASTER_NAME)
+    parser.add_argument('--root', default=FLOOD_RASTER_DIR)
+    parser.add_argument('--resolution', type=float)
+    parser.add_argument('--bbox', type=float, nargs=4)
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        raster = ingest(args.args, args.name, args.root, args.resolution, args.bbox)
+    else:
+        raster = FloodRaster.open(args.name, args.root)
+    if args.command == 'depth':
+        lat, lon = map(float, args.args)
+        print(f'{raster.depth_at([lat], [lon])[0]:.2f} m')
+    else:
+        print(f'{raster.width:,} x {raster.height:,} cells, bounds {raster.bounds}, '
+              f'cell {raster.dx:.7f} x {raster.dy:.7f} deg')
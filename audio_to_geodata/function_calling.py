@@ -1,6 +1,21 @@
 from langchain_core.messages import HumanMessage
+import asyncio
+import contextvars
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+import llm_cache
+import query_events
+from layer_writer import LayerWriteOrder
+
+
+# 同時に実行するツール呼び出しの上限と、1ツールあたりの制限時間（秒）
+TOOL_CONCURRENCY = int(os.getenv('TOOL_CONCURRENCY', '4'))
+TOOL_TIMEOUT = float(os.getenv('TOOL_TIMEOUT', '60'))
+
+# 同期のツールを実行するスレッドプール（プロセス内で共有する）
+_executor = ThreadPoolExecutor(max_workers=TOOL_CONCURRENCY, thread_name_prefix='tool')
 
 
 def function_calling(llm, tools, tool_names, query):
@@ -18,32 +33,105 @@ def function_calling(llm, tools, tool_names, query):
     - JSON形式でツールの出力を含む辞書。
     '''
 
-    # LLMモデルとツールを結合して、新しいLLMインスタンスを作成
-    llm_with_tools = llm.bind_tools(tools)
+    def generate():
+        # LLMモデルとツールを結合して、新しいLLMインスタンスを作成
+        llm_with_tools = llm.bind_tools(tools)
+
+        # クエリをHumanMessageオブジェクトに変換
+        messages = [HumanMessage(query)]
 
-    # クエリをHumanMessageオブジェクトに変換
-    messages = [HumanMessage(query)]
+        # LLMを使用してメッセージに対する応答を取得
+        ai_msg = llm_with_tools.invoke(messages)
+        return [{'name': tool_call['name'], 'args': tool_call['args']} for tool_call in ai_msg.tool_calls]
 
-    # LLMを使用してメッセージに対する応答を取得
-    ai_msg = llm_with_tools.invoke(messages)
+    # 同じクエリ・同じツールのツール呼び出しはキャッシュから返す（LLMを呼ばない）
+    model_name = getattr(llm, 'model_name', None) or getattr(llm, 'model', None)
+    schema = llm_cache.schema_version(tools, model_name)
+    tool_calls = [call._asdict() for call in llm_cache.cached_function_calls(query, schema, generate)]
 
-    # AIからの応答メッセージをメッセージリストに追加
-    messages.append(ai_msg)
+    # ツール呼び出しを並列に実行し、呼び出し順に出力を返す
+    return run_tool_calls(tool_calls, tool_names)
 
-    # ツールの出力を格納する辞書を初期化
-    list_tool_outputs = list()
 
-    # AIメッセージからツール呼び出しを取得し、対応するツールを実行
-    for tool_call in ai_msg.tool_calls:
-        # ツール名に基づいてツールを選択
-        selected_tool = tool_names[tool_call['name']]
-        # print(f"selected tool: {tool_call}")
+def run_tool_calls(tool_calls, tool_names, max_concurrency=TOOL_CONCURRENCY, timeout=TOOL_TIMEOUT):
+    '''
+    ツール呼び出しを並列に実行し、呼び出し順に出力のリストを返す関数。
+
+    非同期のツールは ainvoke で、同期のツールは共有のスレッドプールで実行する。
+    同期のツールの制限時間はスレッドで実行が始まった時点から数える（制限時間を超えたツールの
+    スレッドは止められず実行を続けるため、スレッドの空きを待つ時間は制限時間に含めない）。
+    失敗・制限時間超過したツールは、出力の代わりに {'tool', 'error'} の辞書を返す
+    （他のツールの出力はそのまま返す）。
+    同じレイヤーを書き出すツールが複数あっても、呼び出し順に実行した場合と同じファイルが残る。
+
+    Args:
+    - tool_calls: AIメッセージの tool_calls。
+    - tool_names: ツールの名前の辞書。
+    - max_concurrency: 同時に実行するツールの数。
+    - timeout: 1ツールあたりの制限時間（秒）。
+
+    Returns:
+    - ツールの出力のリスト。
+    '''
+    if not tool_calls:
+        return []
+    coroutine = _run_tool_calls(tool_calls, tool_names, max_concurrency, timeout)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    # イベントループの中（Jupyterなど）から呼ばれた場合は別のスレッドで実行する
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=1) as runner:
+        return runner.submit(context.run, asyncio.run, coroutine).result()
+
+
+async def _run_tool_calls(tool_calls, tool_names, max_concurrency, timeout):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    write_order = LayerWriteOrder()
+
+    async def run(index, tool_call):
+        name = tool_call['name']
+        async with semaphore:
+            try:
+                # ツール名に基づいてツールを選択
+                selected_tool = tool_names[name]
+                query_events.emit('function_call', {'name': name, 'args': tool_call['args']})
+                with write_order.position(index):
+                    if getattr(selected_tool, 'coroutine', None) is not None:
+                        call = selected_tool.ainvoke(tool_call['args'])
+                    else:
+                        call = await _start_in_executor(selected_tool.invoke, tool_call['args'])
+                    return await asyncio.wait_for(call, timeout)
+            except asyncio.TimeoutError:
+                write_order.cancel(index)
+                return {'tool': name, 'error': f'Timed out after {timeout} seconds'}
+            except Exception as e:
+                return {'tool': name, 'error': f'{type(e).__name__}: {e}'}
+
+    return await asyncio.gather(*(run(index, tool_call) for index, tool_call in enumerate(tool_calls)))
+
+
+async def _start_in_executor(func, *args):
+    '''
+    func を共有のスレッドプールで実行し、スレッドで実行が始まってから実行中の future を返す。
+    途中経過の受け取り先などのコンテキストはスレッドに引き継ぐ。
+    '''
+    loop = asyncio.get_running_loop()
+    started = loop.create_future()
 
-        # ツールを実行し、出力を取得
-        tool_output = selected_tool.invoke(tool_call['args'])
+    def mark_started():
+        if not started.done():
+            started.set_result(None)
 
-        # 出力を辞書に追加
-        list_tool_outputs.append(tool_output)
+    def start(*args):
+        loop.call_soon_threadsafe(mark_started)
+        return func(*args)
 
-    # ツールの出力辞書をJSON形式で返す
-    return list_tool_outputs
\ No newline at end of file
+    context = contextvars.copy_context()
+    call = loop.run_in_executor(_executor, context.run, start, *args)
+    # 実行が始まる前に失敗した場合（プールの終了後など）は、その future をそのまま返す
+    await asyncio.wait({started, call}, return_when=asyncio.FIRST_COMPLETED)
+    started.cancel()
+    return call
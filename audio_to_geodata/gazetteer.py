@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+import threading
+from collections import Counter, defaultdict
+
+from text_normalize import ngrams, normalize_name
+
+
+# 地名辞書の保存先
+GAZETTEER_PATH = os.getenv('GAZETTEER_PATH', './cache/gazetteer.json')
+
+# あいまい一致とみなす類似度（文字2-gramのDice係数）の下限
+FUZZY_THRESHOLD = float(os.getenv('GAZETTEER_FUZZY_THRESHOLD', '0.6'))
+
+# OSMのPOIから別名として取り込むタグ
+OSM_ALIAS_TAGS = ['name:ja', 'name:en', 'name:ja-Hira', 'name:ja-Kana', 'name:ja_kana',
+                  'alt_name', 'short_name', 'official_name', 'old_name']
+
+
+### 地名辞書
+class Gazetteer:
+    '''
+    建物名・POI名から建物IDとbboxを引く地名辞書。
+
+    名前と別名は正規化（全角/半角、カタカナ/ひらがな、記号の除去）して登録し、
+    完全一致は辞書で、あいまい一致は文字2-gramの転置索引とDice係数で引く。
+    音声認識の軽い誤り（「サンシャインシテイ」など）も吸収できる。
+
+    Args:
+    - entries: {name, aliases, building_ids, bbox, source} の辞書のリスト。
+      bboxは [西, 南, 東, 北]。
+    '''
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self._key_ids = dict()               # 正規化した名前 -> 名前ID
+        self._key_entries = list()           # 名前ID -> エントリIDのリスト
+        self._key_sizes = list()             # 名前ID -> 2-gramの数
+        self._postings = defaultdict(list)   # 2-gram -> 名前IDのリスト
+
+        for entry_id, entry in enumerate(self.entries):
+            for name in [entry['name']] + list(entry.get('aliases', [])):
+                key = normalize_name(name)
+                if not key:
+                    continue
+                key_id = self._key_ids.get(key)
+                if key_id is None:
+                    key_id = self._key_ids[key] = len(self._key_entries)
+                    self._key_entries.append(list())
+                    grams = ngrams(key)
+                    self._key_sizes.append(len(grams))
+                    for gram in grams:
+                        self._postings[gram].append(key_id)
+                if entry_id not in self._key_entries[key_id]:
+                    self._key_entries[key_id].append(entry_id)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def search(self, name, limit=5, threshold=FUZZY_THRESHOLD):
+        '''
+        名前に一致するエントリを類似度の高い順に返す。
+
+        Returns:
+        - (エントリ, 類似度) のリスト。完全一致の類似度は1.0。
+        '''
+        key = normalize_name(name)
+        if not key:
+            return []
+
+        key_id = self._key_ids.get(key)
+        if key_id is not None:
+            return [(self.entries[entry_id], 1.0) for entry_id in self._key_entries[key_id][:limit]]
+
+        # 共通する2-gramの数を数え、Dice係数で順位付けする
+        grams = ngrams(key)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._postings.get(gram, ()))
+
+        scored = []
+        for candidate, count in shared.items():
+            score = 2 * count / (len(grams) + self._key_sizes[candidate])
+            if score >= threshold:
+                scored.append((score, candidate))
+        scored.sort(reverse=True)
+
+        results = []
+        seen = set()
+        for score, candidate in scored:
+            for entry_id in self._key_entries[candidate]:
+                if entry_id not in seen:
+                    seen.add(entry_id)
+                    results.append((self.entries[entry_id], score))
+            if len(results) >= limit:
+                break
+        return results[:limit]
+
+    def resolve(self, name, threshold=FUZZY_THRESHOLD):
+        '''
+        名前を最も一致するエントリに解決する。見つからない場合はNone。
+
+        同点の場合は建物IDを持つエントリ（PLATEAU由来など）を優先する。
+        '''
+        results = self.search(name, limit=10, threshold=threshold)
+        if not results:
+            return None
+        best_score = results[0][1]
+        best = [entry for entry, score in results if score == best_score]
+        best.sort(key=lambda entry: len(entry.get('building_ids', [])) == 0)
+        return best[0]
+
+    def save(self, path=GAZETTEER_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(self.entries, file, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path=GAZETTEER_PATH):
+        with open(path) as file:
+            return cls(json.load(file))
+
+
+### 辞書の作成
+def entries_from_buildings(landmarks):
+    '''
+    PLATEAUの名前のある建物（building_store.landmarks()）からエントリを作る。
+    同じ名前の建物（複合施設の各棟など）は1つのエントリにまとめる。
+    '''
+    entries = []
+    for name, group in landmarks.groupby('name'):
+        entries.append({
+            'name': name,
+            'aliases': [],
+            'building_ids': group['buildingId'].tolist(),
+            'bbox': [float(group['minx'].min()), float(group['miny'].min()),
+                     float(group['maxx'].max()), float(group['maxy'].max())],
+            'source': 'plateau',
+        })
+    return entries
+
+
+def entries_from_osm(place, store=None):
+    '''
+    OSMの名前のある地物（POI・駅・施設など）からエントリを作る。
+    建物ストアがあれば、地物と重なる建物のIDを紐づける。
+    '''
+    import geopandas as gpd
+    import osmnx as ox
+
+    features = ox.features_from_place(place, tags={'name': True})
+    features = features[features['name'].notna()].to_crs(epsg=4326)
+    alias_columns = [column for column in OSM_ALIAS_TAGS if column in features.columns]
+
+    buildings = None
+    if store is not None and store.available():
+        minx, miny, maxx, maxy = features.total_bounds
+        buildings = store.query_bbox([minx, miny, maxx, maxy])[['buildingId', 'geometry']]
+
+    building_ids = defaultdict(list)
+    if buildings is not None and not buildings.empty:
+        joined = gpd.sjoin(features[['geometry']].reset_index(drop=True), buildings, how='inner', predicate='intersects')
+        for row_id, building_id in zip(joined.index, joined['buildingId']):
+            building_ids[row_id].append(building_id)
+
+    entries = []
+    for row_id, (_, feature) in enumerate(features.iterrows()):
+        aliases = [feature[column] for column in alias_columns if isinstance(feature[column], str)]
+        # alt_nameなどはセミコロン区切りで複数の値を持つことがある
+        aliases = [alias.strip() for value in aliases for alias in value.split(';') if alias.strip()]
+        entries.append({
+            'name': feature['name'],
+            'aliases': aliases,
+            'building_ids': building_ids.get(row_id, []),
+            'bbox': [float(value) for value in feature.geometry.bounds],
+            'source': 'osm',
+        })
+    return entries
+
+
+def build(place='Toshima, Tokyo, Japan', include_osm=True, path=GAZETTEER_PATH):
+    '''建物ストアとOSMから地名辞書を作成して保存する。'''
+    import building_store
+
+    store = building_store.default_store
+    entries = entries_from_buildings(store.landmarks()) if store.available() else []
+    if include_osm:
+        entries += entries_from_osm(place, store)
+    gazetteer = Gazetteer(entries)
+    gazetteer.save(path)
+    return gazetteer
+
+
+# プロセス内で共有する辞書
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_gazetteer():
+    '''
+    共有の地名辞書を返す。保存済みの辞書がなければ建物ストアの名前だけで作る。
+    どちらもない場合はNone。
+    '''
+    global _default
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                if os.path.exists(GAZETTEER_PATH):
+                    _default = Gazetteer.load(GAZETTEER_PATH)
+                else:
+                    import building_store
+                    if not building_store.default_store.available():
+                        return None
+                    _default = Gazetteer(entries_from_buildings(building_store.default_store.landmarks()))
+    return _default
+
+
+def resolve(name):
+    '''共有の地名辞書で名前を解決する。辞書がないか見つからない場合はNone。'''
+    gazetteer = get_gazetteer()
+    return gazetteer.resolve(name) if gazetteer is not None else None
+
+
+if __name__ == '__main__':
+    # python gazetteer.py build [--place ...] [--no-osm]
+    # python gazetteer.py lookup サンシャインシティ
+    parser = argparse.ArgumentParser(description='建物名・POI名の地名辞書を作成・検索する')
+    parser.add_argument('command', choices=['build', 'lookup'])
+    parser.add_argument('name', nargs='?')
+    parser.add_argument('--place', default='Toshima, Tokyo, Japan')
+    parser.add_argument('--no-osm', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        gazetteer = build(args.place, include_osm=not args.no_osm)
+        print(f'{len(gazetteer):,} entries')
+    else:
+        for entry, score in get_gazetteer().search(args.name):
+            print(f"{score:.2f}\t{entry['name']}\t{entry['source']}\t{len(entry['building_ids'])} buildings\t{entry['bbox']}")
@@ -0,0 +1,263 @@
+import argparse
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+import threading
+
+import osmnx as ox
+
+from metrics import record_cache
+
+
+# 既定の対象地域とネットワーク種別
+DEFAULT_PLACE = 'Toshima, Tokyo, Japan'
+DEFAULT_NETWORK_TYPE = 'walk'
+
+# スナップショットの保存先と形式（'pickle' または 'graphml'）
+GRAPH_CACHE_DIR = os.getenv('GRAPH_CACHE_DIR', './cache/graphs')
+GRAPH_SNAPSHOT_FORMAT = os.getenv('GRAPH_SNAPSHOT_FORMAT', 'pickle')
+
+# スナップショットのファイル名（{地域}_{ネットワーク種別}_{ハッシュ8桁}.{pkl|graphml}）
+SNAPSHOT_FILENAME = re.compile(r'^(.+)_([0-9a-f]{8})\.(?:pkl|graphml)$')
+
+
+### 道路グラフのキャッシュ
+class GraphStore:
+    '''
+    (place, network_type) ごとに道路グラフを保持するストア。
+
+    グラフはプロセス内で一度だけ読み込み、ローカルのスナップショット
+    （pickle または GraphML）に保存する。次回以降の起動ではスナップショットから
+    読み込むため、ネットワークへのアクセスは発生しない。
+    グラフから作る索引などの派生データも artifact() で同じ寿命で保持する。
+
+    Args:
+    - cache_dir: スナップショットの保存先ディレクトリ。
+    - snapshot_format: 'pickle' または 'graphml'。
+    '''
+
+    def __init__(self, cache_dir=GRAPH_CACHE_DIR, snapshot_format=GRAPH_SNAPSHOT_FORMAT):
+        if snapshot_format not in ('pickle', 'graphml'):
+            raise ValueError(f'Unknown snapshot format: {snapshot_format}')
+        self.cache_dir = cache_dir
+        self.snapshot_format = snapshot_format
+        self._graphs = dict()
+        self._artifacts = dict()
+        self._key_locks = dict()
+        self._lock = threading.Lock()
+
+    def snapshot_path(self, place=DEFAULT_PLACE, network_type=DEFAULT_NETWORK_TYPE):
+        '''スナップショットのファイルパスを返す。'''
+        extension = 'pkl' if self.snapshot_format == 'pickle' else 'graphml'
+        return os.path.join(self.cache_dir, f'{_slug(place)}_{network_type}_{_digest(place, network_type)}.{extension}')
+
+    def snapshot_paths(self, place=None, network_type=None):
+        '''
+        保存先にある、place, network_type に一致するスナップショット（両方の形式）のパスを返す。
+        Noneの場合はすべてに一致する（メモリに読み込んでいないものも含む）。
+        '''
+        if not os.path.isdir(self.cache_dir):
+            return []
+        prefix = f'{_slug(place)}_' if place is not None else ''
+        paths = []
+        for filename in sorted(os.listdir(self.cache_dir)):
+            match = SNAPSHOT_FILENAME.match(filename)
+            if match is None or not filename.startswith(prefix):
+                continue
+            stem, digest = match.groups()
+            if place is not None:
+                # ファイル名のハッシュで、地域名の表記だけが異なる別の地域と区別する
+                file_network_type = stem[len(prefix):]
+                found = (network_type is None or file_network_type == network_type) \
+                    and digest == _digest(place, file_network_type)
+            else:
+                found = network_type is None or stem.endswith(f'_{network_type}')
+            if found:
+                paths.append(os.path.join(self.cache_dir, filename))
+        return paths
+
+    def get(self, place=DEFAULT_PLACE, network_type=DEFAULT_NETWORK_TYPE):
+        '''
+        道路グラフを返す。メモリ、スナップショット、ネットワークの順に探す。
+        '''
+        key = (place, network_type)
+        graph = self._graphs.get(key)
+        if graph is not None:
+            record_cache('graph', 'hit')
+            return graph
+
+        # 同じグラフを複数スレッドが同時にダウンロードしないようにする
+        with self._key_lock(key):
+            graph = self._graphs.get(key)
+            if graph is not None:
+                record_cache('graph', 'hit')
+                return graph
+            record_cache('graph', 'miss')
+
+            path = self.snapshot_path(place, network_type)
+            if os.path.exists(path):
+                record_cache('graph_snapshot', 'hit')
+                graph = self._load_snapshot(path)
+            else:
+                record_cache('graph_snapshot', 'miss')
+                graph = self._download(place, network_type)
+            self._graphs[key] = graph
+            return graph
+
+    def artifact(self, name, build, place=DEFAULT_PLACE, network_type=DEFAULT_NETWORK_TYPE):
+        '''
+        グラフから作る派生データ（索引など）を一度だけ作成して返す。
+
+        Args:
+        - name: 派生データの名前。
+        - build: グラフを受け取り派生データを返す関数。
+        '''
+        key = (place, network_type, name)
+        value = self._artifacts.get(key)
+        if value is not None:
+            record_cache('graph_artifact', 'hit')
+            return value
+
+        graph = self.get(place, network_type)
+        with self._key_lock(key):
+            value = self._artifacts.get(key)
+            if value is None:
+                record_cache('graph_artifact', 'miss')
+                value = build(graph)
+                self._artifacts[key] = value
+            else:
+                record_cache('graph_artifact', 'hit')
+            return value
+
+    def put(self, graph, place=DEFAULT_PLACE, network_type=DEFAULT_NETWORK_TYPE):
+        '''既存のグラフをストアに登録する（派生データは破棄される）。'''
+        with self._lock:
+            self._drop(place, network_type)
+            self._graphs[(place, network_type)] = graph
+
+    def invalidate(self, place=None, network_type=None, delete_snapshot=False):
+        '''
+        メモリ上のグラフと派生データを破棄する。
+
+        Args:
+        - place, network_type: 対象。Noneの場合はすべてに一致する。
+        - delete_snapshot: Trueの場合は、一致するスナップショット（メモリに読み込んでいないものも含む）も削除する。
+        '''
+        with self._lock:
+            keys = [key for key in list(self._graphs) if self._match(key, place, network_type)]
+            for key in keys:
+                self._drop(*key)
+
+        if delete_snapshot:
+            for path in self.snapshot_paths(place, network_type):
+                if os.path.exists(path):
+                    os.remove(path)
+        return keys
+
+    def refresh(self, place=DEFAULT_PLACE, network_type=DEFAULT_NETWORK_TYPE):
+        '''ネットワークからグラフを取得し直し、スナップショットとメモリを更新する。'''
+        key = (place, network_type)
+        with self._key_lock(key):
+            graph = self._download(place, network_type)
+            with self._lock:
+                self._drop(place, network_type)
+                self._graphs[key] = graph
+        return graph
+
+    def cached(self):
+        '''メモリ上にあるグラフのキー一覧を返す。'''
+        return list(self._graphs)
+
+    def _download(self, place, network_type):
+        graph = ox.graph_from_place(place, network_type=network_type)
+        self._save_snapshot(graph, self.snapshot_path(place, network_type))
+        return graph
+
+    def _load_snapshot(self, path):
+        if self.snapshot_format == 'pickle':
+            with open(path, 'rb') as file:
+                return pickle.load(file)
+        return ox.load_graphml(path)
+
+    def _save_snapshot(self, graph, path):
+        # 書き込み途中のファイルが読まれないよう、一時ファイルに書いてから置き換える
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        os.close(fd)
+        try:
+            if self.snapshot_format == 'pickle':
+                with open(tmp_path, 'wb') as file:
+                    pickle.dump(graph, file, protocol=pickle.HIGHEST_PROTOCOL)
+            else:
+                ox.save_graphml(graph, filepath=tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _drop(self, place, network_type):
+        self._graphs.pop((place, network_type), None)
+        for key in [key for key in self._artifacts if key[:2] == (place, network_type)]:
+            del self._artifacts[key]
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _match(key, place, network_type):
+        return (place is None or key[0] == place) and (network_type is None or key[1] == network_type)
+
+
+def _slug(place):
+    return re.sub(r'\W+', '_', place).strip('_').lower()
+
+
+def _digest(place, network_type):
+    return hashlib.sha1(f'{place}|{network_type}'.encode('utf-8')).hexdigest()[:8]
+
+
+# プロセス全体で共有するストア
+default_store = GraphStore()
+
+
+def get_graph(place=DEFAULT_PLACE, network_type=DEFAULT_NETWORK_TYPE):
+    '''共有ストアから道路グラフを取得する。'''
+    return default_store.get(place, network_type)
+
+
+def get_artifact(name, build, place=DEFAULT_PLACE, network_type=DEFAULT_NETWORK_TYPE):
+    '''共有ストアからグラフの派生データを取得する。'''
+    return default_store.artifact(name, build, place, network_type)
+
+
+def invalidate(place=None, network_type=None, delete_snapshot=False):
+    '''共有ストアのグラフを破棄する。'''
+    return default_store.invalidate(place, network_type, delete_snapshot)
+
+
+def refresh(place=DEFAULT_PLACE, network_type=DEFAULT_NETWORK_TYPE):
+    '''共有ストアのグラフを取得し直す。'''
+    return default_store.refresh(place, network_type)
+
+
+if __name__ == '__main__':
+    # python graph_store.py {fetch|refresh|invalidate|path} --place ... --network-type ...
+    parser = argparse.ArgumentParser(description='道路グラフのスナップショットを管理する')
+    parser.add_argument('command', choices=['fetch', 'refresh', 'invalidate', 'path'])
+    parser.add_argument('--place', default=DEFAULT_PLACE)
+    parser.add_argument('--network-type', default=DEFAULT_NETWORK_TYPE)
+    args = parser.parse_args()
+
+    if args.command == 'fetch':
+        # スナップショットがなければ取得して保存する
+        G = get_graph(args.place, args.network_type)
+        print(f'{len(G.nodes):,} nodes, {len(G.edges):,} edges')
+    elif args.command == 'refresh':
+        G = refresh(args.place, args.network_type)
+        print(f'{len(G.nodes):,} nodes, {len(G.edges):,} edges')
+    elif args.command == 'invalidate':
+        invalidate(args.place, args.network_type, delete_snapshot=True)
+    print(default_store.snapshot_path(args.place, args.network_type))
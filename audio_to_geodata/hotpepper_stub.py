@@ -0,0 +1,93 @@
+import argparse
+import glob
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from poi_fetcher import PAGE_SIZE, RANGE_METERS, distance
+
+
+def load_shops(paths):
+    '''
+    記録したレスポンス（HOTPEPPER_RECORD_DIR に保存したもの）または店舗のリストを読み込む。
+    '''
+    shops = dict()
+    for path in paths:
+        files = sorted(glob.glob(os.path.join(path, '*.json'))) if os.path.isdir(path) else [path]
+        for file_path in files:
+            with open(file_path) as file:
+                data = json.load(file)
+            records = data['results'].get('shop', []) if isinstance(data, dict) else data
+            for shop in records:
+                shops[shop['id']] = shop
+    return list(shops.values())
+
+
+def make_handler(shops, latency=0.0):
+    '''店舗データを元にホットペッパーグルメAPIと同じ形式で応答するハンドラを作る。'''
+
+    class HotPepperStubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+            if latency:
+                time.sleep(latency)
+
+            try:
+                lat, lng = float(query['lat']), float(query['lng'])
+                radius = RANGE_METERS[int(query.get('range', 3))]
+                start = int(query.get('start', 1))
+                count = min(int(query.get('count', 10)), PAGE_SIZE)
+            except (KeyError, ValueError):
+                self._send({'results': {'error': [{'code': 3000, 'message': 'invalid parameter'}]}})
+                return
+
+            genre = query.get('genre')
+            matched = [
+                shop for shop in shops
+                if distance(lat, lng, float(shop['lat']), float(shop['lng'])) <= radius
+                and (genre is None or shop.get('genre', {}).get('code') == genre)
+            ]
+            page = matched[start - 1:start - 1 + count]
+            self._send({'results': {
+                'api_version': 'stub',
+                'results_available': len(matched),
+                'results_returned': str(len(page)),
+                'results_start': start,
+                'shop': page,
+            }})
+
+        def _send(self, body):
+            payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return HotPepperStubHandler
+
+
+def serve(paths, host='127.0.0.1', port=8765, latency=0.0):
+    '''スタブサーバーを起動する。'''
+    shops = load_shops(paths)
+    server = ThreadingHTTPServer((host, port), make_handler(shops, latency))
+    print(f'{len(shops):,} shops at http://{host}:{server.server_port}/hotpepper/gourmet/v1/')
+    return server
+
+
+if __name__ == '__main__':
+    # 記録したレスポンスを再生するローカルのスタブサーバー
+    # HOTPEPPER_API_URL=http://127.0.0.1:8765/hotpepper/gourmet/v1/ を設定して使う
+    parser = argparse.ArgumentParser(description='ホットペッパーグルメAPIのスタブサーバー')
+    parser.add_argument('payloads', nargs='+', help='記録したレスポンスのディレクトリまたはJSONファイル')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='応答の遅延（秒）')
+    args = parser.parse_args()
+
+    serve(args.payloads, args.host, args.port, args.latency).serve_forever()
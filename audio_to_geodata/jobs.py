@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import query_events
+
+
+# 同時に処理するジョブの数と、完了したジョブを保持する時間（秒）・件数
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '8'))
+JOB_TTL = float(os.getenv('JOB_TTL', '600'))
+JOB_MAX_ENTRIES = int(os.getenv('JOB_MAX_ENTRIES', '1000'))
+
+# ジョブの状態（queued → running → done / error）
+JOB_STATUSES = ('queued', 'running', 'done', 'error')
+
+
+class Job:
+    '''バックグラウンドで処理する1件のリクエスト（状態・途中経過・結果）。'''
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = 'queued'
+        self.events = []
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'events': [{'event': event, 'data': data} for event, data in self.events],
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+
+### ジョブの管理
+class JobStore:
+    '''
+    ジョブをIDで管理し、スレッドプールで実行する。
+
+    各ジョブは独立したスレッドで動くため、同時に来た音声のリクエストが直列にならない。
+    完了したジョブは ttl 秒後（または max_entries 件を超えた場合は古い順）に削除する。
+    '''
+
+    def __init__(self, workers=JOB_WORKERS, ttl=JOB_TTL, max_entries=JOB_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._jobs = dict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+
+    def submit(self, func, *args):
+        '''
+        func(*args) をバックグラウンドで実行するジョブを作り、そのジョブを返す。
+        実行中に emit された途中経過は job.events に記録する。
+        '''
+        job = Job(uuid.uuid4().hex)
+        with self._lock:
+            self._expire()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, func, args)
+        return job
+
+    def get(self, job_id):
+        '''ジョブを返す。ない場合（削除済みを含む）はNone。'''
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job, func, args):
+        job.status = 'running'
+        try:
+            with query_events.sink(lambda event, data: job.events.append((event, data))):
+                job.result = func(*args)
+            job.status = 'done'
+        except Exception as e:
+            job.error = str(e)
+            job.status = 'error'
+        finally:
+            job.finished = time.time()
+
+    def _expire(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished is not None and now - job.finished > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+        # 件数が多すぎる場合は完了した古いジョブから削除する
+        finished = sorted((job for job in self._jobs.values() if job.finished is not None),
+                          key=lambda job: job.finished)
+        for job in finished[:max(len(self._jobs) - self.max_entries + 1, 0)]:
+            del self._jobs[job.id]
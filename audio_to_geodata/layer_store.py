@@ -0,0 +1,239 @@
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from metrics import record_cache
+
+
+# メモリに保持するレイヤーの合計の上限（バイト）
+LAYER_STORE_MAX_BYTES = int(os.getenv('LAYER_STORE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# 上限を超えたレイヤーを書き出すディレクトリ（空の場合は書き出さずに削除する）
+LAYER_STORE_SPILL_DIR = os.getenv('LAYER_STORE_SPILL_DIR', './cache/layer_store')
+
+# 更新のないセッションを削除するまでの時間（秒）
+LAYER_STORE_SESSION_TTL = float(os.getenv('LAYER_STORE_SESSION_TTL', '3600'))
+
+# セッションIDとレイヤー名に使える文字
+SESSION_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+LAYER_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}\.(json|bin)$')
+
+CONTENT_TYPES = {'.json': 'application/json', '.bin': 'application/octet-stream'}
+
+# これより小さいレイヤーはgzip圧縮しない（バイト）
+GZIP_MIN_SIZE = 1024
+
+
+class StoredLayer(NamedTuple):
+    '''保持しているレイヤー（シリアライズ済みのバイト列とETag）。'''
+    payload: bytes
+    etag: str
+    content_type: str
+    updated: float
+
+    @property
+    def size(self):
+        return len(self.payload)
+
+
+def valid_session(session):
+    return isinstance(session, str) and SESSION_PATTERN.match(session) is not None
+
+
+def valid_layer_name(name):
+    return isinstance(name, str) and LAYER_NAME_PATTERN.match(name) is not None
+
+
+### セッションごとのレイヤーストア
+class LayerStore:
+    '''
+    (セッション, レイヤー名) ごとにシリアライズ済みのレイヤーを保持するストア。
+
+    メモリ上の合計（gzip圧縮したコピーを含む）が max_bytes を超えると、最後に使われたのが古いレイヤーから spill_dir に書き出し
+    （spill_dir がなければ削除し）、次に読まれたときにメモリに戻す。
+    更新・読み込みのないセッションは session_ttl 秒後に削除する。
+
+    Args:
+    - max_bytes: メモリに保持するレイヤーの合計の上限（バイト）。
+    - spill_dir: 上限を超えたレイヤーを書き出すディレクトリ（プロセスIDのサブディレクトリに書く）。Noneなら書き出さない。
+    - session_ttl: セッションを削除するまでの時間（秒）。0なら削除しない。
+    '''
+
+    def __init__(self, max_bytes=LAYER_STORE_MAX_BYTES, spill_dir=LAYER_STORE_SPILL_DIR,
+                 session_ttl=LAYER_STORE_SESSION_TTL):
+        self.max_bytes = max_bytes
+        # 書き出し先はプロセスごとに分ける
+        self.spill_dir = os.path.join(spill_dir, str(os.getpid())) if spill_dir else None
+        self.session_ttl = session_ttl
+        self._layers = OrderedDict()
+        self._spilled = dict()
+        self._gzipped = dict()
+        self._sessions = dict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, session, name, payload, content_type=None):
+        '''
+        レイヤーを保存し、StoredLayer を返す。内容が同じ場合はETagも同じになる。
+
+        Raises:
+        - ValueError: セッションIDまたはレイヤー名が不正な場合。
+        '''
+        if not valid_session(session) or not valid_layer_name(name):
+            raise ValueError(f'Invalid session or layer name: {session}/{name}')
+        payload = bytes(payload)
+        layer = StoredLayer(
+            payload=payload,
+            etag=hashlib.sha1(payload).hexdigest(),
+            content_type=content_type or CONTENT_TYPES[os.path.splitext(name)[1]],
+            updated=time.time(),
+        )
+        key = (session, name)
+        with self._lock:
+            self._expire_sessions()
+            self._forget(key)
+            self._layers[key] = layer
+            self._bytes += layer.size
+            self._sessions[session] = time.time()
+            self._evict()
+        return layer
+
+    def get(self, session, name):
+        '''レイヤーを返す（書き出したレイヤーはメモリに戻す）。ない場合はNone。'''
+        layer = self._get(session, name)
+        record_cache('layer_store', 'hit' if layer is not None else 'miss')
+        return layer
+
+    def _get(self, session, name):
+        key = (session, name)
+        with self._lock:
+            layer = self._layers.get(key)
+            if layer is not None:
+                self._layers.move_to_end(key)
+            elif key in self._spilled:
+                layer = self._load(key)
+            if layer is not None:
+                self._sessions[session] = time.time()
+            return layer
+
+    def get_gzipped(self, session, name):
+        '''gzip圧縮したレイヤーの本体を返す（圧縮はETagごとに1回）。小さいレイヤー・ない場合はNone。'''
+        layer = self._get(session, name)
+        if layer is None or layer.size < GZIP_MIN_SIZE:
+            return None
+        with self._lock:
+            cached = self._gzipped.get((session, name))
+            if cached is not None and cached[0] == layer.etag:
+                return cached[1]
+        compressed = gzip.compress(layer.payload, compresslevel=6, mtime=0)
+        with self._lock:
+            # 圧縮したものもメモリの上限に数え、メモリに保持しているレイヤーの分だけ持つ
+            key = (session, name)
+            if key in self._layers:
+                self._drop_gzipped(key)
+                self._gzipped[key] = (layer.etag, compressed)
+                self._bytes += len(compressed)
+                self._evict()
+        return compressed
+
+    def list(self, session):
+        '''セッションのレイヤー名とETagの辞書。'''
+        with self._lock:
+            layers = {name: layer.etag for (layer_session, name), layer in self._layers.items()
+                      if layer_session == session}
+            layers.update({name: entry[1] for (layer_session, name), entry in self._spilled.items()
+                           if layer_session == session})
+            return layers
+
+    def delete_session(self, session):
+        '''
+        セッションのレイヤーをすべて削除する。
+
+        Raises:
+        - ValueError: セッションIDが不正な場合。
+        '''
+        if not valid_session(session):
+            raise ValueError(f'Invalid session: {session}')
+        with self._lock:
+            self._delete_session(session)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'layers': len(self._layers),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'spilled': len(self._spilled),
+            }
+
+    def _forget(self, key):
+        layer = self._layers.pop(key, None)
+        if layer is not None:
+            self._bytes -= layer.size
+        self._drop_gzipped(key)
+        spilled = self._spilled.pop(key, None)
+        if spilled is not None and os.path.exists(spilled[0]):
+            os.remove(spilled[0])
+
+    def _evict(self):
+        # 最後に使われたのが古いレイヤーから書き出す（最新のレイヤーは上限を超えても残す）
+        while self._bytes > self.max_bytes and len(self._layers) > 1:
+            key, layer = self._layers.popitem(last=False)
+            self._bytes -= layer.size
+            self._drop_gzipped(key)
+            if self.spill_dir is not None:
+                path = self._spill_path(key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as file:
+                    file.write(layer.payload)
+                self._spilled[key] = (path, layer.etag, layer.content_type, layer.updated)
+
+    def _drop_gzipped(self, key):
+        entry = self._gzipped.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def _load(self, key):
+        path, etag, content_type, updated = self._spilled.pop(key)
+        try:
+            with open(path, 'rb') as file:
+                payload = file.read()
+            os.remove(path)
+        except OSError:
+            return None
+        layer = StoredLayer(payload, etag, content_type, updated)
+        self._layers[key] = layer
+        self._bytes += layer.size
+        self._evict()
+        return layer
+
+    def _spill_path(self, key):
+        session, name = key
+        return os.path.join(self.spill_dir, session, name)
+
+    def _expire_sessions(self):
+        if not self.session_ttl:
+            return
+        now = time.time()
+        for session, last_used in list(self._sessions.items()):
+            if now - last_used > self.session_ttl:
+                self._delete_session(session)
+
+    def _delete_session(self, session):
+        for key in [key for key in list(self._layers) + list(self._spilled) if key[0] == session]:
+            self._forget(key)
+        self._sessions.pop(session, None)
+        # 不正なセッションID（'..' など）から書き出し先の外のパスを作らない
+        if self.spill_dir is not None and valid_session(session):
+            shutil.rmtree(os.path.join(self.spill_dir, session), ignore_errors=True)
+
+
+# プロセス内で共有するストア（Flask APIのプロセスで使う）
+default_store = LayerStore()
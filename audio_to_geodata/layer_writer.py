@@ -0,0 +1,287 @@
+import gzip
+import json
+import math
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import query_events
+from timing import stage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# レイヤーの出力先（Viteの公開ディレクトリ）
+LAYER_OUTPUT_PATH = os.getenv('LAYER_OUTPUT_PATH', '../public/')
+
+# 座標を丸める小数点以下の桁数（空の場合は丸めない）。7桁でおよそ1cm
+COORDINATE_PRECISION = int(os.getenv('LAYER_COORDINATE_PRECISION')) if os.getenv('LAYER_COORDINATE_PRECISION') else None
+
+# 事前圧縮した副ファイルの形式（gz, br）
+LAYER_SIDECARS = tuple(filter(None, os.getenv('LAYER_SIDECARS', 'gz,br').split(',')))
+
+# 書き出すレイヤーの形式（geojson: .json, binary: deck.glのバイナリ属性 .bin）
+LAYER_FORMATS = tuple(filter(None, os.getenv('LAYER_FORMATS', 'geojson').split(',')))
+
+# 座標として丸める値のキー（GeoJSONの coordinates, bbox と LineLayerの from, to）
+COORDINATE_KEYS = frozenset(['coordinates', 'bbox', 'from', 'to'])
+
+# 空のレイヤー
+EMPTY_FEATURE_COLLECTION = {'type': 'FeatureCollection', 'features': []}
+EMPTY_LINES = []
+
+
+def round_coordinates(json_data, precision):
+    '''GeoJSON・LineLayer用データの座標を指定の桁数に丸めた新しいデータを返す。'''
+    def round_values(value):
+        if isinstance(value, float):
+            return round(value, precision)
+        if isinstance(value, (list, tuple)):
+            return [round_values(item) for item in value]
+        return value
+
+    def walk(value):
+        if isinstance(value, dict):
+            return {key: round_values(item) if key in COORDINATE_KEYS else walk(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [walk(item) for item in value]
+        return value
+
+    return walk(json_data)
+
+
+def encode_json(json_data, precision=None):
+    '''
+    JSONデータを空白なしのUTF-8バイト列にする。orjsonがあれば使う。
+    NaN・無限大は、orjsonと同じく null にする。
+
+    Args:
+    - json_data: JSONに変換できるデータ。
+    - precision: 座標を丸める桁数。Noneなら丸めない。
+    '''
+    if precision is not None:
+        json_data = round_coordinates(json_data, precision)
+    if orjson is not None:
+        return orjson.dumps(json_data, option=orjson.OPT_SERIALIZE_NUMPY)
+    try:
+        text = json.dumps(json_data, ensure_ascii=False, separators=(',', ':'), allow_nan=False, default=_default)
+    except ValueError:
+        # NaN・無限大を含む場合だけ、null に置き換えてから変換する
+        text = json.dumps(_replace_non_finite(json_data), ensure_ascii=False, separators=(',', ':'),
+                          allow_nan=False, default=_default)
+    return text.encode('utf-8')
+
+
+def _default(value):
+    # numpyのスカラー・配列
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def _replace_non_finite(value):
+    '''NaN・無限大を None に置き換えた新しいデータを返す。'''
+    if hasattr(value, 'tolist') and not isinstance(value, (str, bytes)):
+        value = value.tolist()
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: _replace_non_finite(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_replace_non_finite(item) for item in value]
+    return value
+
+
+def write_atomic(file_path, data):
+    '''一時ファイルに書いてから置き換え、書き込み途中のファイルが読まれないようにする。'''
+    directory = os.path.dirname(file_path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(file_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_bytes(data, filename, output_path=LAYER_OUTPUT_PATH, sidecars=LAYER_SIDECARS):
+    '''
+    バイト列を出力先に保存し、事前圧縮した副ファイル（.gz, .br）も書く。
+
+    Returns:
+    - 保存したファイルのパス。
+    '''
+    os.makedirs(output_path, exist_ok=True)
+    file_path = os.path.join(output_path, filename)
+
+    # 副ファイルを先に書き、本体より古い副ファイルが残らないようにする
+    for extension in ('gz', 'br'):
+        sidecar_path = f'{file_path}.{extension}'
+        if extension in sidecars and (extension == 'gz' or brotli is not None):
+            compressed = gzip.compress(data, compresslevel=6, mtime=0) if extension == 'gz' else brotli.compress(data, quality=5)
+            write_atomic(sidecar_path, compressed)
+        elif os.path.exists(sidecar_path):
+            os.remove(sidecar_path)
+
+    write_atomic(file_path, data)
+    return file_path
+
+
+### JSONを指定のディレクトリへ保存するツール
+def save_json_to_directory(json_data, filename, output_path=LAYER_OUTPUT_PATH,
+                           precision=COORDINATE_PRECISION, sidecars=LAYER_SIDECARS):
+    '''
+    JSONデータを空白なしで出力先にアトミックに保存する関数。
+
+    Args:
+    - json_data: 保存するデータ（dict, list）。JSON文字列を渡さないこと。
+    - filename: ファイル名。
+    - output_path: 出力先ディレクトリ。
+    - precision: 座標を丸める桁数。Noneなら丸めない。
+    - sidecars: 事前圧縮した副ファイルの形式。
+
+    Returns:
+    - 保存したファイルのパス。
+    '''
+    return write_bytes(encode_json(json_data, precision), filename, output_path, sidecars)
+
+
+### レイヤーを指定の形式で保存するツール
+def save_layer(layer, filename, output_path=LAYER_OUTPUT_PATH, formats=LAYER_FORMATS,
+               precision=COORDINATE_PRECISION, sidecars=LAYER_SIDECARS):
+    '''
+    レイヤーをGeoJSON（filename）とdeck.glのバイナリ属性（filenameの拡張子を .bin にしたもの）の
+    一方または両方で保存する関数。書き出さない形式の古いファイルは削除する。
+
+    Args:
+    - layer: GeoDataFrame、GeoJSONの辞書、またはLineLayer用のレコードのリスト。
+    - filename: GeoJSONのファイル名（例: building.json）。
+    - formats: 書き出す形式（geojson, binary）。
+
+    Returns:
+    - 保存したファイルのパスのリスト。
+    '''
+    session = _session.get()
+    if session is None and query_events.streaming():
+        # ストリーミング中のクエリには、ファイルの書き込みを待たずにレイヤーを送る
+        json_data = json.loads(layer.to_json()) if hasattr(layer, 'to_json') else layer
+        query_events.emit('layer', {'name': filename, 'data': json_data})
+
+    # セッションのレイヤーは共有の出力先に書かず、Flask APIのレイヤーストアに送る
+    write = _send_layer if session is not None else _write_layer
+    destination = ('session', session) if session is not None else output_path
+
+    order = _write_order.get()
+    if order is not None:
+        # 並列に実行中のツールの場合、呼び出し順で後のツールが書いたレイヤーは上書きしない
+        write_order, position = order
+        with write_order.lock:
+            if position in write_order.cancelled or write_order.written.get((destination, filename), -1) > position:
+                return []
+            write_order.written[(destination, filename)] = position
+            return write(layer, filename, output_path, formats, precision, sidecars)
+    return write(layer, filename, output_path, formats, precision, sidecars)
+
+
+def _write_layer(layer, filename, output_path, formats, precision, sidecars):
+    paths = []
+    binary_filename = os.path.splitext(filename)[0] + '.bin'
+    for layer_format, name in (('geojson', filename), ('binary', binary_filename)):
+        if layer_format not in formats:
+            _remove_layer(os.path.join(output_path, name))
+        else:
+            with stage('serialize', layer=name):
+                if layer_format == 'geojson':
+                    json_data = json.loads(layer.to_json()) if hasattr(layer, 'to_json') else layer
+                    data = encode_json(json_data, precision)
+                else:
+                    import binary_layers
+                    data = binary_layers.encode_layer(layer)
+            with stage('write', layer=name):
+                paths.append(write_bytes(data, name, output_path, sidecars))
+    return paths
+
+
+def _send_layer(layer, filename, output_path, formats, precision, sidecars):
+    # 各形式にシリアライズしたバイト列を layer_payload イベントで送る（ファイル名の代わりにレイヤー名を返す）
+    names = []
+    binary_filename = os.path.splitext(filename)[0] + '.bin'
+    for layer_format, name in (('geojson', filename), ('binary', binary_filename)):
+        if layer_format not in formats:
+            continue
+        with stage('serialize', layer=name):
+            if layer_format == 'geojson':
+                json_data = json.loads(layer.to_json()) if hasattr(layer, 'to_json') else layer
+                payload = encode_json(json_data, precision)
+            else:
+                import binary_layers
+                payload = binary_layers.encode_layer(layer)
+        with stage('write', layer=name):
+            query_events.emit('layer_payload', {'name': name, 'payload': payload})
+        names.append(name)
+    return names
+
+
+def _remove_layer(file_path):
+    for path in (file_path, f'{file_path}.gz', f'{file_path}.br'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+### 並列に実行するツールの書き込み順
+# (LayerWriteOrder, 呼び出し順) を保持する
+_write_order = ContextVar('layer_write_order', default=None)
+
+
+class LayerWriteOrder:
+    '''
+    並列に実行したツール呼び出しのレイヤーの書き込みを、呼び出し順に逐次実行した場合と
+    同じ結果（同じファイルは最後の呼び出しのレイヤーが残る）にするための記録。
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.written = dict()
+        self.cancelled = set()
+
+    @contextmanager
+    def position(self, index):
+        '''この中で保存するレイヤーを index 番目の呼び出しのものとして扱う。'''
+        token = _write_order.set((self, index))
+        try:
+            yield
+        finally:
+            _write_order.reset(token)
+
+    def cancel(self, index):
+        '''制限時間を超えた呼び出しが後から書き込まないようにする。'''
+        with self.lock:
+            self.cancelled.add(index)
+
+
+### セッション
+# 実行中のクエリのセッションID（Noneなら共有の出力先に書く）
+_session = ContextVar('layer_session', default=None)
+
+
+@contextmanager
+def session_scope(session):
+    '''この中で保存するレイヤーをセッションのレイヤーとしてレイヤーストアに送る。Noneなら何もしない。'''
+    token = _session.set(session)
+    try:
+        yield
+    finally:
+        _session.reset(token)
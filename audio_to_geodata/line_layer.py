@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+
+# LineLayer用レコードの属性（from/to 以外）
+LINE_ATTRIBUTES = ('length', 'grade', 'oneway', 'highway', 'name', 'maxspeed', 'lanes')
+
+# リスト型の値を持つ場合に1要素1レコードへ展開する属性
+# OSMのリスト型の属性どうしは要素が対応しないため、展開するのは1つだけにする（直積を作らない）
+EXPLODE_ATTRIBUTES = ('name',)
+
+# 展開しないリスト型の値をつなぐ区切り文字（OSMのタグの複数値と同じ）
+LIST_SEPARATOR = ';'
+
+
+def build_line_data(gdf_nodes, gdf_edges, explode=EXPLODE_ATTRIBUTES):
+    '''
+    ノードとエッジのGeoDataFrameからLineLayer用のレコードを作成する関数。
+
+    ノード座標はosmidをキーにした配列の結合で引くため、エッジ数・ノード数に
+    対して線形の計算量で済む。リスト型の道路名は打ち切らずに1要素ずつの
+    レコードへ展開し、それ以外のリスト型の属性（highwayなど）は ';' でつないだ文字列にする。
+
+    Args:
+    - gdf_nodes: ノード。osmid（列またはインデックス）と x, y 列を持つ。
+    - gdf_edges: エッジ。u, v（列またはインデックス）と属性列を持つ。
+    - explode: リスト型の値を展開する属性名（1つのエッジが要素数の積だけ増えるため、通常は1つにする）。
+
+    Returns:
+    - from/to/length/grade/oneway/highway/name/maxspeed/lanes を持つ辞書のリスト。
+    '''
+    nodes = gdf_nodes if 'osmid' in gdf_nodes.columns else gdf_nodes.reset_index()
+    edges = gdf_edges if 'u' in gdf_edges.columns else gdf_edges.reset_index()
+
+    for column in explode:
+        if column in edges.columns:
+            edges = edges.explode(column, ignore_index=True)
+
+    # osmid -> 行番号 の対応で端点の座標を引く
+    node_index = pd.Index(nodes['osmid'].to_numpy())
+    if not node_index.is_unique:
+        keep = ~node_index.duplicated()
+        nodes = nodes[keep]
+        node_index = node_index[keep]
+    pos_u = node_index.get_indexer(edges['u'].to_numpy())
+    pos_v = node_index.get_indexer(edges['v'].to_numpy())
+
+    # 端点が見つからないエッジは除外する
+    found = (pos_u >= 0) & (pos_v >= 0)
+    if not found.all():
+        edges = edges[found].reset_index(drop=True)
+        pos_u = pos_u[found]
+        pos_v = pos_v[found]
+
+    xs = nodes['x'].to_numpy(dtype=float)
+    ys = nodes['y'].to_numpy(dtype=float)
+    zeros = np.zeros(len(edges))  # 高さは0にする
+    from_coords = np.column_stack([xs[pos_u], ys[pos_u], zeros]).tolist()
+    to_coords = np.column_stack([xs[pos_v], ys[pos_v], zeros]).tolist()
+
+    columns = {
+        attribute: _column_values(edges, attribute, default='' if attribute == 'name' else None)
+        for attribute in LINE_ATTRIBUTES
+    }
+
+    return [
+        {'from': from_coord, 'to': to_coord, **dict(zip(LINE_ATTRIBUTES, values))}
+        for from_coord, to_coord, values in zip(from_coords, to_coords, zip(*columns.values()))
+    ]
+
+
+def _column_values(edges, column, default=None):
+    '''
+    列をPythonの値のリストにする。欠損値と存在しない列はdefaultにし、
+    リスト型の値は LIST_SEPARATOR でつないだ文字列にする。
+    '''
+    if column not in edges.columns:
+        return [default] * len(edges)
+    values = edges[column].astype(object)
+    present = values.notna().to_numpy()
+    return [_join(value) if keep else default for value, keep in zip(values.tolist(), present)]
+
+
+def _join(value):
+    if isinstance(value, (list, tuple)):
+        return LIST_SEPARATOR.join(str(item) for item in value)
+    return value
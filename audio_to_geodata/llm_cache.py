@@ -0,0 +1,313 @@
+import argparse
+import atexit
+import copy
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from collections.abc import Mapping
+from typing import NamedTuple
+
+from timing import stage
+
+
+# キャッシュの保存先・メモリに保持する件数・SQLiteに保持する件数・有効期限（秒、0なら無期限）
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', './cache/llm_cache.sqlite')
+LLM_CACHE_SIZE = int(os.getenv('LLM_CACHE_SIZE', '1024'))
+LLM_CACHE_DISK_SIZE = int(os.getenv('LLM_CACHE_DISK_SIZE', '100000'))
+LLM_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', '0'))
+
+# キャッシュを使うかどうか
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE', '1') not in ('0', 'false', 'False')
+
+# 前後から取り除く記号（句読点・感嘆符・疑問符など）
+_EDGE_PUNCTUATION = re.compile(r'^[\s。、．，.,!?！？・…]+|[\s。、．，.,!?！？・…]+$')
+_SPACES = re.compile(r'\s+')
+
+# 命中数をSQLiteに書き込む間隔（件）
+_FLUSH_EVERY = 32
+
+
+class FunctionCall(NamedTuple):
+    '''モデルが生成した関数呼び出し（Vertex AIの FunctionCall と同じく name と args を持つ）。'''
+    name: str
+    args: dict
+
+
+def normalize_query(query):
+    '''
+    クエリを正規化する（全角/半角の統一、大文字/小文字の統一、空白の圧縮、前後の句読点の除去）。
+    「浸水深を表示してください。」と「浸水深を表示してください」は同じキーになる。
+    '''
+    text = unicodedata.normalize('NFKC', query).lower()
+    text = _SPACES.sub(' ', text)
+    return _EDGE_PUNCTUATION.sub('', text)
+
+
+def plain(value):
+    '''関数呼び出しの引数（protoのMapCompositeなど）をJSONに変換できる値にする。'''
+    if isinstance(value, Mapping):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) or (hasattr(value, '__iter__') and not isinstance(value, (str, bytes, dict))):
+        return [plain(item) for item in value]
+    return value
+
+
+def schema_version(declarations, model_name=None):
+    '''
+    ツールの定義とモデル名から版を表すハッシュを作る。
+    ツールの説明や引数を変更すると版が変わり、古いキャッシュは使われなくなる。
+
+    Args:
+    - declarations: Vertex AIの FunctionDeclaration、LangChainのツール、または辞書のリスト。
+    - model_name: モデル名。
+    '''
+    schemas = []
+    for declaration in declarations:
+        if hasattr(declaration, 'to_dict'):
+            schemas.append(declaration.to_dict())
+        elif hasattr(declaration, 'args') and hasattr(declaration, 'name'):
+            schemas.append({'name': declaration.name, 'description': declaration.description,
+                            'args': declaration.args})
+        elif isinstance(declaration, Mapping):
+            schemas.append(dict(declaration))
+        else:
+            schemas.append(repr(declaration))
+    payload = json.dumps({'model': model_name, 'tools': schemas}, sort_keys=True, ensure_ascii=False, default=repr)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+### 関数呼び出しのキャッシュ
+class LLMCache:
+    '''
+    正規化したクエリとツールの版から、モデルが生成した関数呼び出しを引くキャッシュ。
+
+    メモリ上のLRU（OrderedDict）とSQLiteの2段で保持する。SQLiteは複数のワーカープロセスで
+    共有され、再起動後も使われる。
+
+    Args:
+    - path: SQLiteのファイル。Noneならメモリのみ。
+    - max_entries: メモリに保持する件数。
+    - max_disk_entries: SQLiteに保持する件数（最後に使われた順に削除する）。
+    - ttl: 有効期限（秒）。0なら無期限。
+    '''
+
+    def __init__(self, path=LLM_CACHE_PATH, max_entries=LLM_CACHE_SIZE, max_disk_entries=LLM_CACHE_DISK_SIZE,
+                 ttl=LLM_CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._pending_hits = Counter()
+        self._pending_stats = Counter()
+        self._connection = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(path, timeout=5, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS function_calls (
+                    key TEXT PRIMARY KEY, schema TEXT, query TEXT, calls TEXT,
+                    created REAL, last_used REAL, hits INTEGER DEFAULT 0
+                )''')
+            # 全プロセスの命中数・失敗数の累計
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache_stats (name TEXT PRIMARY KEY, value INTEGER DEFAULT 0)')
+            self._connection.commit()
+
+    @staticmethod
+    def key(query, schema):
+        return hashlib.sha256(f'{schema}\0{normalize_query(query)}'.encode('utf-8')).hexdigest()
+
+    def get(self, query, schema):
+        '''関数呼び出しのリストを返す。ない場合・期限切れの場合はNone。'''
+        key = self.key(query, schema)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[0], now):
+                self._entries.move_to_end(key)
+                self._count_hit(key, 'memory_hits')
+                return entry[1]
+
+            row = None
+            if self._connection is not None:
+                row = self._connection.execute(
+                    'SELECT created, calls FROM function_calls WHERE key = ?', (key,)).fetchone()
+            if row is None or self._expired(row[0], now):
+                self._stats['misses'] += 1
+                self._pending_stats['misses'] += 1
+                return None
+
+            calls = json.loads(row[1])
+            self._remember(key, row[0], calls)
+            self._count_hit(key, 'disk_hits')
+            return calls
+
+    def put(self, query, schema, calls):
+        '''関数呼び出しのリスト（{name, args} の辞書のリスト）を登録する。'''
+        key = self.key(query, schema)
+        now = time.time()
+        calls = plain(calls)
+        with self._lock:
+            self._remember(key, now, calls)
+            if self._connection is not None:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO function_calls (key, schema, query, calls, created, last_used, hits) '
+                    'VALUES (?, ?, ?, ?, ?, ?, 0)',
+                    (key, schema, normalize_query(query), json.dumps(calls, ensure_ascii=False), now, now))
+                self._connection.execute(
+                    'DELETE FROM function_calls WHERE key NOT IN '
+                    '(SELECT key FROM function_calls ORDER BY last_used DESC LIMIT ?)', (self.max_disk_entries,))
+                self._flush_hits()
+                self._connection.commit()
+
+    def stats(self):
+        '''
+        このプロセスの命中数・失敗数・命中率と保持件数を返す。
+        SQLiteを使う場合は、全プロセスの累計を total に入れる。
+        '''
+        with self._lock:
+            hits = self._stats['memory_hits'] + self._stats['disk_hits']
+            lookups = hits + self._stats['misses']
+            stats = {
+                'hits': hits,
+                'memory_hits': self._stats['memory_hits'],
+                'disk_hits': self._stats['disk_hits'],
+                'misses': self._stats['misses'],
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._entries),
+            }
+            if self._connection is not None:
+                self._flush_hits()
+                self._connection.commit()
+                stats['disk_entries'] = self._connection.execute('SELECT COUNT(*) FROM function_calls').fetchone()[0]
+                stats['total'] = _with_hit_rate(dict(self._connection.execute('SELECT name, value FROM cache_stats')))
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pending_hits.clear()
+            self._pending_stats.clear()
+            if self._connection is not None:
+                self._connection.execute('DELETE FROM function_calls')
+                self._connection.execute('DELETE FROM cache_stats')
+                self._connection.commit()
+
+    def flush(self):
+        '''まだSQLiteに書き込んでいない命中数を書き込む。'''
+        with self._lock:
+            if self._connection is not None and (self._pending_hits or self._pending_stats):
+                self._flush_hits()
+                self._connection.commit()
+
+    def _expired(self, created, now):
+        return bool(self.ttl) and now - created > self.ttl
+
+    def _remember(self, key, created, calls):
+        self._entries[key] = (created, calls)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _count_hit(self, key, kind):
+        # 命中のたびにSQLiteへ書き込まず、まとめて書き込む
+        self._stats[kind] += 1
+        self._pending_stats[kind] += 1
+        self._pending_hits[key] += 1
+        if self._connection is not None and sum(self._pending_stats.values()) >= _FLUSH_EVERY:
+            self._flush_hits()
+            self._connection.commit()
+
+    def _flush_hits(self):
+        now = time.time()
+        self._connection.executemany(
+            'UPDATE function_calls SET hits = hits + ?, last_used = ? WHERE key = ?',
+            [(count, now, key) for key, count in self._pending_hits.items()])
+        self._connection.executemany(
+            'INSERT INTO cache_stats (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            list(self._pending_stats.items()))
+        self._pending_hits.clear()
+        self._pending_stats.clear()
+
+
+def _with_hit_rate(counts):
+    hits = counts.get('memory_hits', 0) + counts.get('disk_hits', 0)
+    lookups = hits + counts.get('misses', 0)
+    return dict(counts, hits=hits, misses=counts.get('misses', 0), hit_rate=hits / lookups if lookups else 0.0)
+
+
+# プロセス内で共有するキャッシュ
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_cache():
+    '''共有のキャッシュを返す。LLM_CACHE=0 の場合はNone。'''
+    global _default
+    if not LLM_CACHE_ENABLED:
+        return None
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                _default = LLMCache()
+                atexit.register(_default.flush)
+    return _default
+
+
+def cached_function_calls(query, schema, generate):
+    '''
+    クエリの関数呼び出しをキャッシュから返す。ない場合は generate() でモデルに生成させて登録する。
+
+    Args:
+    - query: ユーザーからの入力クエリ。
+    - schema: schema_version で作ったツールの版。
+    - generate: 関数呼び出しのリスト（{name, args} の辞書のリスト）を返す関数。
+
+    Returns:
+    - FunctionCall のリスト。
+
+    段階 model_call（ラベル cache=hit / miss / off）として計測し、モデルの呼び出しは子の段階 llm とする。
+    '''
+    with stage('model_call') as span:
+        cache = get_cache()
+        calls = cache.get(query, schema) if cache is not None else None
+        span.labels['cache'] = 'off' if cache is None else ('miss' if calls is None else 'hit')
+        if calls is None:
+            with stage('llm'):
+                calls = plain(generate())
+            if cache is not None and calls:
+                cache.put(query, schema, calls)
+    # キャッシュ内の引数をツールが書き換えないようにコピーを渡す
+    return [FunctionCall(call['name'], copy.deepcopy(call['args'])) for call in calls]
+
+
+if __name__ == '__main__':
+    # python llm_cache.py stats | clear
+    parser = argparse.ArgumentParser(description='関数呼び出しのキャッシュを表示・削除する')
+    parser.add_argument('command', choices=['stats', 'clear'])
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    cache = LLMCache()
+    if args.command == 'clear':
+        cache.clear()
+    else:
+        stats = cache.stats()
+        total = stats['total']
+        print(f"{stats['disk_entries']:,} entries, {total['hits']:,} hits, {total['misses']:,} misses, "
+              f"hit rate {total['hit_rate']:.1%}")
+        for query, calls, entry_hits in cache._connection.execute(
+                'SELECT query, calls, hits FROM function_calls ORDER BY hits DESC LIMIT ?', (args.top,)):
+            print(f'{entry_hits}\t{query}\t{calls}')
@@ -1,79 +1,40 @@
 from dotenv import load_dotenv
 import os
 import sys
-import vertexai
-from vertexai.generative_models import (
-    GenerationConfig,
-    GenerativeModel,
-    Content,
-    Part,
-    FunctionDeclaration,
-    Tool,
-    ToolConfig
-)
-from google.cloud import speech
 import json
-from shapely.geometry import Polygon
-import geopandas as gpd
-import pydeck as pdk
+from layer_writer import save_layer
+import fakes
+import llm_cache
+import query_events
+import streaming_asr
+from tool_registry import ToolRegistry
 
-# コマンドライン引数の取得
-args = sys.argv
-
-# APIキーの取得
-load_dotenv()
-PROJECT_ID = os.getenv('GCP_PROJECT_ID')
-LOCATION = os.getenv('GCP_LOCATION')
-MODEL = os.getenv('MODEL')
-audio_file_path = args[1]
-
-# Vertex AIを初期化する
-vertexai.init(project=PROJECT_ID, location=LOCATION)
+# google.cloud.speech・geopandas・vertexai などの重いモジュールは、使う関数の中でimportする
+registry = ToolRegistry()
 
 def transcribe_audio(audio_file_path):
-    client = speech.SpeechClient()
-
-    with open(audio_file_path, 'rb') as audio_file:
-        content = audio_file.read()
-
-    audio = speech.RecognitionAudio(content=content)
-    config = speech.RecognitionConfig(
-        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-        sample_rate_hertz=48000,
-        language_code="ja-JP",
-    )
-
-    response = client.recognize(config=config, audio=audio)
-
-    if response.results:
-        return response.results[0].alternatives[0].transcript
-    else:
-        return ""
-
-# 音声認識
-query = transcribe_audio(audio_file_path)
-os.remove(audio_file_path)
-print(query)
+    '''
+    音声ファイルをストリーミング認識で文字起こしする関数。
+    ffmpegで変換しながら認識器に送り、最初に確定した文字起こしを返す。
+    '''
+    return streaming_asr.transcribe_stream(audio_file_path)
 
 ### 関数の実装
+@registry.tool(description='Add two numbers.', params={'a': 'one number', 'b': 'another number'})
 def add_two_numbers(a: int, b: int):
     return a + b
 
+@registry.tool(description='Multiply two numbers.', params={'a': 'one number', 'b': 'another number'})
 def multiply_two_numbers(a: int, b: int):
     return a * b
 
-def save_json_to_directory(json_data, filename, output_path='../public/'):
-    # ディレクトリが存在しない場合は作成する
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-    
-    # JSONデータをファイルに保存する
-    file_path = os.path.join(output_path, filename)
-    with open(file_path, 'w') as file:
-        json.dump(json_data, file, indent=2, ensure_ascii=False)
-
+@registry.tool(params={'building_type': 'Type of building to build, either "大きい" or "小さい".',
+                       'visualize': 'Whether to visualize the building or not.'},
+               requires=('geopandas', 'shapely'))
 def buildbuilding(building_type='大きい', visualize=False):
     '''Build large or small buildings.'''
+    import geopandas as gpd
+    from shapely.geometry import Polygon
 
     if building_type == '大きい':
         param_buildingHeight = 150
@@ -116,6 +77,7 @@ def buildbuilding(building_type='大きい', visualize=False):
     building_gdf['measuredHeight'] = param_buildingHeight
 
     if visualize:
+      import pydeck as pdk
 
       # ビューの設定
       view_state = pdk.ViewState(
@@ -142,102 +104,120 @@ def buildbuilding(building_type='大きい', visualize=False):
       deck.show()
 
     building_json = json.loads(building_gdf.to_json())
-    save_json_to_directory(json_data=building_json, filename='building.json')
+    save_layer(building_json, filename='building.json')
     return building_json
 
-### 関数宣言
-add_func = FunctionDeclaration(
-    name='add_two_numbers',
-    description='Add two numbers.',
-    parameters={
-        'type': 'object',
-        'properties': {'a': {'type': 'integer', 'description': 'one number'}, 'b': {'type': 'integer', 'description': 'another number'}},
-    },
-)
-
-multiply_func = FunctionDeclaration(
-    name='multiply_two_numbers',
-    description='Multiply two numbers.',
-    parameters={
-        'type': 'object',
-        'properties': {'a': {'type': 'integer', 'description': 'one number'}, 'b': {'type': 'integer', 'description': 'another number'}},
-    },
-)
-
-buildbuilding_func = FunctionDeclaration(
-    name='buildbuilding',
-    description='Build large or small buildings.',
-    parameters={
-        'type': 'object',
-        'properties': {
-            'building_type': {'type': 'string', 'description': 'Type of building to build, either "大きい" or "小さい".'},
-            'visualize': {'type': 'boolean', 'description': 'Whether to visualize the building or not.'}
-        },
-    },
-)
-
-### Toolの定義
-calc_tool = Tool(
-  function_declarations=[add_func, multiply_func, buildbuilding_func]
-)
-
-### ToolConfigの定義
-calc_tool_config = ToolConfig(
-    function_calling_config=ToolConfig.FunctionCallingConfig(
-        mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
-        allowed_function_names=['add_two_numbers', 'multiply_two_numbers', 'buildbuilding']
-    )
-)
-
 ### モデルの定義
-model = GenerativeModel(
-    model_name=MODEL,
-    tools=[calc_tool],
-    tool_config=calc_tool_config
-)
-
-### ユーザープロンプトの定義
-user_prompt_content = Content(
-    role='user',
-    parts=[
-        Part.from_text(query)
-    ]
-)
-
-### 呼び出す関数と引数をモデルに生成させる
-response = model.generate_content(
-    user_prompt_content,
-)
-response_function_call_content = response.candidates[0].content
-function_call = response.candidates[0].content.parts[0].function_call
-
-### 関数を実行する
-function_response = None
-if function_call.name == 'add_two_numbers':
-
-    # 引数の取り出し
-    a = function_call.args['a']
-    b = function_call.args['b']
-
-    # 関数の実行
-    function_response = add_two_numbers(a=a, b=b)
+def init_model():
+    '''
+    Vertex AIを初期化し、関数宣言を登録したモデルを返す関数。
+    常駐ワーカーからは起動時に一度だけ呼ばれる。
+    '''
+
+    # 負荷試験用のローカルのモデル（LLM_BACKEND=fake）
+    if fakes.use_fake_model():
+        return fakes.FakeModel(registry.names())
+
+    # APIキーの取得
+    load_dotenv()
+    PROJECT_ID = os.getenv('GCP_PROJECT_ID')
+    LOCATION = os.getenv('GCP_LOCATION')
+    MODEL = os.getenv('MODEL')
+
+    import vertexai
+    from vertexai.generative_models import GenerativeModel, Tool, ToolConfig
+
+    # Vertex AIを初期化する
+    vertexai.init(project=PROJECT_ID, location=LOCATION)
+
+    ### Tool・ToolConfigの定義（関数宣言は registry から作る）
+    calc_tool = Tool(
+        function_declarations=registry.function_declarations()
+    )
+    calc_tool_config = ToolConfig(
+        function_calling_config=ToolConfig.FunctionCallingConfig(
+            mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
+            allowed_function_names=registry.names()
+        )
+    )
 
-elif function_call.name == 'multiply_two_numbers':
+    return GenerativeModel(
+        model_name=MODEL,
+        tools=[calc_tool],
+        tool_config=calc_tool_config
+    )
 
-    # 引数の取り出し
-    a = function_call.args['a']
-    b = function_call.args['b']
+def warmup():
+    '''ツールと音声認識に必要なモジュールを読み込む関数。常駐ワーカーから起動時に呼ばれる。'''
+    registry.preload()
+    try:
+        from google.cloud import speech  # noqa: F401
+    except ImportError:
+        pass
+
+def run_query(model, audio_file_path):
+    '''
+    音声ファイルを文字起こしし、モデルに関数呼び出しを生成させて実行する関数。
+
+    Args:
+    - model: init_modelで生成したモデル。
+    - audio_file_path: 音声ファイルのパス。処理後に削除される。
+
+    Returns:
+    - 実行した関数の戻り値。
+    '''
+
+    # 音声認識
+    query = transcribe_audio(audio_file_path)
+    os.remove(audio_file_path)
+    return run_transcript(model, query)
+
+def run_transcript(model, query):
+    '''
+    文字起こし済みのテキストから、モデルに関数呼び出しを生成させて実行する関数。
+    /upload のジョブ（アップロードを受け取ったプロセスで文字起こし済み）から呼ばれる。
+
+    Args:
+    - model: init_modelで生成したモデル。
+    - query: 文字起こしの結果。
+
+    Returns:
+    - 実行した関数の戻り値。
+    '''
+    print(query)
+
+    ### 呼び出す関数と引数をモデルに生成させる（同じクエリの結果はキャッシュから返す）
+    def generate():
+        if isinstance(model, fakes.FakeModel):
+            # ローカルのモデルはクエリの文字列をそのまま受け取る
+            user_prompt_content = query
+        else:
+            from vertexai.generative_models import Content, Part
+
+            # ユーザープロンプトの定義
+            user_prompt_content = Content(
+                role='user',
+                parts=[
+                    Part.from_text(query)
+                ]
+            )
+        response = model.generate_content(
+            user_prompt_content,
+        )
+        function_call = response.candidates[0].content.parts[0].function_call
+        return [{'name': function_call.name, 'args': function_call.args}]
 
-    # 関数の実行
-    function_response = multiply_two_numbers(a=a, b=b)
+    schema = llm_cache.schema_version(registry.declarations(), getattr(model, '_model_name', None))
+    function_call = llm_cache.cached_function_calls(query, schema, generate)[0]
+    query_events.emit('function_call', {'name': function_call.name, 'args': function_call.args})
 
-elif function_call.name == 'buildbuilding':
+    ### 関数を実行する（名前から関数を引き、省略された引数は関数の既定値を使う）
+    function_response = registry.call(function_call.name, function_call.args)
 
-    # 引数の取り出し
-    building_type = function_call.args.get('building_type', '大きい')
-    visualize = function_call.args.get('visualize', False)
+    return function_response
 
-    # 関数の実行
-    function_response = buildbuilding(building_type=building_type, visualize=visualize)
 
-print(function_response)
+if __name__ == '__main__':
+    # コマンドライン引数から音声ファイルのパスを取得
+    audio_file_path = sys.argv[1]
+    print(run_query(init_model(), audio_file_path))
@@ -2,59 +2,57 @@ import json
 import os
 import sys
 
-import geopandas as gpd
-import pandas as pd
-import pydeck as pdk
-import requests
-import vertexai
 from dotenv import load_dotenv
-from plateaukit import load_dataset
-from shapely.geometry import Point, Polygon
-from vertexai.generative_models import (
-    Content,
-    FunctionDeclaration,
-    GenerationConfig,
-    GenerativeModel,
-    Part,
-    Tool,
-    ToolConfig,
-)
-
-# コマンドライン引数の取得
-args = sys.argv
-
-# APIキーの取得
-load_dotenv()
-PROJECT_ID = os.getenv('GCP_PROJECT_ID')
-LOCATION = os.getenv('GCP_LOCATION')
-MODEL = os.getenv('MODEL')
-
-### Vertex AIを初期化する
-vertexai.init(project=PROJECT_ID, location=LOCATION)
-
-# コマンドライン引数からクエリを取得
-query = args[1]
+from layer_writer import EMPTY_FEATURE_COLLECTION, save_layer
+import fakes
+import llm_cache
+import query_events
+from timing import stage
+from tool_registry import ToolRegistry
+
+# geopandas・vertexai などの重いモジュールは、使う関数の中でimportする
+# （add_two_numbers だけを実行する場合などに起動を速くするため）
+registry = ToolRegistry()
 
 ### 関数の実装
+@registry.tool(description='Add two numbers.', params={'a': 'one number', 'b': 'another number'})
 def add_two_numbers(a: int, b: int):
     return a + b
 
+@registry.tool(description='Multiply two numbers.', params={'a': 'one number', 'b': 'another number'})
 def multiply_two_numbers(a: int, b: int):
     return a * b
 
-def save_json_to_directory(json_data, filename, output_path='../public/'):
-    # ディレクトリが存在しない場合は作成する
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-    
-    # JSONデータをファイルに保存する
-    file_path = os.path.join(output_path, filename)
-    with open(file_path, 'w') as file:
-        json.dump(json_data, file, indent=2, ensure_ascii=False)
-
+@registry.tool(params={'show_type': 'Either "浸水深表示" or "浸水深削除".'}, hidden=('visualize',),
+               requires=('geopandas', 'shapely', 'flood_raster'))
 def show_flood_depth(show_type='浸水深表示', visualize=False):
     '''Show flood depth of the designated area.'''
-
+    import geopandas as gpd
+    from shapely.geometry import Polygon
+    import flood_raster
+
+    # 浸水深のグリッドを取り込んでいれば、表示範囲の浸水深を区分したポリゴンを返す
+    # 建物のタイルストアがあれば、表示範囲の建物ごとの最大・平均浸水深も書き出す
+    with stage('load'):
+        raster = flood_raster.get_raster() if show_type == '浸水深表示' else None
+        buildings = None
+        if raster is not None:
+            import building_store
+            if building_store.default_store.available():
+                buildings = building_store.default_store.query_bbox(flood_raster.FLOOD_VIEW_BBOX)
+    if raster is not None:
+        with stage('compute'):
+            flooding_gdf = raster.depth_bands(flood_raster.FLOOD_VIEW_BBOX)
+            if buildings is not None:
+                buildings = buildings.join(raster.zonal_stats(buildings))
+        with stage('serialize'):
+            flooding_json = json.loads(flooding_gdf.to_json())
+            buildings_json = json.loads(buildings.to_json()) if buildings is not None else EMPTY_FEATURE_COLLECTION
+        save_layer(flooding_json, filename='flooding.json')
+        save_layer(buildings_json, filename='flood_buildings.json')
+        return flooding_json
+
+    # 取り込んでいない場合（と削除の場合）は、従来の範囲のポリゴンに一定の浸水深を設定する
     if show_type == '浸水深表示':
         param_floodingDepth = 70
         # ポリゴンの座標データ
@@ -88,143 +86,159 @@ def show_flood_depth(show_type='浸水深表示', visualize=False):
           "type": "Polygon"
         }
 
-    # ShapelyのPolygonオブジェクトを作成
-    polygon = Polygon(flooding_geojson['coordinates'][0])
+    with stage('compute'):
+        # ShapelyのPolygonオブジェクトを作成
+        polygon = Polygon(flooding_geojson['coordinates'][0])
 
-    # GeoDataFrameの座標系を適切に設定 (ここではWGS84と仮定)
-    flooding_gdf =  gpd.GeoDataFrame(index=[0], geometry=[polygon]).set_crs(epsg=4326)
+        # GeoDataFrameの座標系を適切に設定 (ここではWGS84と仮定)
+        flooding_gdf =  gpd.GeoDataFrame(index=[0], geometry=[polygon]).set_crs(epsg=4326)
 
-    # 浸水深をセット
-    flooding_gdf['measuredHeight'] = param_floodingDepth
-    flooding_json = json.loads(flooding_gdf.to_json())
-    save_json_to_directory(json_data=flooding_json, filename='flooding.json')
+        # 浸水深をセット
+        flooding_gdf['measuredHeight'] = param_floodingDepth
+    with stage('serialize'):
+        flooding_json = json.loads(flooding_gdf.to_json())
+    save_layer(flooding_json, filename='flooding.json')
+    save_layer(EMPTY_FEATURE_COLLECTION, filename='flood_buildings.json')
     return flooding_json
 
+@registry.tool(params={'show_type': '避難所（shelters）を表示します。'}, hidden=('visualize',),
+               requires=('geopandas', 'shapely', 'shelter_analysis'))
 def show_shelters(show_type='避難所表示', visualize=False):
     '''Show shelters.'''
+    import geopandas as gpd
+    from shapely.geometry import Point
+    import shelter_analysis
+
+    # 避難所の一覧があれば、道路ネットワーク上で歩いて最も近い避難所を全建物に割り当てる
+    with stage('load'):
+        analysis = shelter_analysis.get_analysis() if shelter_analysis.available() else None
+        buildings = None
+        if analysis is not None:
+            import building_store
+            if building_store.default_store.available():
+                buildings = building_store.default_store.query_bbox(analysis.bbox())
+    if analysis is not None:
+        with stage('compute'):
+            shelters_gdf = analysis.shelter_points()
+            catchments_gdf = analysis.catchments()
+            if buildings is not None:
+                buildings = analysis.assign_buildings(buildings)
+        with stage('serialize'):
+            shelters_json = json.loads(shelters_gdf.to_json())
+            catchments_json = json.loads(catchments_gdf.to_json())
+            buildings_json = json.loads(buildings.to_json()) if buildings is not None else EMPTY_FEATURE_COLLECTION
+        # 避難所の点と割り当て範囲（重なり合うポリゴン）は別のレイヤーにする
+        save_layer(shelters_json, filename='shelters.json')
+        save_layer(catchments_json, filename='shelter_catchments.json')
+        # 建物のタイルストアがない場合も、前回の割り当てが残らないよう空にする
+        save_layer(buildings_json, filename='shelter_buildings.json')
+        return shelters_json
+
     # 2つのPointを作成
     point1 = Point(139.537108, 35.648013)  # Example: Tokyo, Japan
     point2 = Point(139.527570, 35.654551)  # Example: New York City, USA
 
     # GeoDataFrameを作成
-    shelters_gdf = gpd.GeoDataFrame([{'geometry': point1,}, 
-                            {'geometry': point2,}],
-                        crs="EPSG:4326")
-
-    
-    shelters_json = json.loads(shelters_gdf.to_json())
-    save_json_to_directory(json_data=shelters_json, filename='shelters.json')
+    with stage('compute'):
+        shelters_gdf = gpd.GeoDataFrame([{'geometry': point1,}, 
+                                {'geometry': point2,}],
+                            crs="EPSG:4326")
+
+    with stage('serialize'):
+        shelters_json = json.loads(shelters_gdf.to_json())
+    save_layer(shelters_json, filename='shelters.json')
+    save_layer(EMPTY_FEATURE_COLLECTION, filename='shelter_catchments.json')
+    save_layer(EMPTY_FEATURE_COLLECTION, filename='shelter_buildings.json')
     return shelters_json
 
-### 関数宣言
-add_func = FunctionDeclaration(
-    name='add_two_numbers',
-    description='Add two numbers.',
-    parameters={
-        'type': 'object',
-        'properties': {'a': {'type': 'integer', 'description': 'one number'}, 'b': {'type': 'integer', 'description': 'another number'}},
-    },
-)
-
-multiply_func = FunctionDeclaration(
-    name='multiply_two_numbers',
-    description='Multiply two numbers.',
-    parameters={
-        'type': 'object',
-        'properties': {'a': {'type': 'integer', 'description': 'one number'}, 'b': {'type': 'integer', 'description': 'another number'}},
-    },
-)
-
-show_flood_depth_func = FunctionDeclaration(
-    name='show_flood_depth',
-    description='Show flood depth of the designated area.',
-    parameters={
-        'type': 'object',
-        'properties': {
-            'show_type': {'type': 'string', 'description': 'Either "浸水深表示" or "浸水深削除".'}
-        },
-    },
-)
-
-show_shelters_func = FunctionDeclaration(
-    name='show_shelters',
-    description='Show shelters.',
-    parameters={
-        'type': 'object',
-        'properties': {
-            'show_type': {'type': 'string', 'description': '避難所（shelters）を表示します。'}
-        },
-    },
-)
-
-### Toolの定義
-calc_tool = Tool(
-  function_declarations=[add_func, multiply_func, show_flood_depth_func, show_shelters_func]
-)
-
-### ToolConfigの定義
-calc_tool_config = ToolConfig(
-    function_calling_config=ToolConfig.FunctionCallingConfig(
-        mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
-        allowed_function_names=['add_two_numbers', 'multiply_two_numbers', 'show_flood_depth', 'show_shelters']
-    )
-)
-
 ### モデルの定義
-model = GenerativeModel(
-    model_name=MODEL,
-    tools=[calc_tool],
-    tool_config=calc_tool_config
-)
-
-### ユーザープロンプトの定義
-user_prompt_content = Content(
-    role='user',
-    parts=[
-        Part.from_text(query)
-    ]
-)
-
-### 呼び出す関数と引数をモデルに生成させる
-response = model.generate_content(
-    user_prompt_content,
-)
-response_function_call_content = response.candidates[0].content
-function_call = response.candidates[0].content.parts[0].function_call
-
-### 関数を実行する
-function_response = None
-if function_call.name == 'add_two_numbers':
-
-    # 引数の取り出し
-    a = function_call.args['a']
-    b = function_call.args['b']
-
-    # 関数の実行
-    function_response = add_two_numbers(a=a, b=b)
-
-elif function_call.name == 'multiply_two_numbers':
-
-    # 引数の取り出し
-    a = function_call.args['a']
-    b = function_call.args['b']
+def init_model():
+    '''
+    Vertex AIを初期化し、関数宣言を登録したモデルを返す関数。
+    常駐ワーカーからは起動時に一度だけ呼ばれる。
+    '''
+
+    # 負荷試験用のローカルのモデル（LLM_BACKEND=fake）
+    if fakes.use_fake_model():
+        return fakes.FakeModel(registry.names())
+
+    # APIキーの取得
+    load_dotenv()
+    PROJECT_ID = os.getenv('GCP_PROJECT_ID')
+    LOCATION = os.getenv('GCP_LOCATION')
+    MODEL = os.getenv('MODEL')
+
+    import vertexai
+    from vertexai.generative_models import GenerativeModel, Tool, ToolConfig
+
+    ### Vertex AIを初期化する
+    vertexai.init(project=PROJECT_ID, location=LOCATION)
+
+    ### Tool・ToolConfigの定義（関数宣言は registry から作る）
+    calc_tool = Tool(
+        function_declarations=registry.function_declarations()
+    )
+    calc_tool_config = ToolConfig(
+        function_calling_config=ToolConfig.FunctionCallingConfig(
+            mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
+            allowed_function_names=registry.names()
+        )
+    )
 
-    # 関数の実行
-    function_response = multiply_two_numbers(a=a, b=b)
+    return GenerativeModel(
+        model_name=MODEL,
+        tools=[calc_tool],
+        tool_config=calc_tool_config
+    )
 
-elif function_call.name == 'show_flood_depth':
+def warmup():
+    '''ツールの実行に必要なモジュールを読み込む関数。常駐ワーカーから起動時に呼ばれる。'''
+    registry.preload()
+
+def run_query(model, query):
+    '''
+    クエリからモデルに関数呼び出しを生成させ、その関数を実行する関数。
+
+    Args:
+    - model: init_modelで生成したモデル。
+    - query: ユーザーからの入力クエリ。
+
+    Returns:
+    - 実行した関数の戻り値。
+    '''
+
+    ### 呼び出す関数と引数をモデルに生成させる（同じクエリの結果はキャッシュから返す）
+    def generate():
+        if isinstance(model, fakes.FakeModel):
+            # ローカルのモデルはクエリの文字列をそのまま受け取る
+            user_prompt_content = query
+        else:
+            from vertexai.generative_models import Content, Part
+
+            # ユーザープロンプトの定義
+            user_prompt_content = Content(
+                role='user',
+                parts=[
+                    Part.from_text(query)
+                ]
+            )
+        response = model.generate_content(
+            user_prompt_content,
+        )
+        function_call = response.candidates[0].content.parts[0].function_call
+        return [{'name': function_call.name, 'args': function_call.args}]
 
-    # 引数の取り出し
-    show_type = function_call.args.get('show_type', '浸水深表示')
+    schema = llm_cache.schema_version(registry.declarations(), getattr(model, '_model_name', None))
+    function_call = llm_cache.cached_function_calls(query, schema, generate)[0]
+    query_events.emit('function_call', {'name': function_call.name, 'args': function_call.args})
 
-    # 関数の実行
-    function_response = show_flood_depth(show_type=show_type)
+    ### 関数を実行する（名前から関数を引き、省略された引数は関数の既定値を使う）
+    function_response = registry.call(function_call.name, function_call.args)
 
-elif function_call.name == 'show_shelters':
-    # 引数の取り出し
-    show_type = function_call.args.get('show_type', '避難所表示')
+    return function_response
 
-    # 関数の実行
-    function_response = show_shelters(show_type=show_type)
 
-print(function_response)
+if __name__ == '__main__':
+    # コマンドライン引数からクエリを取得
+    query = sys.argv[1]
+    print(run_query(init_model(), query))
@@ -0,0 +1,188 @@
+import bisect
+import os
+import threading
+
+import timing
+
+
+# 処理時間のヒストグラムの区間の上限（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# これより時間のかかったリクエストの段階の木をログに出す（秒、0なら出さない）
+METRICS_SLOW_REQUEST_SECONDS = float(os.getenv('METRICS_SLOW_REQUEST_SECONDS', '0'))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    '''増える一方の値（キャッシュの命中数など）。'''
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class Histogram(_Metric):
+    '''値（処理時間など）の分布。区間ごとの累積件数と合計・件数を持つ。'''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return sum(entry[0]) if entry else 0
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+### メトリクスの登録
+class Registry:
+    '''メトリクスを名前で管理し、Prometheusのテキスト形式で書き出す。'''
+
+    def __init__(self):
+        self._metrics = dict()
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        '''Prometheusのテキスト形式（text/plain; version=0.0.4）。'''
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric already registered: {metric.name}')
+            self._metrics[metric.name] = metric
+        return metric
+
+
+# プロセス内で共有するメトリクス（Flask APIのプロセスで使う）
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.histogram(
+    'geo_request_duration_seconds', 'Time to serve a request, by endpoint.', ('endpoint',))
+STAGE_DURATION = REGISTRY.histogram(
+    'geo_stage_duration_seconds',
+    'Time spent in each pipeline stage (upload, transcription, model_call, tool, load, compute, serialize, write).',
+    ('stage', 'tool'))
+CACHE_REQUESTS = REGISTRY.counter(
+    'geo_cache_requests_total',
+    'Cache lookups by cache (llm, graph, graph_snapshot, graph_artifact, poi_tiles, layer_store) '
+    'and result (hit, miss, off).',
+    ('cache', 'result'))
+REQUEST_ERRORS = REGISTRY.counter(
+    'geo_request_errors_total', 'Requests that ended with an error, by endpoint.', ('endpoint',))
+
+
+def observe_span(span):
+    '''
+    段階の木（timing.Span）をメトリクスに記録する。
+    最上位の request は REQUEST_DURATION に、それ以外の段階は STAGE_DURATION に記録し、
+    model_call の段階からは関数呼び出しのキャッシュの命中・失敗を、
+    段階に記録されたキャッシュの出来事（record_cache）からはそれぞれのキャッシュの命中・失敗を数える。
+    '''
+    for child in span.walk():
+        for name, labels in child.events:
+            if name == 'cache':
+                CACHE_REQUESTS.inc(cache=labels['cache'], result=labels['result'])
+        if child.name == 'request':
+            endpoint = child.labels.get('endpoint', '')
+            REQUEST_DURATION.observe(child.duration, endpoint=endpoint)
+            if child.error:
+                REQUEST_ERRORS.inc(endpoint=endpoint)
+            continue
+        STAGE_DURATION.observe(child.duration, stage=child.name, tool=child.labels.get('tool', ''))
+        if child.name == 'model_call':
+            CACHE_REQUESTS.inc(cache='llm', result=child.labels.get('cache', 'off'))
+
+
+def record_cache(cache, result):
+    '''
+    キャッシュの命中（hit）・失敗（miss）を数える。
+
+    段階の計測中は段階の出来事として記録し、段階の木がメトリクスに記録されるときに数える
+    （常駐ワーカーでの参照も、段階と一緒にFlask APIのプロセスへ送られて数えられる）。
+    計測中でなければ、このプロセスのメトリクスに直接数える。
+    '''
+    if not timing.record('cache', cache=cache, result=result):
+        CACHE_REQUESTS.inc(cache=cache, result=result)
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from routing_engine import EARTH_RADIUS
+
+# 道路ネットワークから離れすぎた地点を拒否する距離（m）
+MAX_SNAP_DISTANCE = float(os.getenv('MAX_SNAP_DISTANCE', '500'))
+
+
+class SnapDistanceError(ValueError):
+    '''地点が道路ネットワークから離れすぎている場合の例外。'''
+
+
+### 最寄りノードの空間索引
+class NodeIndex:
+    '''
+    道路グラフのノード座標に対するKD木。
+
+    緯度経度をグラフの中心緯度で正距円筒図法に投影し（単位m）、KD木を一度だけ作る。
+    区や市の範囲であれば投影による距離の誤差は無視できる。
+
+    Args:
+    - node_ids: ノードのosmidの配列。
+    - lats, lons: ノードの緯度・経度の配列。
+    '''
+
+    def __init__(self, node_ids, lats, lons):
+        self.node_ids = np.asarray(node_ids)
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        self._cos_lat0 = float(np.cos(np.radians(lats.mean()))) if len(lats) else 1.0
+        self._tree = cKDTree(self._project(lats, lons))
+
+    @classmethod
+    def from_graph(cls, G):
+        '''osmnxのグラフから索引を作成する。'''
+        node_ids, lats, lons = [], [], []
+        for node_id, data in G.nodes(data=True):
+            node_ids.append(node_id)
+            lats.append(data['y'])
+            lons.append(data['x'])
+        return cls(node_ids, lats, lons)
+
+    def _project(self, lats, lons):
+        x = EARTH_RADIUS * np.radians(lons) * self._cos_lat0
+        y = EARTH_RADIUS * np.radians(lats)
+        return np.column_stack([x, y])
+
+    def snap(self, lats, lons, max_distance=MAX_SNAP_DISTANCE):
+        '''
+        N地点をまとめて最寄りノードに対応付ける。
+
+        Args:
+        - lats, lons: 地点の緯度・経度の配列。
+        - max_distance: これより遠い地点は対応付けない（m）。Noneなら制限なし。
+
+        Returns:
+        - (node_ids, distances)。対応付けられなかった地点は node_id が -1、距離が inf。
+        '''
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+        upper_bound = np.inf if max_distance is None else max_distance
+        distances, positions = self._tree.query(self._project(lats, lons), distance_upper_bound=upper_bound)
+
+        found = np.isfinite(distances)
+        node_ids = np.full(len(lats), -1, dtype=self.node_ids.dtype)
+        node_ids[found] = self.node_ids[positions[found]]
+        return node_ids, distances
+
+    def snap_point(self, lat, lon, max_distance=MAX_SNAP_DISTANCE):
+        '''
+        1地点を最寄りノードに対応付け、(node_id, distance) を返す。
+
+        Raises:
+        - SnapDistanceError: max_distance以内にノードがない場合。
+        '''
+        node_ids, distances = self.snap([lat], [lon], max_distance)
+        if not np.isfinite(distances[0]):
+            raise SnapDistanceError(f'({lat}, {lon}) is more than {max_distance} m away from the road network')
+        return node_ids[0].item(), float(distances[0])
+
+
+def get_node_index(place='Toshima, Tokyo, Japan', network_type='walk'):
+    '''キャッシュ済みの道路グラフのノード索引を返す（グラフごとに一度だけ作成）。'''
+    import graph_store
+    return graph_store.get_artifact('node_index', NodeIndex.from_graph, place, network_type)
@@ -0,0 +1,306 @@
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import record_cache
+from routing_engine import EARTH_RADIUS
+
+
+# ホットペッパーグルメAPI
+HOTPEPPER_API_URL = os.getenv('HOTPEPPER_API_URL', 'http://webservice.recruit.co.jp/hotpepper/gourmet/v1/')
+
+# 検索範囲のコードと半径（m）
+RANGE_METERS = {1: 300, 2: 500, 3: 1000, 4: 2000, 5: 3000}
+
+# 1ページの最大件数
+PAGE_SIZE = 100
+
+# タイルキャッシュの設定
+POI_CACHE_DIR = os.getenv('POI_CACHE_DIR', './cache/hotpepper')
+POI_CACHE_TTL = float(os.getenv('POI_CACHE_TTL', '3600'))
+GEOHASH_PRECISION = int(os.getenv('POI_GEOHASH_PRECISION', '6'))
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+### geohash
+def geohash_encode(lat, lng, precision=GEOHASH_PRECISION):
+    '''緯度経度をgeohashに変換する。'''
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < precision:
+        target, value = (lng_range, lng) if even else (lat_range, lat)
+        mid = (target[0] + target[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            target[0] = mid
+        else:
+            target[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits, bit_count = 0, 0
+    return ''.join(chars)
+
+
+def geohash_bbox(geohash):
+    '''geohashのセルの範囲 [西, 南, 東, 北] を返す。'''
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = _BASE32.index(char)
+        for shift in range(4, -1, -1):
+            target = lng_range if even else lat_range
+            mid = (target[0] + target[1]) / 2
+            if (value >> shift) & 1:
+                target[0] = mid
+            else:
+                target[1] = mid
+            even = not even
+    return [lng_range[0], lat_range[0], lng_range[1], lat_range[1]]
+
+
+def geohashes_covering(lat, lng, radius, precision=GEOHASH_PRECISION):
+    '''円（中心と半径m）と重なるgeohashのセルの一覧を返す。'''
+    cell = geohash_bbox(geohash_encode(lat, lng, precision))
+    cell_width, cell_height = cell[2] - cell[0], cell[3] - cell[1]
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    dlng = dlat / math.cos(math.radians(lat))
+
+    cells = set()
+    y = lat - dlat
+    while y <= lat + dlat + cell_height:
+        x = lng - dlng
+        while x <= lng + dlng + cell_width:
+            cells.add(geohash_encode(min(y, lat + dlat), min(x, lng + dlng), precision))
+            x += cell_width
+        y += cell_height
+    return sorted(cells)
+
+
+def distance(lat1, lng1, lat2, lng2):
+    '''2点間のハバーサイン距離（m）。'''
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+### APIクライアント
+class HotPepperClient:
+    '''
+    コネクションを再利用し、全ページを並列に取得するホットペッパーグルメAPIのクライアント。
+
+    Args:
+    - api_key: APIキー。
+    - base_url: APIのURL（ローカルのスタブサーバーにも向けられる）。
+    - timeout: 1リクエストのタイムアウト（秒）。
+    - max_workers: ページを並列に取得するスレッド数。
+    - retries: 接続エラー・5xx・429の再試行回数。
+    - record_dir: 指定した場合、取得したレスポンスをそのまま保存する（スタブサーバーで再生できる）。
+    '''
+
+    def __init__(self, api_key, base_url=HOTPEPPER_API_URL, timeout=10, max_workers=8, retries=3, record_dir=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.record_dir = record_dir
+
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch_page(self, params, start=1):
+        '''1ページ分のレスポンスの results を返す。'''
+        body = dict(params, key=self.api_key, format='json', start=start, count=PAGE_SIZE)
+        response = self.session.get(self.base_url, params=body, timeout=self.timeout)
+        response.raise_for_status()
+        datum = response.json()
+        if 'error' in datum.get('results', {}):
+            raise RuntimeError(datum['results']['error'])
+        if self.record_dir:
+            self._record(params, start, datum)
+        return datum['results']
+
+    def fetch_all(self, lat, lng, range_code, genre=None):
+        '''
+        検索条件に一致する全店舗を返す（100件を超える分も取得する）。
+        1ページ目で総件数を調べ、残りのページは並列に取得する。
+        '''
+        params = {'lat': lat, 'lng': lng, 'range': range_code}
+        if genre:
+            params['genre'] = genre
+
+        first = self.fetch_page(params)
+        shops = list(first.get('shop', []))
+        available = int(first.get('results_available', len(shops)))
+        starts = list(range(1 + PAGE_SIZE, available + 1, PAGE_SIZE))
+        if starts:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for page in executor.map(lambda start: self.fetch_page(params, start), starts):
+                    shops.extend(page.get('shop', []))
+
+        # ページの境界で重複した店舗を取り除く
+        return list({shop['id']: shop for shop in shops}.values())
+
+    def _record(self, params, start, datum):
+        os.makedirs(self.record_dir, exist_ok=True)
+        name = '_'.join(f'{key}-{params[key]}' for key in sorted(params)) + f'_start-{start}.json'
+        with open(os.path.join(self.record_dir, name), 'w') as file:
+            json.dump(datum, file, ensure_ascii=False)
+
+
+### geohashタイルのキャッシュ
+class POITileCache:
+    '''
+    (genre, geohash) ごとに店舗のリストを保持するTTL付きのキャッシュ（メモリとディスク）。
+
+    検索円に完全に含まれたタイルは coverage=None（タイル内の全店舗）として、
+    一部だけ含まれたタイルは取得した円 [lat, lng, radius] とともに登録する。
+    '''
+
+    def __init__(self, cache_dir=POI_CACHE_DIR, ttl=POI_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._tiles = dict()
+        self._lock = threading.Lock()
+
+    def get(self, genre, geohash):
+        '''(店舗のリスト, coverage) を返す。ない場合・期限切れの場合はNone。'''
+        key = (genre or '', geohash)
+        with self._lock:
+            entry = self._tiles.get(key)
+        if entry is None:
+            entry = self._read(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            return None
+        with self._lock:
+            self._tiles[key] = entry
+        return entry[1], entry[2]
+
+    def put(self, genre, geohash, shops, coverage=None):
+        key = (genre or '', geohash)
+        entry = (time.time(), shops, coverage)
+        with self._lock:
+            self._tiles[key] = entry
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._path(key)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as file:
+                json.dump({'fetched_at': entry[0], 'shops': shops, 'coverage': coverage}, file, ensure_ascii=False)
+            os.replace(tmp_path, path)
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key[0] or "all"}_{key[1]}.json')
+
+    def _read(self, key):
+        if not self.cache_dir or not os.path.exists(self._path(key)):
+            return None
+        with open(self._path(key)) as file:
+            data = json.load(file)
+        return data['fetched_at'], data['shops'], data.get('coverage')
+
+
+### 店舗の取得
+class POIFetcher:
+    '''
+    タイルキャッシュを通して半径内の店舗を取得するクラス。
+
+    検索円と重なるタイルがすべてキャッシュで賄えればAPIを呼ばない。
+    足りない場合は検索円を1回（全ページ並列で）取得し、円と重なるタイルを
+    キャッシュに登録する。円に一部だけ含まれるタイルは、取得した円の内側の
+    検索にだけ使う。
+
+    Args:
+    - client: HotPepperClient。
+    - cache: POITileCache。
+    - precision: タイルのgeohashの桁数。
+    '''
+
+    def __init__(self, client, cache=None, precision=GEOHASH_PRECISION):
+        self.client = client
+        self.cache = cache if cache is not None else POITileCache()
+        self.precision = precision
+
+    def shops_within(self, lat, lng, range_code=5, genre=None):
+        '''
+        中心から検索範囲（ホットペッパーの range コード）内の店舗のリストを返す。
+        '''
+        radius = RANGE_METERS[range_code]
+        tiles = geohashes_covering(lat, lng, radius, self.precision)
+
+        cached = [self.cache.get(genre, tile) for tile in tiles]
+        if all(entry is not None and _covers(entry[1], lat, lng, radius) for entry in cached):
+            record_cache('poi_tiles', 'hit')
+            shops = [shop for tile_shops, _ in cached for shop in tile_shops]
+        else:
+            record_cache('poi_tiles', 'miss')
+            shops = self.client.fetch_all(lat, lng, range_code, genre)
+            self._store_tiles(lat, lng, radius, genre, tiles, shops)
+
+        return [shop for shop in shops if distance(lat, lng, float(shop['lat']), float(shop['lng'])) <= radius]
+
+    def _store_tiles(self, lat, lng, radius, genre, tiles, shops):
+        by_tile = {tile: [] for tile in tiles}
+        for shop in shops:
+            tile = geohash_encode(float(shop['lat']), float(shop['lng']), self.precision)
+            if tile in by_tile:
+                by_tile[tile].append(shop)
+
+        for tile, tile_shops in by_tile.items():
+            west, south, east, north = geohash_bbox(tile)
+            corners = [(south, west), (south, east), (north, west), (north, east)]
+            if all(distance(lat, lng, y, x) <= radius for y, x in corners):
+                self.cache.put(genre, tile, tile_shops)
+            else:
+                # 完全なタイルが既にあれば、一部だけのタイルで上書きしない
+                cached = self.cache.get(genre, tile)
+                if cached is None or cached[1] is not None:
+                    self.cache.put(genre, tile, tile_shops, coverage=[lat, lng, radius])
+
+
+def _covers(coverage, lat, lng, radius):
+    '''タイルのキャッシュが検索円の範囲を賄えるかどうか。'''
+    if coverage is None:
+        return True
+    covered_lat, covered_lng, covered_radius = coverage
+    return distance(covered_lat, covered_lng, lat, lng) + radius <= covered_radius + 1e-6
+
+
+# プロセス内で共有するフェッチャー
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_fetcher():
+    '''共有のフェッチャーを返す（セッションとキャッシュをプロセス内で再利用する）。'''
+    global _default
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                load_dotenv()
+                client = HotPepperClient(
+                    api_key=os.getenv('HOTPEPPER_API_KEY'),
+                    base_url=os.getenv('HOTPEPPER_API_URL', HOTPEPPER_API_URL),
+                    record_dir=os.getenv('HOTPEPPER_RECORD_DIR'),
+                )
+                _default = POIFetcher(client)
+    return _default
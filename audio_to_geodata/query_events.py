@@ -0,0 +1,39 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# クエリの実行中に送る途中経過の種類
+# - transcript: 音声認識の途中経過・確定した結果 {'text', 'final'}
+# - function_call: モデルが選んだ関数 {'name', 'args'}
+# - layer: ツールが書き出したレイヤー {'name', 'data'}（セッションのクエリでは {'name', 'etag', 'url'}）
+# - layer_payload: セッションのレイヤーのバイト列 {'name', 'payload'}（Flask APIがレイヤーストアに保存する）
+# （done / error はワーカーのプールが最後に送る）
+EVENT_TYPES = ('transcript', 'function_call', 'layer', 'layer_payload', 'done', 'error')
+
+# 途中経過の受け取り先（contextvarsで保持し、asyncio.to_thread などで実行したツールにも引き継ぐ）
+_callback = ContextVar('query_event_callback', default=None)
+
+
+def emit(event, data=None):
+    '''
+    実行中のクエリの途中経過を送る。受け取り先がなければ何もしない
+    （CLIから実行した場合など）。
+    '''
+    callback = _callback.get()
+    if callback is not None:
+        callback(event, data)
+
+
+def streaming():
+    '''途中経過の受け取り先があるかどうか（ない場合はレイヤーの変換などを省ける）。'''
+    return _callback.get() is not None
+
+
+@contextmanager
+def sink(callback):
+    '''この中で emit された途中経過を callback(event, data) に渡す。'''
+    token = _callback.set(callback)
+    try:
+        yield
+    finally:
+        _callback.reset(token)
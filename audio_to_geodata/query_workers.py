@@ -0,0 +1,238 @@
+import importlib
+import io
+import multiprocessing as mp
+import queue
+import threading
+import time
+import traceback
+from contextlib import redirect_stdout
+
+import query_events
+import timing
+from layer_writer import session_scope
+
+
+# 常駐ワーカーで読み込んでおくスクリプト（モジュール名）
+DEFAULT_SCRIPTS = ('main_string_query', 'main')
+
+# ジョブで呼び出せるスクリプトの関数（run_query はクエリ、run_transcript は文字起こし済みのテキストを受け取る）
+ENTRY_POINTS = ('run_query', 'run_transcript')
+
+
+class QueryTimeoutError(Exception):
+    '''クエリが制限時間内に完了しなかった場合の例外。'''
+
+
+class QueryError(Exception):
+    '''ワーカー内でクエリの実行に失敗した場合の例外。'''
+
+
+### ワーカープロセスの本体
+def _worker_loop(conn, scripts):
+    '''
+    モデルとツールを一度だけ読み込み、パイプ経由でクエリを受け付け続ける関数。
+
+    各スクリプトの init_model() で生成したモデルを保持し、
+    ジョブごとに指定された関数（run_query() など）の戻り値を print した標準出力を返す。
+    （サブプロセスとして起動していた頃の標準出力と同じ内容になる）
+    ストリーミングのジョブでは、実行中に emit された途中経過を ('event', ...) として先に送る。
+    計測した段階（timing）は、結果の直前に ('spans', ...) として送る。
+    '''
+    send_lock = threading.Lock()
+
+    def send_event(event, data):
+        with send_lock:
+            conn.send(('event', (event, data)))
+
+    modules = dict()
+    models = dict()
+    # 読み込みに失敗したスクリプトは、そのスクリプトへのジョブでのみエラーを返す
+    load_errors = dict()
+    for script in scripts:
+        try:
+            modules[script] = importlib.import_module(script)
+            models[script] = modules[script].init_model()
+            # ツールが使う重いモジュールは起動時に読み込み、最初のクエリを待たせない
+            warmup = getattr(modules[script], 'warmup', None)
+            if warmup is not None:
+                warmup()
+        except Exception:
+            load_errors[script] = traceback.format_exc()
+    conn.send(('ready', None))
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+
+        script, entry, query, stream, session = job
+        if script in load_errors:
+            conn.send(('error', load_errors[script]))
+            continue
+        if not hasattr(modules[script], entry):
+            conn.send(('error', f'{script} has no {entry}()'))
+            continue
+
+        stdout = io.StringIO()
+        with timing.collect() as spans:
+            try:
+                with redirect_stdout(stdout), query_events.sink(send_event if stream else None), \
+                        session_scope(session), timing.stage('query', script=script):
+                    print(getattr(modules[script], entry)(models[script], query))
+                result = ('ok', stdout.getvalue())
+            except Exception:
+                result = ('error', traceback.format_exc())
+        with send_lock:
+            conn.send(('spans', [span.to_dict() for span in spans]))
+            conn.send(result)
+
+
+class _Worker:
+    '''ワーカープロセスと親側のパイプの組。'''
+
+    def __init__(self, context, scripts):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_loop, args=(child_conn, scripts), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def wait_ready(self, timeout):
+        '''起動時のモデル読み込みが終わるまで待つ。'''
+        if self.ready:
+            return
+        if not self.conn.poll(timeout):
+            raise QueryTimeoutError('Query worker is still starting up')
+        try:
+            self.conn.recv()
+        except (EOFError, OSError):
+            raise QueryError('Query worker exited unexpectedly') from None
+        self.ready = True
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+### 常駐ワーカーのプール
+class QueryWorkerPool:
+    '''
+    モデル・ツール・データセットを読み込み済みのワーカープロセスを常駐させるプール。
+
+    空いているワーカーをキューで管理し、リクエストごとに1つ取り出してクエリを渡す。
+    制限時間を超えたワーカーは強制終了し、新しいワーカーに入れ替える。
+
+    Args:
+    - size: ワーカー数。
+    - timeout: 1リクエストあたりの制限時間（秒）。
+    - scripts: ワーカーで読み込むスクリプトのモジュール名。
+    '''
+
+    def __init__(self, size=2, timeout=120, scripts=DEFAULT_SCRIPTS):
+        self.size = size
+        self.timeout = timeout
+        self.scripts = tuple(scripts)
+        self._context = mp.get_context('spawn')
+        self._idle = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        for _ in range(size):
+            self._idle.put(_Worker(self._context, self.scripts))
+
+    def run(self, script, query, timeout=None, on_event=None, session=None, entry='run_query'):
+        '''
+        空いているワーカーでスクリプトのクエリを実行し、標準出力を返す。
+        entry はクエリを渡すスクリプトの関数（ENTRY_POINTS のいずれか）。
+
+        on_event を渡すと、実行中の途中経過（query_events）を on_event(event, data) で受け取れる。
+        ワーカーで計測した段階は、呼び出し元で実行中の段階（timing）の子として加える。
+        session を渡すと、ツールのレイヤーはファイルに書かず layer_payload イベントで送られる
+        （on_event で受け取ること）。
+
+        Raises:
+        - QueryTimeoutError: 制限時間内に完了しなかった場合。
+        - QueryError: ワーカー内で例外が発生した場合（トレースバックを含む）、または実行中にワーカーが終了した場合。
+        '''
+        if script not in self.scripts:
+            raise ValueError(f'Unknown script: {script}')
+        if entry not in ENTRY_POINTS:
+            raise ValueError(f'Unknown entry point: {entry}')
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise QueryTimeoutError('No query worker became available')
+
+        try:
+            # 異常終了していたワーカーは入れ替える
+            if not worker.alive():
+                worker.kill()
+                worker = _Worker(self._context, self.scripts)
+
+            worker.wait_ready(max(deadline - time.monotonic(), 0))
+
+            try:
+                try:
+                    worker.conn.send((script, entry, query, on_event is not None, session))
+                except OSError:
+                    raise QueryError('Query worker exited unexpectedly') from None
+                while True:
+                    if not worker.conn.poll(max(deadline - time.monotonic(), 0)):
+                        raise QueryTimeoutError(f'Query timed out after {timeout} seconds')
+                    try:
+                        status, payload = worker.conn.recv()
+                    except (EOFError, OSError):
+                        # 実行中にワーカーが終了した（クラッシュ・メモリ不足など）
+                        raise QueryError('Query worker exited unexpectedly') from None
+                    if status == 'spans':
+                        timing.attach(payload)
+                        continue
+                    if status != 'event':
+                        break
+                    on_event(*payload)
+            except BaseException:
+                # 実行中のワーカー（途中経過の受け取りに失敗した場合も含む）は再利用できないため入れ替える
+                worker.kill()
+                worker = _Worker(self._context, self.scripts)
+                raise
+        finally:
+            self._release(worker)
+
+        if status != 'ok':
+            raise QueryError(payload)
+        return payload
+
+    def _release(self, worker):
+        with self._lock:
+            if self._closed:
+                worker.stop()
+            else:
+                self._idle.put(worker)
+
+    def close(self):
+        '''待機中のワーカーをすべて終了する。'''
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
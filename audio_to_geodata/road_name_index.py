@@ -0,0 +1,82 @@
+from collections import defaultdict
+
+from text_normalize import ngrams, normalize_name
+
+
+### 道路名の転置索引
+class RoadNameIndex:
+    '''
+    道路名の文字2-gramからエッジキー (u, v, key) を引く転置索引。
+
+    索引は道路名（の正規化後の文字列）単位で作るため、エッジ数ではなく
+    道路名の種類数に比例する大きさで済む。
+    リスト型の name 属性を持つエッジは、含まれるすべての名前で登録する。
+    道路名は末尾の「通り」を残したまま登録し、表記ゆれは検索側で吸収する。
+    '''
+
+    def __init__(self):
+        self._names = list()                   # 正規化した道路名
+        self._edges = list()                   # 道路名ごとのエッジキーのリスト
+        self._postings = defaultdict(set)      # 2-gram -> 道路名ID の集合
+
+    @classmethod
+    def from_graph(cls, G):
+        '''グラフのエッジから索引を作成する。'''
+        index = cls()
+        name_ids = dict()
+        for u, v, k, name in G.edges(keys=True, data='name'):
+            names = name if isinstance(name, list) else [name]
+            for raw_name in names:
+                normalized = normalize_name(raw_name)
+                if not normalized:
+                    continue
+                name_id = name_ids.get(normalized)
+                if name_id is None:
+                    name_id = name_ids[normalized] = index._add_name(normalized)
+                index._edges[name_id].append((u, v, k))
+        return index
+
+    def _add_name(self, normalized):
+        name_id = len(self._names)
+        self._names.append(normalized)
+        self._edges.append(list())
+        for gram in ngrams(normalized) | set(normalized):
+            self._postings[gram].add(name_id)
+        return name_id
+
+    def lookup(self, road_name):
+        '''
+        道路名を部分一致で検索し、一致したエッジキーのリストを返す。
+
+        表記ゆれ（全角/半角、カタカナ/ひらがな、末尾の「通り」）は無視して照合する。
+        「通り」を取り除くと1文字になるクエリ（「大通り」など）は、取り除かずに照合する。
+        '''
+        # 「明治通」で「明治通り」も引けるよう、「通り」を取り除いたクエリでも照合する
+        queries = dict.fromkeys(filter(None, [normalize_name(road_name),
+                                              normalize_name(road_name, strip_road_suffix=True)]))
+        name_ids = set()
+        for query in queries:
+            name_ids |= self._match(query)
+
+        # 複数の名前を持つエッジが重複しないよう、順序を保って一意にする
+        edges = dict()
+        for name_id in sorted(name_ids):
+            edges.update(dict.fromkeys(self._edges[name_id]))
+        return list(edges)
+
+    def _match(self, query):
+        '''正規化したクエリを部分文字列に含む道路名IDの集合を返す。'''
+        # 2-gramの転置リストの積で候補を絞り、最後に部分文字列で確認する
+        grams = sorted(ngrams(query), key=lambda gram: len(self._postings.get(gram, ())))
+        candidates = None
+        for gram in grams:
+            postings = self._postings.get(gram)
+            if not postings:
+                return set()
+            candidates = set(postings) if candidates is None else candidates & postings
+            if not candidates:
+                return set()
+        return {name_id for name_id in candidates if query in self._names[name_id]}
+
+    def __len__(self):
+        return len(self._names)
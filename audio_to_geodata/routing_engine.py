@@ -0,0 +1,186 @@
+import heapq
+import math
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+
+# 地球の半径（m）
+EARTH_RADIUS = 6371008.8
+
+
+class NoRouteError(Exception):
+    '''2点間に経路が存在しない場合の例外。'''
+
+
+### 経路探索エンジン
+class RoutingEngine:
+    '''
+    道路グラフをCSR形式の隣接配列に変換して保持する経路探索エンジン。
+
+    - route(): 1対1の最短経路（ハバーサイン距離をヒューリスティックにしたA*）
+    - one_to_many(): 1対多の最短距離
+    - many_to_many(): 多対多の距離行列
+
+    多重エッジは重みが最小のものだけを残す。重みはA*のヒューリスティックと
+    比較するため、メートル単位の長さ（osmnxの length）を前提とする。
+    距離行列はscipyのDijkstra（C実装）で計算する。
+
+    Args:
+    - node_ids: ノードのosmidの配列。
+    - lats, lons: ノードの緯度・経度の配列。
+    - indptr, indices, weights, edge_keys: CSR形式の隣接配列と、各エッジの重み・キー。
+    '''
+
+    def __init__(self, node_ids, lats, lons, indptr, indices, weights, edge_keys):
+        self.node_ids = np.asarray(node_ids)
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=float)
+        self.edge_keys = np.asarray(edge_keys)
+        self._node_ids = self.node_ids.tolist()
+        self._edge_keys = self.edge_keys.tolist()
+        self._position = {node_id: i for i, node_id in enumerate(self._node_ids)}
+
+        n = len(self.node_ids)
+        self.matrix = csr_matrix((self.weights, self.indices, self.indptr), shape=(n, n))
+
+        # A*はPythonのループで回すため、リストにしておく（numpyの要素アクセスは遅い）
+        self._indptr = self.indptr.tolist()
+        self._indices = self.indices.tolist()
+        self._weights = self.weights.tolist()
+        self._lat_rad = np.radians(self.lats).tolist()
+        self._lon_rad = np.radians(self.lons).tolist()
+        self._cos_lat = np.cos(np.radians(self.lats)).tolist()
+
+    @classmethod
+    def from_graph(cls, G, weight='length'):
+        '''osmnxのMultiDiGraphからエンジンを作成する。'''
+        node_ids = np.array(list(G.nodes))
+        position = {node_id: i for i, node_id in enumerate(node_ids.tolist())}
+        lats = np.array([data['y'] for _, data in G.nodes(data=True)], dtype=float)
+        lons = np.array([data['x'] for _, data in G.nodes(data=True)], dtype=float)
+
+        edges = list(G.edges(keys=True, data=weight, default=1.0))
+        us = np.array([position[u] for u, _, _, _ in edges], dtype=np.int64)
+        vs = np.array([position[v] for _, v, _, _ in edges], dtype=np.int64)
+        ws = np.array([w for _, _, _, w in edges], dtype=float)
+        keys = np.array([k for _, _, k, _ in edges])
+
+        # (u, v, 重み) の順に並べ、同じ (u, v) の中で最小の重みのエッジだけを残す
+        order = np.lexsort((ws, vs, us))
+        us, vs, ws, keys = us[order], vs[order], ws[order], keys[order]
+        first = np.ones(len(us), dtype=bool)
+        first[1:] = (us[1:] != us[:-1]) | (vs[1:] != vs[:-1])
+        us, vs, ws, keys = us[first], vs[first], ws[first], keys[first]
+
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(us, minlength=len(node_ids)), out=indptr[1:])
+        return cls(node_ids, lats, lons, indptr, vs, ws, keys)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def positions(self, node_ids):
+        '''osmidの並びを内部の行番号の配列に変換する。'''
+        try:
+            return np.array([self._position[node_id] for node_id in node_ids], dtype=np.int64)
+        except KeyError as e:
+            raise KeyError(f'Node {e.args[0]} is not in the graph')
+
+    def route(self, source, target):
+        '''
+        2ノード間の最短経路をA*で探索し、osmidのリストを返す。
+
+        Raises:
+        - NoRouteError: 経路が存在しない場合。
+        '''
+        s, t = self.positions([source, target]).tolist()
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+        heuristic = self._heuristic_to(t)
+
+        best = {s: 0.0}
+        previous = {s: -1}
+        closed = set()
+        heap = [(heuristic(s), 0.0, s)]
+        while heap:
+            _, dist, node = heapq.heappop(heap)
+            if node == t:
+                return self._path(previous, t)
+            if node in closed:
+                continue
+            closed.add(node)
+            for i in range(indptr[node], indptr[node + 1]):
+                neighbor = indices[i]
+                candidate = dist + weights[i]
+                if candidate < best.get(neighbor, math.inf):
+                    best[neighbor] = candidate
+                    previous[neighbor] = node
+                    heapq.heappush(heap, (candidate + heuristic(neighbor), candidate, neighbor))
+
+        raise NoRouteError(f'No route between {source} and {target}')
+
+    def route_length(self, path):
+        '''経路（osmidのリスト）の長さを返す。'''
+        return float(sum(self.weights[i] for i in self._edge_positions(path)))
+
+    def route_edges(self, path):
+        '''経路（osmidのリスト）を構成するエッジ (u, v, key) のリストを返す。'''
+        keys = self._edge_keys
+        return [(u, v, keys[i]) for (u, v), i in zip(zip(path[:-1], path[1:]), self._edge_positions(path))]
+
+    def one_to_many(self, source, targets):
+        '''1つの始点から複数の終点までの最短距離の配列を返す（到達不能はinf）。'''
+        return self.many_to_many([source], targets)[0]
+
+    def many_to_many(self, sources, targets):
+        '''
+        始点×終点の最短距離行列を返す（到達不能はinf）。
+
+        Returns:
+        - shape (len(sources), len(targets)) の配列。
+        '''
+        source_positions = self.positions(sources)
+        target_positions = self.positions(targets)
+        unique_sources, inverse = np.unique(source_positions, return_inverse=True)
+        distances = dijkstra(self.matrix, directed=True, indices=unique_sources)
+        return distances[np.ix_(inverse, target_positions)]
+
+    def _heuristic_to(self, target):
+        '''ノードから終点までのハバーサイン距離を返す関数を作る。'''
+        lat_rad, lon_rad, cos_lat = self._lat_rad, self._lon_rad, self._cos_lat
+        target_lat, target_lon, target_cos = lat_rad[target], lon_rad[target], cos_lat[target]
+
+        def heuristic(node):
+            a = (math.sin((lat_rad[node] - target_lat) / 2) ** 2
+                 + cos_lat[node] * target_cos * math.sin((lon_rad[node] - target_lon) / 2) ** 2)
+            return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+        return heuristic
+
+    def _path(self, previous, target):
+        path = []
+        node = target
+        while node != -1:
+            path.append(node)
+            node = previous[node]
+        return [self._node_ids[i] for i in reversed(path)]
+
+    def _edge_positions(self, path):
+        '''経路の各区間に対応するCSR上のエッジ位置を返す。'''
+        positions = self.positions(path).tolist()
+        edge_positions = []
+        for u, v in zip(positions[:-1], positions[1:]):
+            start, end = self._indptr[u], self._indptr[u + 1]
+            offset = self._indices[start:end].index(v)
+            edge_positions.append(start + offset)
+        return edge_positions
+
+
+def get_engine(place='Toshima, Tokyo, Japan', network_type='walk'):
+    '''キャッシュ済みの道路グラフから作ったエンジンを返す（グラフごとに一度だけ作成）。'''
+    import graph_store
+    return graph_store.get_artifact('routing_engine', RoutingEngine.from_graph, place, network_type)
@@ -0,0 +1,213 @@
+import argparse
+import os
+
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from node_index import MAX_SNAP_DISTANCE
+
+
+# 避難所の一覧（CSV。国土地理院の指定緊急避難場所データなど）
+SHELTER_PATH = os.getenv('SHELTER_PATH', './data/shelters.csv')
+
+# 避難所を割り当てる道路ネットワークの対象地域
+SHELTER_PLACE = os.getenv('SHELTER_PLACE', 'Toshima, Tokyo, Japan')
+
+# 割り当て範囲のポリゴン（凹包）の細かさ（0〜1、小さいほど凹凸を残す）
+SHELTER_HULL_RATIO = float(os.getenv('SHELTER_HULL_RATIO', '0.3'))
+
+# CSVの列名の候補（英語の列名と、指定緊急避難場所データの列名）
+COLUMN_ALIASES = {
+    'id': ('id', 'shelter_id', '共通ID', 'NO', '番号'),
+    'name': ('name', '施設・場所名', '名称', '施設名'),
+    'lat': ('lat', 'latitude', '緯度'),
+    'lon': ('lon', 'lng', 'longitude', '経度'),
+}
+
+
+def load_shelters(path=SHELTER_PATH):
+    '''
+    避難所の一覧を読み、id, name, lat, lon の列を持つDataFrameを返す。
+
+    Raises:
+    - ValueError: 必要な列（緯度・経度）が見つからない場合。
+    '''
+    import pandas as pd
+
+    try:
+        frame = pd.read_csv(path, encoding='utf-8-sig')
+    except UnicodeDecodeError:
+        frame = pd.read_csv(path, encoding='cp932')
+
+    columns = dict()
+    for column, aliases in COLUMN_ALIASES.items():
+        found = next((alias for alias in aliases if alias in frame.columns), None)
+        if found is not None:
+            columns[found] = column
+    if 'lat' not in columns.values() or 'lon' not in columns.values():
+        raise ValueError(f'Shelter list needs latitude and longitude columns: {path}')
+
+    shelters = frame.rename(columns=columns)
+    if 'id' not in shelters:
+        shelters['id'] = np.arange(len(shelters))
+    if 'name' not in shelters:
+        shelters['name'] = shelters['id'].astype(str)
+    shelters = shelters[['id', 'name', 'lat', 'lon']].dropna(subset=['lat', 'lon'])
+    return shelters.reset_index(drop=True)
+
+
+### 避難所の割り当て
+class ShelterAnalysis:
+    '''
+    道路ネットワークの全ノードを、歩いて最も近い避難所に割り当てた結果。
+
+    避難所ごとに仮想のノード（避難所の最寄りノードまでの直線距離の辺を持つ）を加え、
+    辺の向きを逆にしたグラフで仮想ノードのすべてから1回のDijkstra（scipy、C実装）を行う。
+    各ノードの「最寄りの避難所までの距離」と「その避難所」が一度に求まるため、
+    建物ごとに最短経路を探索する必要がない。
+
+    Args:
+    - engine: routing_engine.RoutingEngine（CSR形式の道路グラフ）。
+    - nodes: node_index.NodeIndex（最寄りノードの索引）。
+    - shelters: load_shelters() の結果。
+    - max_snap_distance: 道路からこれより離れた避難所・建物は割り当てない（m）。
+    '''
+
+    def __init__(self, engine, nodes, shelters, max_snap_distance=MAX_SNAP_DISTANCE):
+        self.engine = engine
+        self.nodes = nodes
+        self.shelters = shelters.reset_index(drop=True)
+        self.max_snap_distance = max_snap_distance
+        self.node_distance, self.node_shelter = self._assign_nodes()
+
+    def _assign_nodes(self):
+        n = len(self.engine)
+        node_ids, snap_distances = self.nodes.snap(self.shelters['lat'], self.shelters['lon'], self.max_snap_distance)
+        snapped = np.flatnonzero(np.isfinite(snap_distances))
+        if len(snapped) == 0:
+            return np.full(n, np.inf), np.full(n, -1, dtype=np.int64)
+
+        # 逆向きのグラフ（建物→避難所の距離を避難所側から求める）に仮想ノードを加える
+        # 距離0の辺は疎行列では辺にならないため、わずかな長さにする
+        reverse = self.engine.matrix.T.tocoo()
+        virtual = n + np.arange(len(snapped))
+        rows = np.concatenate([reverse.row, virtual])
+        cols = np.concatenate([reverse.col, self.engine.positions(node_ids[snapped].tolist())])
+        weights = np.concatenate([reverse.data, np.maximum(snap_distances[snapped], 1e-6)])
+        size = n + len(snapped)
+        graph = coo_matrix((weights, (rows, cols)), shape=(size, size)).tocsr()
+
+        distances, _, sources = dijkstra(graph, directed=True, indices=virtual, min_only=True,
+                                         return_predecessors=True)
+        reached = sources[:n] >= 0
+        node_shelter = np.full(n, -1, dtype=np.int64)
+        node_shelter[reached] = snapped[sources[:n][reached] - n]
+        return distances[:n], node_shelter
+
+    def assign_points(self, lats, lons):
+        '''
+        各地点を最寄りノード経由で避難所に割り当て、(避難所の行番号, 距離 m) の配列を返す。
+        割り当てられない地点（道路から遠い・到達できない）は -1 と inf。
+        距離は地点から最寄りノードまでの直線距離を含む。
+        '''
+        node_ids, snap_distances = self.nodes.snap(lats, lons, self.max_snap_distance)
+        shelter = np.full(len(node_ids), -1, dtype=np.int64)
+        distance = np.full(len(node_ids), np.inf)
+        found = np.flatnonzero(np.isfinite(snap_distances))
+        if len(found):
+            positions = self.engine.positions(node_ids[found].tolist())
+            shelter[found] = self.node_shelter[positions]
+            distance[found] = self.node_distance[positions] + snap_distances[found]
+            distance[shelter < 0] = np.inf
+        return shelter, distance
+
+    def assign_buildings(self, buildings):
+        '''
+        建物のGeoDataFrameに、最寄りの避難所（shelter_id, shelter_name）と歩行距離（shelter_distance, m）の列を加えて返す。
+        '''
+        points = shapely.point_on_surface(buildings.geometry.values)
+        shelter, distance = self.assign_points(shapely.get_y(points), shapely.get_x(points))
+        result = buildings.copy()
+        assigned = shelter >= 0
+        result['shelter_id'] = np.where(assigned, self.shelters['id'].to_numpy()[np.maximum(shelter, 0)], None)
+        result['shelter_name'] = np.where(assigned, self.shelters['name'].to_numpy()[np.maximum(shelter, 0)], None)
+        result['shelter_distance'] = np.where(assigned, distance, np.nan)
+        return result
+
+    def catchments(self, ratio=SHELTER_HULL_RATIO):
+        '''
+        避難所ごとの割り当て範囲（割り当てられたノードの凹包）のGeoDataFrame。
+        列は shelter_id, name, nodes（ノード数）, max_distance（m）。凹包どうしは重なることがある。
+        '''
+        import geopandas as gpd
+
+        reached = np.flatnonzero(self.node_shelter >= 0)
+        order = reached[np.argsort(self.node_shelter[reached], kind='stable')]
+        groups, starts, counts = np.unique(self.node_shelter[order], return_index=True, return_counts=True)
+        coords = np.column_stack([self.engine.lons[order], self.engine.lats[order]])
+        multipoints = shapely.multipoints(coords, indices=np.repeat(np.arange(len(groups)), counts))
+        hulls = shapely.concave_hull(multipoints, ratio=ratio)
+        # ノードが少ない避難所は点・線になるため、わずかに太らせる
+        degenerate = shapely.get_type_id(hulls) != shapely.GeometryType.POLYGON
+        hulls[degenerate] = shapely.buffer(hulls[degenerate], 0.0002)
+
+        max_distance = np.maximum.reduceat(self.node_distance[order], starts) if len(order) else []
+        return gpd.GeoDataFrame({
+            'shelter_id': self.shelters['id'].to_numpy()[groups],
+            'name': self.shelters['name'].to_numpy()[groups],
+            'nodes': counts,
+            'max_distance': max_distance,
+        }, geometry=hulls, crs='EPSG:4326')
+
+    def shelter_points(self):
+        '''避難所の点（shelter_id, name, nodes）のGeoDataFrame。'''
+        import geopandas as gpd
+
+        counts = np.bincount(self.node_shelter[self.node_shelter >= 0], minlength=len(self.shelters))
+        return gpd.GeoDataFrame({
+            'shelter_id': self.shelters['id'].to_numpy(),
+            'name': self.shelters['name'].to_numpy(),
+            'nodes': counts,
+        }, geometry=shapely.points(self.shelters['lon'], self.shelters['lat']), crs='EPSG:4326')
+
+    def bbox(self):
+        '''道路ネットワークの範囲 [西, 南, 東, 北]。'''
+        return [float(self.engine.lons.min()), float(self.engine.lats.min()),
+                float(self.engine.lons.max()), float(self.engine.lats.max())]
+
+
+def available(path=SHELTER_PATH):
+    '''避難所の一覧があるかどうか。'''
+    return os.path.exists(path)
+
+
+def get_analysis(place=SHELTER_PLACE, network_type='walk', path=SHELTER_PATH):
+    '''
+    キャッシュ済みの道路グラフに避難所を割り当てた結果を返す（グラフと避難所の一覧ごとに一度だけ作成）。
+    一覧の更新時刻をキーに含めるため、一覧を編集すると次の呼び出しで作り直す。
+    '''
+    import graph_store
+    import node_index
+    import routing_engine
+
+    def build(graph):
+        return ShelterAnalysis(routing_engine.get_engine(place, network_type),
+                               node_index.get_node_index(place, network_type), load_shelters(path))
+
+    key = f'shelter_analysis:{os.path.abspath(path)}:{os.stat(path).st_mtime_ns}'
+    return graph_store.get_artifact(key, build, place, network_type)
+
+
+if __name__ == '__main__':
+    # python shelter_analysis.py --shelters data/shelters.csv
+    parser = argparse.ArgumentParser(description='道路ネットワークの全ノードを歩いて最も近い避難所に割り当てる')
+    parser.add_argument('--shelters', default=SHELTER_PATH)
+    parser.add_argument('--place', default=SHELTER_PLACE)
+    args = parser.parse_args()
+
+    analysis = get_analysis(args.place, 'walk', args.shelters)
+    reached = np.isfinite(analysis.node_distance)
+    print(f'{len(analysis.shelters):,} shelters, {reached.sum():,} / {len(reached):,} nodes assigned, '
+          f'median {np.median(analysis.node_distance[reached]):.0f} m, max {analysis.node_distance[reached].max():.0f} m')
@@ -0,0 +1,288 @@
+import hashlib
+import os
+import subprocess
+import threading
+import time
+from contextlib import closing
+from typing import NamedTuple
+
+import query_events
+from timing import stage
+
+
+# 認識器（google: Cloud Speech-to-Textのストリーミング認識、fake: ローカルでテストするための認識器）
+ASR_RECOGNIZER = os.getenv('ASR_RECOGNIZER', 'google')
+ASR_LANGUAGE = os.getenv('ASR_LANGUAGE', 'ja-JP')
+
+# 認識器に送る音声（LINEAR16・モノラル）のサンプリングレートと1チャンクの長さ（ミリ秒）
+ASR_SAMPLE_RATE = int(os.getenv('ASR_SAMPLE_RATE', '16000'))
+ASR_CHUNK_MS = int(os.getenv('ASR_CHUNK_MS', '100'))
+
+# fake の認識器が返す文字起こし
+ASR_FAKE_TRANSCRIPT = os.getenv('ASR_FAKE_TRANSCRIPT', '浸水深を表示してください')
+
+# fake の認識器が録音ごとに選ぶ文字起こしの候補（'|' 区切り。空なら ASR_FAKE_TRANSCRIPT だけを返す）
+ASR_FAKE_TRANSCRIPTS = [text for text in os.getenv('ASR_FAKE_TRANSCRIPTS', '').split('|') if text]
+
+# fake の認識器がチャンクごとにかける処理時間（秒）
+ASR_FAKE_LATENCY = float(os.getenv('ASR_FAKE_LATENCY', '0'))
+
+FFMPEG_PATH = os.getenv('FFMPEG_PATH', 'ffmpeg')
+
+# 認識しやすくする語句（地名など）
+ASR_PHRASES = ['サンシャインシティ', 'サンシャイン通り', '東京駅']
+
+# 音声の入力を読む単位（バイト）
+READ_SIZE = 64 * 1024
+
+
+class Transcript(NamedTuple):
+    '''認識の途中経過（is_final=False）または確定した文字起こし（is_final=True）。'''
+    text: str
+    is_final: bool
+    stability: float = 0.0
+
+
+def iter_source(source, read_size=READ_SIZE):
+    '''
+    音声の入力をバイト列のチャンクにして返す。
+
+    Args:
+    - source: ファイルのパス、bytes、read() を持つファイルオブジェクト、またはbytesのイテラブル
+      （アップロード中のリクエストのボディなど）。
+    '''
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield bytes(source)
+    elif isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as file:
+            yield from iter(lambda: file.read(read_size), b'')
+    elif hasattr(source, 'read'):
+        yield from iter(lambda: source.read(read_size), b'')
+    else:
+        for chunk in source:
+            if chunk:
+                yield chunk
+
+
+### 音声のデコード
+class PCMStream:
+    '''
+    ffmpegで音声を LINEAR16・モノラル・sample_rate Hz に変換しながら、chunk_ms ごとのチャンクを返す。
+
+    入力は別スレッドでffmpegに書き込むため、入力の到着・デコード・認識が並行して進む。
+    ファイルのパスはffmpegに直接渡す（.m4a のように末尾にメタデータがある形式はパイプでは読めないため）。
+    close() はどのスレッドから呼んでもよく、ffmpegを止めて反復を終わらせる。
+    '''
+
+    def __init__(self, source, sample_rate=ASR_SAMPLE_RATE, chunk_ms=ASR_CHUNK_MS):
+        self.chunk_bytes = sample_rate * 2 * chunk_ms // 1000
+        self._closed = False
+        self._stderr = b''
+        path = os.fspath(source) if isinstance(source, (str, os.PathLike)) else None
+        command = [FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-i', path or 'pipe:0',
+                   '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(sample_rate), 'pipe:1']
+        self._process = subprocess.Popen(command, stdin=subprocess.DEVNULL if path else subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._threads = [threading.Thread(target=self._read_stderr, daemon=True)]
+        if path is None:
+            self._threads.append(threading.Thread(target=self._feed, args=(source,), daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _feed(self, source):
+        try:
+            for chunk in iter_source(source):
+                if self._closed:
+                    break
+                self._process.stdin.write(chunk)
+        except (BrokenPipeError, ValueError, OSError):
+            # ffmpegが先に終了した場合（close() された場合・入力が壊れている場合）
+            pass
+        finally:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+
+    def _read_stderr(self):
+        self._stderr = self._process.stderr.read()
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self._process.stdout.read(self.chunk_bytes)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self._process.stdout.close()
+            returncode = self._process.wait()
+            for thread in self._threads:
+                thread.join()
+        if returncode != 0 and not self._closed:
+            raise RuntimeError(f"ffmpeg failed: {self._stderr.decode('utf-8', 'replace').strip()}")
+
+    def close(self):
+        self._closed = True
+        if self._process.poll() is None:
+            self._process.kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+### 認識器
+class GoogleStreamingRecognizer:
+    '''
+    Cloud Speech-to-Textのストリーミング認識。
+    チャンクを受け取るたびに送り、途中経過（interim）と確定した文字起こし（final）を返す。
+    '''
+
+    def __init__(self, language=ASR_LANGUAGE, sample_rate=ASR_SAMPLE_RATE, phrases=None, client=None):
+        self.language = language
+        self.sample_rate = sample_rate
+        self.phrases = ASR_PHRASES if phrases is None else phrases
+        self._client = client
+
+    def stream(self, chunks):
+        from google.cloud import speech
+
+        if self._client is None:
+            self._client = speech.SpeechClient()
+        config = speech.StreamingRecognitionConfig(
+            config=speech.RecognitionConfig(
+                encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+                sample_rate_hertz=self.sample_rate,
+                language_code=self.language,
+                enable_automatic_punctuation=True,
+                speech_contexts=[speech.SpeechContext(phrases=self.phrases)] if self.phrases else None,
+            ),
+            interim_results=True,
+        )
+        requests = (speech.StreamingRecognizeRequest(audio_content=chunk) for chunk in chunks)
+        responses = self._client.streaming_recognize(config=config, requests=requests)
+        try:
+            for response in responses:
+                for result in response.results:
+                    if result.alternatives:
+                        yield Transcript(result.alternatives[0].transcript, result.is_final, result.stability)
+        finally:
+            # 確定した時点で呼び出し側が止めた場合は、残りの音声を送らずにストリームを閉じる
+            cancel = getattr(responses, 'cancel', None)
+            if cancel is not None:
+                cancel()
+
+
+class FakeRecognizer:
+    '''
+    ローカルでテストするための認識器。
+
+    受け取った音声の長さに応じて transcript の先頭から途中経過を返し、
+    final_after_ms ミリ秒分の音声を受け取った時点（Noneなら音声の終わり）で確定した文字起こしを返す。
+    transcripts を渡すと、最初のチャンクのハッシュで候補から1つを選ぶ（同じ録音には毎回同じ文字起こし）。
+
+    Args:
+    - transcript: 返す文字起こし（transcripts が空の場合）。
+    - final_after_ms: 確定させる音声の長さ（ミリ秒）。
+    - latency: チャンクごとの処理時間（秒）。
+    - ms_per_char: 途中経過で1文字進める音声の長さ（ミリ秒）。
+    - transcripts: 録音ごとに選ぶ文字起こしの候補。
+    '''
+
+    def __init__(self, transcript=ASR_FAKE_TRANSCRIPT, final_after_ms=None, latency=ASR_FAKE_LATENCY, ms_per_char=150,
+                 sample_rate=ASR_SAMPLE_RATE, transcripts=ASR_FAKE_TRANSCRIPTS):
+        self.transcript = transcript
+        self.final_after_ms = final_after_ms
+        self.latency = latency
+        self.ms_per_char = ms_per_char
+        self.sample_rate = sample_rate
+        self.transcripts = list(transcripts)
+
+    def pick(self, chunk):
+        '''録音の最初のチャンクから、返す文字起こしを決める。'''
+        if not self.transcripts:
+            return self.transcript
+        digest = hashlib.sha1(chunk).digest()
+        return self.transcripts[int.from_bytes(digest[:4], 'big') % len(self.transcripts)]
+
+    def stream(self, chunks):
+        received = 0
+        shown = 0
+        transcript = self.transcript
+        for chunk in chunks:
+            if not received:
+                transcript = self.pick(chunk)
+            received += len(chunk)
+            if self.latency:
+                time.sleep(self.latency)
+            elapsed_ms = received / (self.sample_rate * 2) * 1000
+            if self.final_after_ms is not None and elapsed_ms >= self.final_after_ms:
+                break
+            length = min(len(transcript), int(elapsed_ms / self.ms_per_char))
+            if length > shown:
+                shown = length
+                yield Transcript(transcript[:length], False, 0.5)
+        yield Transcript(transcript, True, 1.0)
+
+
+RECOGNIZERS = {
+    'google': GoogleStreamingRecognizer,
+    'fake': FakeRecognizer,
+}
+
+# プロセス内で共有する認識器（SpeechClientの作成を1回にする）
+_recognizers = dict()
+_recognizers_lock = threading.Lock()
+
+
+def get_recognizer(name=None):
+    '''名前（省略時は ASR_RECOGNIZER）の認識器を返す。'''
+    name = name or ASR_RECOGNIZER
+    if name not in RECOGNIZERS:
+        raise ValueError(f'Unknown recognizer: {name}')
+    with _recognizers_lock:
+        if name not in _recognizers:
+            _recognizers[name] = RECOGNIZERS[name]()
+        return _recognizers[name]
+
+
+### ストリーミングの文字起こし
+def stream_transcripts(source, recognizer=None, decode=True):
+    '''
+    音声を受け取りながら認識し、途中経過と確定した文字起こしを順に返す。
+
+    Args:
+    - source: 音声の入力（iter_source を参照）。
+    - recognizer: 認識器。省略時は get_recognizer()。
+    - decode: ffmpegで変換するかどうか。False なら source は LINEAR16 の音声とみなす。
+    '''
+    recognizer = recognizer or get_recognizer()
+    pcm = PCMStream(source) if decode else None
+    results = recognizer.stream(pcm if decode else iter_source(source))
+    try:
+        yield from results
+    finally:
+        results.close()
+        if pcm is not None:
+            pcm.close()
+
+
+def transcribe_stream(source, recognizer=None, decode=True):
+    '''
+    音声を受け取りながら認識し、最初に確定した文字起こしを返す。
+
+    確定した時点で残りの音声を待たずに返すため、呼び出し側はすぐに関数呼び出しの生成を始められる。
+    途中経過と確定した文字起こしは transcript イベント（{'text', 'final'}）として送る。
+
+    Returns:
+    - 確定した文字起こし。認識できなかった場合は空文字列。
+    '''
+    with stage('transcription'), closing(stream_transcripts(source, recognizer, decode)) as results:
+        for result in results:
+            query_events.emit('transcript', {'text': result.text, 'final': result.is_final})
+            if result.is_final and result.text.strip():
+                return result.text
+    return ''
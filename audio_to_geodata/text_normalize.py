@@ -0,0 +1,53 @@
+import re
+import unicodedata
+
+
+# カタカナ（ァ〜ヶ）とひらがな（ぁ〜ゖ）のコードポイントの差
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord('ァ'), ord('ヶ') + 1)}
+
+# 小書き仮名（音声認識で大書きと揺れやすい）
+_SMALL_KANA = str.maketrans('ぁぃぅぇぉっゃゅょゎ', 'あいうえおつやゆよわ')
+
+# 照合時に無視する記号・空白（長音記号は表記ゆれが多いため無視する）
+_IGNORED_CHARS = re.compile(r'[\s・･\-‐－ー―~〜,、.。()（）「」『』\'"]')
+
+# 道路名の末尾の「通り」
+_ROAD_SUFFIX = re.compile(r'(通り|通|どおり|とおり)$')
+
+# 「通り」を取り除いた後に残す最小の文字数（「大通り」が「大」にならないようにする）
+_MIN_STRIPPED_LENGTH = 2
+
+
+def normalize_name(text, strip_road_suffix=False):
+    '''
+    地名・道路名・建物名を照合用に正規化する関数。
+
+    - 全角/半角の英数字・カタカナを統一する（NFKC）
+    - カタカナをひらがなに変換し、小書き仮名を大書きにする
+    - 英字を小文字にし、空白や中黒などの記号を取り除く
+    - strip_road_suffix=True の場合は末尾の「通り」を取り除く（2文字以上残る場合のみ）
+
+    Args:
+    - text: 正規化する文字列。
+    - strip_road_suffix: 末尾の「通り」を取り除くかどうか。
+
+    Returns:
+    - 正規化した文字列。
+    '''
+    if not isinstance(text, str):
+        return ''
+    text = unicodedata.normalize('NFKC', text)
+    text = text.translate(_KATAKANA_TO_HIRAGANA).translate(_SMALL_KANA).lower()
+    text = _IGNORED_CHARS.sub('', text)
+    if strip_road_suffix:
+        stripped = _ROAD_SUFFIX.sub('', text)
+        if len(stripped) >= _MIN_STRIPPED_LENGTH:
+            text = stripped
+    return text
+
+
+def ngrams(text, n=2):
+    '''文字n-gramの集合を返す。nより短い文字列はそのまま1要素とする。'''
+    if len(text) < n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
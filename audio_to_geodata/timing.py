@@ -0,0 +1,188 @@
+import functools
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# パイプラインの段階の名前
+# - request: Flask APIの1リクエスト（最上位の段階）
+# - upload: アップロードされた音声の受け取り
+# - transcription: 音声認識
+# - query: 常駐ワーカーでのクエリの実行
+# - model_call: 関数呼び出しの生成（キャッシュを含む。モデルを呼んだ場合は子に llm を持つ）
+# - tool: ツールの実行
+# - load: グラフ・建物・POIなどのデータの取得
+# - compute: 経路探索・空間結合などの計算
+# - serialize: GeoJSON・LineLayer用データ・バイナリへの変換
+# - write: レイヤーの書き出し
+STAGES = ('request', 'upload', 'transcription', 'query', 'model_call', 'llm', 'tool',
+          'load', 'compute', 'serialize', 'write')
+
+
+class Span:
+    '''
+    1つの段階の計測結果（経過時間とメモリのピーク）。
+
+    labels は親の段階のラベル（tool など）を引き継ぐ。
+    peak_memory は tracemalloc で計測中の場合のみ、段階の開始時からの増分のピーク（バイト）。
+    events は段階の中で記録した出来事（キャッシュの命中など）の (名前, ラベル) のリスト。
+    '''
+
+    def __init__(self, name, labels, parent=None):
+        self.name = name
+        self.labels = labels
+        self.parent = parent
+        self.children = []
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = False
+        self.peak_memory = None
+        self.events = []
+        self._memory_base = None
+        self._memory_peak = 0
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'labels': self.labels,
+            'duration': self.duration,
+            'error': self.error,
+            'peak_memory': self.peak_memory,
+            'events': [[name, labels] for name, labels in self.events],
+            'children': [child.to_dict() for child in self.children],
+        }
+
+    @classmethod
+    def from_dict(cls, data, parent=None):
+        '''to_dict() の結果（ワーカープロセスから送られた段階など）から段階を作り直す。'''
+        span = cls(data['name'], dict(data['labels']), parent)
+        span.duration = data['duration']
+        span.error = data.get('error', False)
+        span.peak_memory = data.get('peak_memory')
+        span.events = [(name, dict(labels)) for name, labels in data.get('events', [])]
+        span.children = [cls.from_dict(child, span) for child in data.get('children', [])]
+        return span
+
+    def format(self, indent=0):
+        '''段階の木を1行に1段階ずつ字下げした文字列にする（遅いリクエストのログ用）。'''
+        labels = ' '.join(f'{key}={value}' for key, value in self.labels.items())
+        line = f"{'  ' * indent}{self.name} {self.duration * 1000:.1f} ms" + (f' [{labels}]' if labels else '')
+        if self.error:
+            line += ' (error)'
+        return '\n'.join([line] + [child.format(indent + 1) for child in self.children])
+
+    def walk(self):
+        '''この段階と子孫の段階を順に返す。'''
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+# 実行中の段階（contextvarsで保持し、スレッドプールで実行したツールにも引き継ぐ）
+_current = ContextVar('timing_span', default=None)
+
+# 最上位の段階が終わったときに呼ぶ関数
+_collectors = ContextVar('timing_collectors', default=())
+
+# すべてのコンテキストで、最上位の段階が終わったときに呼ぶ関数（メトリクスの記録など）
+_observers = []
+
+
+@contextmanager
+def stage(name, **labels):
+    '''
+    この中の処理を段階 name として計測する。
+
+        with stage('load', tool='getroad_by_name'):
+            G = graph_store.get_graph()
+    '''
+    parent = _current.get()
+    span = Span(name, {**parent.labels, **labels} if parent is not None else labels, parent)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        span._memory_base, peak = tracemalloc.get_traced_memory()
+        if parent is not None:
+            parent._memory_peak = max(parent._memory_peak, peak)
+        tracemalloc.reset_peak()
+
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException:
+        span.error = True
+        raise
+    finally:
+        _current.reset(token)
+        span.duration = time.perf_counter() - span.start
+        if tracing:
+            peak = max(tracemalloc.get_traced_memory()[1], span._memory_peak)
+            span.peak_memory = max(peak - span._memory_base, 0)
+            if parent is not None:
+                # 親のピークは子の計測で reset_peak される前の値も含める
+                parent._memory_peak = max(parent._memory_peak, peak)
+        if parent is not None:
+            parent.children.append(span)
+        else:
+            _finish(span)
+
+
+def _finish(span):
+    for collector in _collectors.get() + tuple(_observers):
+        collector(span)
+
+
+def tool_stage(func):
+    '''関数の実行全体を段階 tool（ラベル tool=関数名）として計測するデコレータ。'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage('tool', tool=func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def collect():
+    '''この中で終わった最上位の段階をリストに集める。'''
+    spans = []
+    token = _collectors.set(_collectors.get() + (spans.append,))
+    try:
+        yield spans
+    finally:
+        _collectors.reset(token)
+
+
+def add_observer(observer):
+    '''最上位の段階が終わるたびに observer(span) を呼ぶ（プロセス内のすべてのスレッドで）。'''
+    _observers.append(observer)
+
+
+def attach(spans):
+    '''
+    ワーカープロセスで計測した段階（to_dict() の結果のリスト）を、実行中の段階の子として加える。
+    実行中の段階がなければ最上位の段階として扱う。
+    '''
+    parent = _current.get()
+    for data in spans:
+        span = Span.from_dict(data, parent)
+        if parent is not None:
+            parent.children.append(span)
+        else:
+            _finish(span)
+
+
+def current():
+    '''実行中の段階を返す。計測していなければNone。'''
+    return _current.get()
+
+
+def record(name, **labels):
+    '''
+    実行中の段階に出来事を記録し、記録したかどうかを返す（計測していなければ記録せずFalse）。
+    ワーカープロセスで記録した出来事も、段階と一緒にFlask APIのプロセスへ送られる。
+    '''
+    span = _current.get()
+    if span is None:
+        return False
+    span.events.append((name, labels))
+    return True
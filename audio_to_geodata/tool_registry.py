@@ -0,0 +1,154 @@
+import importlib
+import inspect
+from typing import NamedTuple
+
+from timing import stage
+
+
+# Pythonの型とJSON Schemaの型の対応（boolはintの前に判定する）
+SCHEMA_TYPES = [
+    (bool, 'boolean'),
+    (int, 'integer'),
+    (float, 'number'),
+    (str, 'string'),
+    (list, 'array'),
+    (tuple, 'array'),
+    (dict, 'object'),
+]
+
+
+class RegisteredTool(NamedTuple):
+    '''登録したツール（関数・関数宣言・実行時に必要なモジュール）。'''
+    name: str
+    func: object
+    declaration: dict
+    params: dict
+    requires: tuple
+
+
+def schema_type(annotation, default=inspect.Parameter.empty):
+    '''引数の型注釈（なければ既定値の型）からJSON Schemaの型を返す。'''
+    candidate = annotation if annotation is not inspect.Parameter.empty else (
+        type(default) if default not in (inspect.Parameter.empty, None) else str)
+    for python_type, name in SCHEMA_TYPES:
+        if isinstance(candidate, type) and issubclass(candidate, python_type):
+            return name
+    return 'string'
+
+
+def coerce(value, annotation):
+    '''モデルが返した引数を型注釈に合わせる（整数は 3.0 のような浮動小数点数で返ることがある）。'''
+    if annotation is int and isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+### ツールの登録
+class ToolRegistry:
+    '''
+    モデルに渡すツールを一度だけ宣言するための登録簿。
+
+    関数のシグネチャから関数宣言（JSON Schema）を作り、名前から辞書で関数を引いて実行する。
+    geopandas などの重いモジュールは各関数の中でimportし、requires に書いておく
+    （常駐ワーカーは preload() で起動時に読み込める）。
+    '''
+
+    def __init__(self):
+        self._tools = dict()
+
+    def tool(self, description=None, params=None, hidden=(), requires=(), name=None):
+        '''
+        関数をツールとして登録するデコレータ。
+
+        Args:
+        - description: ツールの説明。省略時は関数のdocstringの1行目。
+        - params: {引数名: 説明} の辞書。
+        - hidden: モデルに見せない引数（既定値で実行する）。
+        - requires: 実行時に必要な重いモジュールの名前。
+        - name: ツール名。省略時は関数名。
+        '''
+        params = params or dict()
+
+        def decorator(func):
+            tool_name = name or func.__name__
+            signature = inspect.signature(func)
+            properties = dict()
+            required = []
+            for param in signature.parameters.values():
+                if param.name in hidden or param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+                    continue
+                properties[param.name] = {
+                    'type': schema_type(param.annotation, param.default),
+                    'description': params.get(param.name, param.name),
+                }
+                if param.default is param.empty:
+                    required.append(param.name)
+
+            parameters = {'type': 'object', 'properties': properties}
+            if required:
+                parameters['required'] = required
+            summary = description or (inspect.getdoc(func) or tool_name).splitlines()[0]
+
+            self._tools[tool_name] = RegisteredTool(
+                name=tool_name,
+                func=func,
+                declaration={'name': tool_name, 'description': summary, 'parameters': parameters},
+                params={param.name: param.annotation for param in signature.parameters.values()
+                        if param.name not in hidden},
+                requires=tuple(requires),
+            )
+            return func
+
+        return decorator
+
+    def names(self):
+        '''登録順のツール名のリスト（ToolConfigの allowed_function_names に渡す）。'''
+        return list(self._tools)
+
+    def declarations(self):
+        '''関数宣言（name, description, parameters の辞書）のリスト。'''
+        return [tool.declaration for tool in self._tools.values()]
+
+    def function_declarations(self):
+        '''Vertex AIの FunctionDeclaration のリスト。'''
+        from vertexai.generative_models import FunctionDeclaration
+
+        return [FunctionDeclaration(**declaration) for declaration in self.declarations()]
+
+    def call(self, name, args=None):
+        '''
+        ツールを名前で実行する。
+
+        Args:
+        - name: ツール名。
+        - args: モデルが生成した引数の辞書。宣言にない引数は無視し、省略された引数は関数の既定値を使う。
+
+        Returns:
+        - 関数の戻り値。
+        '''
+        tool = self._tools.get(name)
+        if tool is None:
+            raise ValueError(f'Unknown tool: {name}')
+        kwargs = {key: coerce(value, tool.params[key]) for key, value in (args or dict()).items()
+                  if key in tool.params}
+        with stage('tool', tool=name):
+            return tool.func(**kwargs)
+
+    def requirements(self, names=None):
+        '''ツール（省略時はすべて）の実行に必要なモジュールの名前。'''
+        tools = self._tools.values() if names is None else [self._tools[name] for name in names]
+        return sorted({module for tool in tools for module in tool.requires})
+
+    def preload(self, names=None):
+        '''ツールの実行に必要なモジュールを読み込む（インストールされていないモジュールは飛ばす）。'''
+        for module in self.requirements(names):
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                pass
+
+    def __contains__(self, name):
+        return name in self._tools
+
+    def __len__(self):
+        return len(self._tools)
@@ -1,39 +1,46 @@
 from langchain_core.tools import tool
-from plateaukit import load_dataset
-from dotenv import load_dotenv
 from shapely.geometry import Polygon
 import pydeck as pdk
 import osmnx as ox
-import networkx as nx
 import geopandas as gpd
 import pandas as pd
+import numpy as np
 import json
-import requests
-import os
-
-
-### JSONを指定のディレクトリへ保存するツール
-def save_json_to_directory(json_data, filename, output_path='../public/'):
-    # ディレクトリが存在しない場合は作成する
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-    
-    # JSONデータをファイルに保存する
-    file_path = os.path.join(output_path, filename)
-    with open(file_path, 'w') as file:
-        json.dump(json_data, file, indent=2, ensure_ascii=False)
-    
-    # print(f"JSONファイルが {file_path} に保存されました。")
+import graph_store
+import building_store
+import building_lod
+import gazetteer
+import poi_fetcher
+from road_name_index import RoadNameIndex
+from line_layer import build_line_data
+import routing_engine
+import node_index
+from node_index import MAX_SNAP_DISTANCE, SnapDistanceError
+from layer_writer import EMPTY_FEATURE_COLLECTION, EMPTY_LINES, encode_json, save_layer
+from timing import stage, tool_stage
 
 
 ### 建物選択ツール
 @tool
-def getbuilding_by_name(building_name, visualize=False):
+@tool_stage
+def getbuilding_by_name(building_name, visualize=False, zoom=None):
     '''Retrieve building information by building name'''
-    tokyo23ku = load_dataset("plateau-tokyo23ku-2022.cloud")
-    area = tokyo23ku.area_from_landmark(building_name)
-    basemap_gdf = area.gdf
-    building_gdf =  basemap_gdf.query("name == @building_name")
+    # 地名辞書で建物名を解決し（表記ゆれ・音声認識の誤りを吸収）、ローカルのタイルストアから周辺の建物を取得
+    # 建物はズームに応じた詳細度（単純化・量子化・小さい建物の除外）で取得する
+    with stage('load'):
+        entry = gazetteer.resolve(building_name) if building_store.default_store.available() else None
+        if entry is not None:
+            bbox = building_store.pad_bbox(entry['bbox'], (1000, 1000))
+            basemap_gdf = building_lod.query_bbox(bbox, zoom, keep_ids=entry['building_ids'])
+        else:
+            # 未取り込みの場合はPLATEAUのクラウドデータセットから取得
+            basemap_gdf = building_store.area_gdf_from_landmark(building_name)
+    with stage('compute'):
+        if entry is not None:
+            building_gdf = basemap_gdf[basemap_gdf['buildingId'].isin(entry['building_ids'])]
+        else:
+            building_gdf =  basemap_gdf.query("name == @building_name")
+            building_gdf = building_lod.simplify_buildings(building_gdf, building_lod.pick_level(zoom), cull=False)
 
     if visualize:
 
@@ -79,55 +86,36 @@ def getbuilding_by_name(building_name, visualize=False):
       pass
     
     # basemap_json = json.loads(basemap_gdf.to_json())
-    building_json = json.loads(building_gdf.to_json())
-    lines_json = json.dumps(dict(), indent=2, ensure_ascii=False)
+    with stage('serialize'):
+        building_json = json.loads(building_gdf.to_json())
 
-    # save_json_to_directory(json_data=basemap_json, filename='basemap.json')
-    save_json_to_directory(json_data=building_json, filename='building.json')
-    save_json_to_directory(json_data=lines_json, filename='lines.json')
+    # save_layer(basemap_json, filename='basemap.json')
+    save_layer(building_json, filename='building.json')
+    save_layer(EMPTY_LINES, filename='lines.json')
 
     return building_json
 
 
 ### 道路選択ツール
 @tool
+@tool_stage
 def getroad_by_name(road_name, visualize=False):
     '''Retrieve road information by road name'''
-    def get_node_coords(node_id):
-        node = gdf_nodes[gdf_nodes["osmid"] == node_id].iloc[0]
-        return [node.x, node.y, 0]
-
-    G = ox.graph_from_place('Toshima, Tokyo, Japan', network_type='walk')
-    sub_edges = []
-    sub_nodes = set()
-
-    for u, v, k, data in G.edges(keys=True, data=True):
-        if road_name in data.get('name', ''):
-            sub_edges.append((u, v, k))
-            sub_nodes.add(u)
-            sub_nodes.add(v)
-
-    H = G.edge_subgraph(sub_edges)
-    gdf_nodes, gdf_edges = ox.graph_to_gdfs(H, nodes=True, edges=True, node_geometry=True, fill_edge_geometry=True)
-    gdf_edges = gdf_edges.reset_index()
-    gdf_nodes = gdf_nodes.reset_index()
-
-    line_data = []
-    for row in gdf_edges.itertuples(index=False):
-        edge = row._asdict()
-        if isinstance(edge["name"], list):
-            break
-        line_data.append({
-            "from": get_node_coords(edge["u"]),
-            "to": get_node_coords(edge["v"]),
-            "length": edge["length"],
-            "grade": None,
-            "oneway": edge["oneway"],
-            "highway": edge["highway"],
-            "name": edge["name"] if not pd.isna(edge["name"]) else "",
-            "maxspeed": None,
-            "lanes": None,
-        })
+    # 豊島区の歩行者ネットワーク（プロセス内とローカルのスナップショットでキャッシュ）
+    with stage('load'):
+        G = graph_store.get_graph('Toshima, Tokyo, Japan', network_type='walk')
+        name_index = graph_store.get_artifact('road_name_index', RoadNameIndex.from_graph, 'Toshima, Tokyo, Japan', 'walk')
+
+    # 道路名の索引（グラフと一緒に一度だけ作成）から一致するエッジを取得
+    with stage('compute'):
+        sub_edges = name_index.lookup(road_name)
+
+        H = G.edge_subgraph(sub_edges)
+        gdf_nodes, gdf_edges = ox.graph_to_gdfs(H, nodes=True, edges=True, node_geometry=False, fill_edge_geometry=False)
+
+    # LineLayer用のデータを生成
+    with stage('serialize'):
+        line_data = build_line_data(gdf_nodes, gdf_edges)
 
     if visualize:
         line_layer = pdk.Layer(
@@ -147,18 +135,19 @@ def getroad_by_name(road_name, visualize=False):
         deck = pdk.Deck(layers=[line_layer], initial_view_state=view_state)
         deck.show()
 
-    building_json = json.dumps(dict(), indent=2, ensure_ascii=False)
-    lines_json = json.dumps(line_data, indent=2, ensure_ascii=False)
+    with stage('serialize'):
+        lines_json = encode_json(line_data).decode('utf-8')
     # print(lines_json)
 
-    save_json_to_directory(json_data=building_json, filename='building.json')
-    save_json_to_directory(json_data=line_data, filename='lines.json')
+    save_layer(EMPTY_FEATURE_COLLECTION, filename='building.json')
+    save_layer(line_data, filename='lines.json')
 
     return lines_json
 
 
 ### 最短経路探索ツール
 @tool
+@tool_stage
 def getroad_from_points(start_point:tuple=(35.7295, 139.7109),end_point:tuple= (35.73089558924716, 139.7186283707542),visualize:bool=False):
     """
     Retrieve the shortest path from one point to another point.
@@ -179,59 +168,35 @@ def getroad_from_points(start_point:tuple=(35.7295, 139.7109),end_point:tuple= (
 
     """
 
-    def get_node_coords(node_id):
-        node = gdf_nodes[gdf_nodes["osmid"] == node_id].iloc[0]
-        # return [node.x, node.y, int(node.elevation)]
-        return [node.x, node.y, 0]  # 高さは0にする
-
-    G = ox.graph_from_place('Toshima, Tokyo, Japan', network_type='walk')
+    # 豊島区の歩行者ネットワーク（プロセス内とローカルのスナップショットでキャッシュ）
+    with stage('load'):
+        G = graph_store.get_graph('Toshima, Tokyo, Japan', network_type='walk')
+        nodes = node_index.get_node_index('Toshima, Tokyo, Japan', 'walk')
+        engine = routing_engine.get_engine('Toshima, Tokyo, Japan', 'walk')
 
+    with stage('compute'):
+        # 最寄りのノードを取得（道路から離れすぎた地点は拒否する）
+        node_ids, distances = nodes.snap([start_point[0], end_point[0]], [start_point[1], end_point[1]])
+        if not np.isfinite(distances).all():
+            raise SnapDistanceError(f'Start or end point is more than {MAX_SNAP_DISTANCE} m away from the road network')
+        start_node, end_node = node_ids.tolist()
 
-    # 最寄りのノードを取得
-    start_node = ox.nearest_nodes(G, start_point[1], start_point[0])
-    end_node = ox.nearest_nodes(G, end_point[1], end_point[0])
+        # 最短経路を計算（CSR化したグラフ上のA*）
+        route = engine.route(start_node, end_node)
 
-    # 最短経路を計算
-    route = nx.shortest_path(G, start_node, end_node, weight='length')
+        # 経路上のエッジだけのサブグラフを作成
+        H = G.edge_subgraph(engine.route_edges(route))
 
-    # サブグラフを作成
-    H = G.subgraph(route)
-
-    gdf_nodes, gdf_edges = ox.graph_to_gdfs(
-        H,
-        nodes=True, edges=True,
-        node_geometry=True,
-        fill_edge_geometry=True)
-
-    gdf_edges = gdf_edges.reset_index()
-    gdf_nodes = gdf_nodes.reset_index()
+        # 座標は端点ノードから引くため、ジオメトリの生成は省略する
+        gdf_nodes, gdf_edges = ox.graph_to_gdfs(
+            H,
+            nodes=True, edges=True,
+            node_geometry=False,
+            fill_edge_geometry=False)
 
     #linelayerを生成
-
-
-    line_data = []
-
-    for row in gdf_edges.itertuples(index=False):
-        edge = row._asdict()
-
-        if isinstance(edge["name"], list):
-            break
-
-        name = edge["name"]
-
-        line_data.append(
-            {
-                "from": get_node_coords(edge["u"]),
-                "to": get_node_coords(edge["v"]),
-                "length": edge["length"],
-                "grade": None,
-                "oneway": edge["oneway"],
-                "highway": edge["highway"],
-                "name": edge["name"] if not pd.isna(edge["name"]) else "",
-                "maxspeed": None,
-                "lanes": None,
-            }
-        )
+    with stage('serialize'):
+        line_data = build_line_data(gdf_nodes, gdf_edges)
 
     if visualize:
         # LineLayerを作成
@@ -259,66 +224,49 @@ def getroad_from_points(start_point:tuple=(35.7295, 139.7109),end_point:tuple= (
         deck.show()
 
 
-    building_json = json.dumps(dict(), indent=2, ensure_ascii=False)
-    lines_json = json.dumps(line_data, indent=2, ensure_ascii=False)
+    with stage('serialize'):
+        lines_json = encode_json(line_data).decode('utf-8')
 
-    save_json_to_directory(json_data=building_json, filename='building.json')
-    save_json_to_directory(json_data=line_data, filename='lines.json')
+    save_layer(EMPTY_FEATURE_COLLECTION, filename='building.json')
+    save_layer(line_data, filename='lines.json')
 
     return lines_json
 
 
 ### レストラン情報取得ツール
 @tool
-def getrestaurants(visualize=False):
+@tool_stage
+def getrestaurants(visualize=False, zoom=None):
     '''Retrieve information about Asian restaurants within a 3km radius of Ikebukuro Station.'''
 
-    # APIキーの取得
-    load_dotenv()
-    API_KEY = os.getenv('HOTPEPPER_API_KEY')
-
     # hotpepper からレストラン情報を取得
-    URL = 'http://webservice.recruit.co.jp/hotpepper/gourmet/v1/'
-
-    #池袋駅から半径3km以内のアジア料理を取得
-
-    body = {
-        'key':API_KEY,
-        'genre':'G009',
-        'lat':35.728926,
-        'lng':139.71038,
-        'range':5,
-        'format':'json',
-        'count':100
-    }
-    #api request
-    response = requests.get(URL,body)
-    #取得したデータからJSONデータを取得
-    datum = response.json()
-    #JSONデータの中からお店のデータを取得
-    stores = datum['results']['shop']
-    #お店のデータの中から、店名を抜き出してgdfに変換
-    for store_name in stores:
-        name = store_name['name']
-
-    df_stores = pd.DataFrame(stores)
-    gdf_stores = gpd.GeoDataFrame(
-        df_stores, geometry=gpd.points_from_xy(df_stores.lng, df_stores.lat), crs="EPSG:4326"
-    )
-
-    #plateauから建物データを取得
-    tokyo23ku = load_dataset("plateau-tokyo23ku-2022.cloud")
-    area = tokyo23ku.area_from_landmark(landmark="サンシャインシティ",min_size=[1500,1500])
-    base_building_gdf  = area.gdf
+    #池袋駅から半径3km以内のアジア料理を取得（全ページを並列取得し、geohashタイル単位でキャッシュ）
+    with stage('load'):
+        stores = poi_fetcher.get_fetcher().shops_within(lat=35.728926, lng=139.71038, range_code=5, genre='G009')
+
+        #plateauから建物データを取得
+        base_building_gdf = building_store.area_gdf_from_landmark("サンシャインシティ", min_size=(1500, 1500))
+
+    with stage('compute'):
+        #お店のデータの中から、店名を抜き出してgdfに変換
+        for store_name in stores:
+            name = store_name['name']
+
+        df_stores = pd.DataFrame(stores)
+        gdf_stores = gpd.GeoDataFrame(
+            df_stores, geometry=gpd.points_from_xy(df_stores.lng, df_stores.lat), crs="EPSG:4326"
+        )
 
+        #建物との交差判定
+        joined_gdf = gpd.sjoin(gdf_stores, base_building_gdf, how="inner", predicate="within")
+        base_building_gdf['store_dummy'] = base_building_gdf['buildingId'].isin(joined_gdf['buildingId']).astype(int)
 
-    #建物との交差判定
-    joined_gdf = gpd.sjoin(gdf_stores, base_building_gdf, how="inner", predicate="within")
-    base_building_gdf['store_dummy'] = base_building_gdf['buildingId'].isin(joined_gdf['buildingId']).astype(int)
+        #ベースの建物と，レストランが入った建物をそれぞれ切り分け
+        basemap_gdf = base_building_gdf
+        building_gdf = base_building_gdf.query('store_dummy==1')
 
-    #ベースの建物と，レストランが入った建物をそれぞれ切り分け
-    basemap_gdf = base_building_gdf
-    building_gdf = base_building_gdf.query('store_dummy==1')
+        # 出力する建物をズームに応じた詳細度にする（レストランの入った建物は省かない）
+        building_gdf = building_lod.simplify_buildings(building_gdf, building_lod.pick_level(zoom), cull=False)
 
     if visualize:
 
@@ -360,18 +308,19 @@ def getrestaurants(visualize=False):
       pass
 
     # basemap_json = json.loads(basemap_gdf.to_json())
-    building_json = json.loads(building_gdf.to_json())
-    lines_json = json.dumps(dict(), indent=2, ensure_ascii=False)
+    with stage('serialize'):
+        building_json = json.loads(building_gdf.to_json())
 
-    # save_json_to_directory(json_data=basemap_json, filename='basemap.json')
-    save_json_to_directory(json_data=building_json, filename='building.json')
-    save_json_to_directory(json_data=lines_json, filename='lines.json')
+    # save_layer(basemap_json, filename='basemap.json')
+    save_layer(building_json, filename='building.json')
+    save_layer(EMPTY_LINES, filename='lines.json')
 
     return building_json
 
 
 ### 建物建築ツール
 @tool
+@tool_stage
 def buildbuilding(building_type='大きい',visualize=False):
     '''Build large or small buildings.'''
 
@@ -413,15 +362,16 @@ def buildbuilding(building_type='大きい',visualize=False):
     """
 
 
-    # ShapelyのPolygonオブジェクトを作成
-    polygon = Polygon(building_geojson['coordinates'][0])
+    with stage('compute'):
+        # ShapelyのPolygonオブジェクトを作成
+        polygon = Polygon(building_geojson['coordinates'][0])
 
 
-    # GeoDataFrameの座標系を適切に設定 (ここではWGS84と仮定)
-    building_gdf =  gpd.GeoDataFrame(index=[0], geometry=[polygon]).set_crs(epsg=4326)
+        # GeoDataFrameの座標系を適切に設定 (ここではWGS84と仮定)
+        building_gdf =  gpd.GeoDataFrame(index=[0], geometry=[polygon]).set_crs(epsg=4326)
 
-    # 建物の高さをセット
-    building_gdf['measuredHeight'] = param_buildingHeight
+        # 建物の高さをセット
+        building_gdf['measuredHeight'] = param_buildingHeight
 
     if visualize:
 
@@ -472,10 +422,10 @@ def buildbuilding(building_type='大きい',visualize=False):
 
     basemap_json = json.loads(basemap_gdf.to_json())
     """
-    building_json = json.loads(building_gdf.to_json())
-    lines_json = json.dumps(dict(), indent=2, ensure_ascii=False)
+    with stage('serialize'):
+        building_json = json.loads(building_gdf.to_json())
 
-    save_json_to_directory(json_data=building_json, filename='building.json')
-    save_json_to_directory(json_data=lines_json, filename='lines.json')
+    save_layer(building_json, filename='building.json')
+    save_layer(EMPTY_LINES, filename='lines.json')
 
     return building_json
\ No newline at end of file
@@ -0,0 +1,326 @@
+import argparse
+import gzip
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+
+# タイルの保存先（レイヤーごとに {name}.mbtiles）
+VECTOR_TILES_DIR = os.getenv('VECTOR_TILES_DIR', './cache/tiles')
+
+# MVTの座標の分解能と、タイル境界の外側に含める幅（分解能に対する割合）
+EXTENT = 4096
+BUFFER = 64 / 4096
+
+# 画面上のタイルの大きさ（px）。これより小さい建物は低ズームで省く
+TILE_PIXELS = 512
+
+# Webメルカトルの原点からの距離（m）
+ORIGIN_SHIFT = 20037508.342789244
+
+# レイヤーごとの既定のズーム範囲と属性
+LAYER_DEFAULTS = {
+    'buildings': {'min_zoom': 14, 'max_zoom': 16, 'fields': ['buildingId', 'name', 'measuredHeight']},
+    'roads': {'min_zoom': 12, 'max_zoom': 16, 'fields': ['name', 'highway', 'length']},
+}
+
+# TileJSONで数値として宣言する属性（それ以外は文字列）
+NUMBER_FIELDS = ('measuredHeight', 'length')
+
+
+### タイルの座標
+def tile_bounds(z, x, y):
+    '''タイル z/x/y の範囲 [西, 南, 東, 北] をWebメルカトル（m）で返す。'''
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    return [-ORIGIN_SHIFT + x * size, ORIGIN_SHIFT - (y + 1) * size,
+            -ORIGIN_SHIFT + (x + 1) * size, ORIGIN_SHIFT - y * size]
+
+
+def lonlat_to_tile(lon, lat, z):
+    '''緯度経度を含むタイルの (x, y) を返す。'''
+    n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def mercator_to_lonlat(x, y):
+    return math.degrees(x / 6378137.0), math.degrees(2 * math.atan(math.exp(y / 6378137.0)) - math.pi / 2)
+
+
+def tiles_covering(bbox, z):
+    '''bbox [西, 南, 東, 北]（緯度経度）と重なるタイル (x, y) を列ごとに返す。'''
+    min_x, min_y = lonlat_to_tile(bbox[0], bbox[3], z)
+    max_x, max_y = lonlat_to_tile(bbox[2], bbox[1], z)
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            yield x, y
+
+
+### タイルの作成
+def encode_tile(layer_name, gdf, z, x, y, fields, min_pixels=0):
+    '''
+    Webメルカトルの地物をタイル z/x/y のMVT（gzip圧縮）にする。地物がなければNone。
+
+    タイル境界（とバッファ）で切り取り、タイルの分解能で単純化する。
+    ポリゴンは min_pixels（画面上のpx）より小さいものを省く。
+    '''
+    import mapbox_vector_tile
+    import shapely
+
+    bounds = tile_bounds(z, x, y)
+    size = bounds[2] - bounds[0]
+    margin = size * BUFFER
+    geometries = shapely.clip_by_rect(gdf.geometry.to_numpy(), bounds[0] - margin, bounds[1] - margin,
+                                      bounds[2] + margin, bounds[3] + margin)
+    geometries = shapely.simplify(geometries, size / EXTENT, preserve_topology=True)
+
+    # タイル座標（左上が原点、0〜EXTENT）への変換をまとめて行う
+    scale = EXTENT / size
+    geometries = shapely.transform(geometries, lambda coords: np.round(np.column_stack(
+        [(coords[:, 0] - bounds[0]) * scale, (bounds[3] - coords[:, 1]) * scale])))
+
+    keep = ~shapely.is_empty(geometries)
+    if min_pixels:
+        pixel = size / TILE_PIXELS
+        is_polygon = np.isin(shapely.get_type_id(geometries), [3, 6])
+        keep &= ~is_polygon | (shapely.area(geometries) >= (min_pixels * pixel) ** 2)
+    if not keep.any():
+        return None
+
+    columns = [field for field in fields if field in gdf.columns]
+    records = gdf[columns][keep].to_dict('records')
+    features = []
+    for geometry, record in zip(geometries[keep], records):
+        properties = {key: _property_value(value) for key, value in record.items()}
+        features.append({
+            'geometry': geometry,
+            'properties': {key: value for key, value in properties.items() if value is not None},
+        })
+
+    data = mapbox_vector_tile.encode(
+        [{'name': layer_name, 'features': features}],
+        default_options={'y_coord_down': True, 'extents': EXTENT},
+    )
+    return gzip.compress(data, mtime=0)
+
+
+def _property_value(value):
+    if isinstance(value, (list, tuple)):
+        value = ';'.join(str(item) for item in value)
+    elif hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def build_mbtiles(layer_name, query, bbox, path, min_zoom, max_zoom, fields, min_pixels=0):
+    '''
+    地物をタイルに切り分けてMBTiles（SQLite）に保存する。
+
+    Args:
+    - layer_name: MVTのレイヤー名。
+    - query: bbox [西, 南, 東, 北]（緯度経度）を受け取り、交差する地物のGeoDataFrameを返す関数。
+      タイルを列ごとに順に処理するため、建物ストアのタイルキャッシュがそのまま効く。
+    - bbox: タイルを作る範囲（緯度経度）。
+    - path: MBTilesの保存先。
+    - min_zoom, max_zoom: ズームの範囲。
+    - fields: タイルに含める属性。
+    - min_pixels: 最大ズーム未満で省くポリゴンの大きさ（画面上のpx）。
+
+    Returns:
+    - 作成したタイル数。
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    connection.executescript('''
+        CREATE TABLE metadata (name TEXT, value TEXT);
+        CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+        CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+    ''')
+
+    count = 0
+    for z in range(min_zoom, max_zoom + 1):
+        rows = []
+        for x, y in tiles_covering(bbox, z):
+            west, south, east, north = tile_bounds(z, x, y)
+            margin = (east - west) * BUFFER
+            lon_min, lat_min = mercator_to_lonlat(west - margin, south - margin)
+            lon_max, lat_max = mercator_to_lonlat(east + margin, north + margin)
+            gdf = query([lon_min, lat_min, lon_max, lat_max])
+            if gdf is None or gdf.empty:
+                continue
+            data = encode_tile(layer_name, gdf.to_crs(epsg=3857), z, x, y, fields,
+                               min_pixels if z < max_zoom else 0)
+            if data is not None:
+                # MBTilesの行番号はTMS（南が0）
+                rows.append((z, x, 2 ** z - 1 - y, data))
+        connection.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?)', rows)
+        connection.commit()
+        count += len(rows)
+
+    center = [(bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2, max_zoom]
+    metadata = {
+        'name': layer_name,
+        'format': 'pbf',
+        'minzoom': str(min_zoom),
+        'maxzoom': str(max_zoom),
+        'bounds': ','.join(str(value) for value in bbox),
+        'center': ','.join(str(value) for value in center),
+        'json': json.dumps({'vector_layers': [{
+            'id': layer_name, 'minzoom': min_zoom, 'maxzoom': max_zoom,
+            'fields': {field: 'Number' if field in NUMBER_FIELDS else 'String' for field in fields},
+        }]}),
+    }
+    connection.executemany('INSERT INTO metadata VALUES (?, ?)', metadata.items())
+    connection.commit()
+    connection.close()
+    # 作成し終えてから置き換え、配信中のタイルが途中の状態にならないようにする
+    os.replace(tmp_path, path)
+    return count
+
+
+def build_buildings(path=None, min_zoom=None, max_zoom=None, bbox=None, min_pixels=1):
+    '''建物ストアの建物をタイルにする。'''
+    import building_store
+
+    defaults = LAYER_DEFAULTS['buildings']
+    store = building_store.default_store
+    if bbox is None:
+        tiles = store.manifest['tiles']
+        bbox = [min(tile['bbox'][0] for tile in tiles), min(tile['bbox'][1] for tile in tiles),
+                max(tile['bbox'][2] for tile in tiles), max(tile['bbox'][3] for tile in tiles)]
+    return build_mbtiles('buildings', store.query_bbox, bbox, path or tileset_path('buildings'),
+                         min_zoom or defaults['min_zoom'], max_zoom or defaults['max_zoom'],
+                         defaults['fields'], min_pixels)
+
+
+def build_roads(place='Toshima, Tokyo, Japan', network_type='walk', path=None, min_zoom=None, max_zoom=None):
+    '''道路グラフのエッジをタイルにする。'''
+    import osmnx as ox
+    import shapely
+    import graph_store
+
+    defaults = LAYER_DEFAULTS['roads']
+    G = graph_store.get_graph(place, network_type=network_type)
+    edges = ox.graph_to_gdfs(G, nodes=False, edges=True, fill_edge_geometry=True).reset_index(drop=True)
+    edges = edges.to_crs(epsg=4326)
+    tree = edges.sindex
+
+    def query(bbox):
+        return edges.iloc[tree.query(shapely.box(*bbox))]
+
+    return build_mbtiles('roads', query, list(edges.total_bounds), path or tileset_path('roads'),
+                         min_zoom or defaults['min_zoom'], max_zoom or defaults['max_zoom'], defaults['fields'])
+
+
+### タイルの配信
+def tileset_path(layer_name, tiles_dir=VECTOR_TILES_DIR):
+    return os.path.join(tiles_dir, f'{layer_name}.mbtiles')
+
+
+class MBTiles:
+    '''
+    MBTilesを読み取り専用で開き、タイルを返すクラス。
+    SQLiteの接続はスレッドごとに持つ（Flaskのスレッドから同時に読める）。
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._metadata = None
+        # 開いた時点のファイルの版（作り直されたら開き直す）
+        self.opened_version = self.version
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+            self._local.connection = connection
+        return connection
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = dict(self._connection().execute('SELECT name, value FROM metadata'))
+        return self._metadata
+
+    def get_tile(self, z, x, y):
+        '''タイル z/x/y（XYZ）のMVT（gzip圧縮）を返す。ない場合はNone。'''
+        row = self._connection().execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+            (z, x, 2 ** z - 1 - y),
+        ).fetchone()
+        return row[0] if row else None
+
+    @property
+    def version(self):
+        '''ファイルの更新を表す値（ETagに含め、作り直したタイルを再取得させる）。'''
+        stat = os.stat(self.path)
+        return f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
+    def tilejson(self, url):
+        '''TileJSON（MVTLayerなどのクライアントがタイルのURLとズーム範囲を知るための情報）。'''
+        metadata = self.metadata
+        tilejson = {
+            'tilejson': '3.0.0',
+            'name': metadata.get('name'),
+            'tiles': [url],
+            'minzoom': int(metadata.get('minzoom', 0)),
+            'maxzoom': int(metadata.get('maxzoom', 22)),
+            'bounds': [float(value) for value in metadata.get('bounds', '-180,-85,180,85').split(',')],
+        }
+        if 'json' in metadata:
+            tilejson.update(json.loads(metadata['json']))
+        return tilejson
+
+
+def tile_etag(tileset, z, x, y, data):
+    '''タイルのETag（ファイルの版とタイルの内容から作る）。'''
+    digest = hashlib.blake2b(data, digest_size=8).hexdigest()
+    return f'{tileset.opened_version}-{z}-{x}-{y}-{digest}'
+
+
+# プロセス内で共有するタイルセット
+_tilesets = dict()
+_tilesets_lock = threading.Lock()
+
+
+def get_tileset(layer_name, tiles_dir=VECTOR_TILES_DIR):
+    '''レイヤーのタイルセットを返す。作成されていない場合はNone。'''
+    path = tileset_path(layer_name, tiles_dir)
+    if not os.path.exists(path):
+        return None
+    with _tilesets_lock:
+        tileset = _tilesets.get(path)
+        if tileset is None or tileset.version != tileset.opened_version:
+            tileset = _tilesets[path] = MBTiles(path)
+    return tileset
+
+
+if __name__ == '__main__':
+    # python vector_tiles.py buildings [--min-zoom 14 --max-zoom 16]
+    # python vector_tiles.py roads [--place 'Toshima, Tokyo, Japan']
+    parser = argparse.ArgumentParser(description='建物・道路をMVTのタイルに切り分けてMBTilesに保存する')
+    parser.add_argument('layer', choices=list(LAYER_DEFAULTS))
+    parser.add_argument('--min-zoom', type=int)
+    parser.add_argument('--max-zoom', type=int)
+    parser.add_argument('--bbox', type=float, nargs=4)
+    parser.add_argument('--place', default='Toshima, Tokyo, Japan')
+    args = parser.parse_args()
+
+    if args.layer == 'buildings':
+        count = build_buildings(min_zoom=args.min_zoom, max_zoom=args.max_zoom, bbox=args.bbox)
+    else:
+        count = build_roads(args.place, min_zoom=args.min_zoom, max_zoom=args.max_zoom)
+    print(f'{count:,} tiles -> {tileset_path(args.layer)}')
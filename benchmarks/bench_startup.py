@@ -0,0 +1,75 @@
+'''
+CLIのエントリーポイント（main_string_query.py・main.py）の起動時間を計測する。
+
+各計測は新しいPythonプロセスで行う（importのキャッシュが効かない状態）。
+- lazy: スクリプトをimportし、add_two_numbers を registry から実行するまで
+- eager: 上に加えて、以前はスクリプトの先頭でimportしていたモジュールをすべて読み込むまで
+  （インストールされていないモジュールは飛ばし、結果に表示する）
+
+    python benchmarks/bench_startup.py --repeat 10
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'audio_to_geodata')
+
+# 以前スクリプトの先頭でimportしていた重いモジュール
+EAGER_IMPORTS = {
+    'main_string_query': ['geopandas', 'pandas', 'pydeck', 'requests', 'vertexai', 'plateaukit', 'shapely'],
+    'main': ['vertexai', 'google.cloud.speech', 'shapely', 'geopandas', 'pydeck'],
+}
+
+# 子プロセスで実行するコード（importからツールの実行までの時間と読み込まれなかったモジュールを返す）
+CHILD = '''
+import importlib, json, sys, time
+start = time.perf_counter()
+module = importlib.import_module({script!r})
+missing = []
+for name in {eager!r}:
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        missing.append(name)
+module.registry.call('add_two_numbers', {{'a': 3, 'b': 5}})
+print(json.dumps({{'seconds': time.perf_counter() - start, 'missing': missing}}))
+'''
+
+
+def measure(script, eager, repeat):
+    '''新しいプロセスで repeat 回計測し、(秒のリスト, 読み込まれなかったモジュール) を返す。'''
+    code = CHILD.format(script=script, eager=eager)
+    seconds = []
+    missing = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], cwd=SCRIPT_DIR, check=True,
+                                capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        seconds.append(result['seconds'])
+        missing = result['missing']
+    return seconds, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CLIのエントリーポイントの起動時間を計測する')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scripts', nargs='+', default=list(EAGER_IMPORTS))
+    args = parser.parse_args()
+
+    print(f"{'script':<20}{'mode':<8}{'median ms':>12}{'min ms':>10}")
+    for script in args.scripts:
+        lazy, _ = measure(script, [], args.repeat)
+        eager, missing = measure(script, EAGER_IMPORTS[script], args.repeat)
+        for mode, seconds in (('lazy', lazy), ('eager', eager)):
+            print(f'{script:<20}{mode:<8}{statistics.median(seconds) * 1000:>12.1f}{min(seconds) * 1000:>10.1f}')
+        print(f'{script:<20}{"speedup":<8}{statistics.median(eager) / statistics.median(lazy):>11.1f}x')
+        if missing:
+            print(f'  (not installed, excluded from eager: {", ".join(missing)})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+'''
+地理空間ツールの処理時間とメモリのピークを、段階（load・compute・serialize・write）ごとに計測する。
+
+ネットワークに接続せずに実行できるよう、次のものを合成データ・スタブに置き換える。
+- 豊島区の歩行者ネットワーク: 格子状の合成グラフ（--graph-size で一辺のノード数を指定）
+- PLATEAUの建物: 池袋周辺に並べた合成の建物のGeoDataFrame（--buildings で件数を指定）
+- ホットペッパーのAPI: 建物の中に置いた合成の店舗
+- 浸水深のグリッド: show_flood_depth の表示範囲を覆う合成のグリッド（--flood-size で一辺のセル数を指定）
+- 避難所の一覧: 合成グラフの範囲に散らばせた避難所のCSV（--shelters で件数を指定）
+レイヤーは一時ディレクトリに書き出す（LLMは呼ばず、ツールを直接実行する）。
+
+    python benchmarks/bench_tools.py --rounds 10
+    python benchmarks/bench_tools.py --save-baseline      # 結果を baselines.json に保存（--tools を指定すればそのツールの行だけ更新）
+    python benchmarks/bench_tools.py --compare            # 保存した結果より遅くなった段階を報告する
+'''
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'audio_to_geodata')
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+PLACE = 'Toshima, Tokyo, Japan'
+
+# 合成データの基準点（池袋駅周辺）
+ORIGIN = (35.7200, 139.7000)
+NODE_SPACING = (0.0004, 0.0005)
+
+# ツールと実行時の引数（getroad_from_points の始点・終点は cases() で合成グラフの範囲から決める）
+CASES = {
+    'getbuilding_by_name': {'building_name': 'サンシャインシティ'},
+    'getroad_by_name': {'road_name': '明治通り'},
+    'getroad_from_points': {},
+    'getrestaurants': {},
+    'buildbuilding': {'building_type': '大きい'},
+    'show_flood_depth': {'param_floodingDepth': 3},
+    'show_shelters': {},
+}
+
+
+# getroad_from_points の始点・終点の、合成グラフの範囲（南西が0、北東が1）に対する位置
+ROUTE_FRACTIONS = ((0.40, 0.36), (0.45, 0.62))
+
+
+def cases(graph_size):
+    '''ツールと実行時の引数。経路探索の始点・終点は一辺 graph_size ノードの合成グラフの中に置く。'''
+    (start_lat, start_lng), (end_lat, end_lng) = [
+        (ORIGIN[0] + lat * (graph_size - 1) * NODE_SPACING[0], ORIGIN[1] + lng * (graph_size - 1) * NODE_SPACING[1])
+        for lat, lng in ROUTE_FRACTIONS]
+    return {**CASES, 'getroad_from_points': {'start_point': (start_lat, start_lng), 'end_point': (end_lat, end_lng)}}
+
+
+### 合成データ
+def synthetic_graph(size, seed=0):
+    '''一辺 size ノードの格子状の歩行者ネットワーク（osmnxのグラフと同じ属性を持つ）。'''
+    import networkx as nx
+
+    rng = random.Random(seed)
+    G = nx.MultiDiGraph(crs='epsg:4326')
+    for i in range(size):
+        for j in range(size):
+            G.add_node(i * size + j,
+                       y=ORIGIN[0] + i * NODE_SPACING[0] + rng.uniform(-1e-4, 1e-4),
+                       x=ORIGIN[1] + j * NODE_SPACING[1] + rng.uniform(-1e-4, 1e-4))
+
+    names = ['サンシャイン通り', '明治通り', None, ['グリーン大通り', '明治通り']]
+    for i in range(size):
+        for j in range(size):
+            u = i * size + j
+            for v in ([u + 1] if j < size - 1 else []) + ([u + size] if i < size - 1 else []):
+                length = _distance(G.nodes[u], G.nodes[v]) * rng.uniform(1.0, 1.3)
+                attributes = {'length': length, 'name': names[(i + j) % len(names)],
+                              'highway': 'footway', 'oneway': False}
+                G.add_edge(u, v, 0, **attributes)
+                G.add_edge(v, u, 0, **attributes)
+    return G
+
+
+def _distance(a, b):
+    from routing_engine import EARTH_RADIUS
+
+    lat1, lng1, lat2, lng2 = map(math.radians, (a['y'], a['x'], b['y'], b['x']))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(h))
+
+
+def synthetic_buildings(count, seed=0):
+    '''PLATEAUの建物と同じ列（buildingId, name, measuredHeight, geometry）を持つGeoDataFrame。'''
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    rng = random.Random(seed)
+    side = max(int(math.ceil(math.sqrt(count))), 1)
+    records = []
+    for index in range(count):
+        lat = ORIGIN[0] + 0.02 * (index // side) / side
+        lng = ORIGIN[1] + 0.02 * (index % side) / side
+        size = rng.uniform(0.00005, 0.0002)
+        records.append({
+            'buildingId': f'bldg_{index:06d}',
+            # 一部の建物には名前を付ける（最初の建物は getbuilding_by_name で探す建物）
+            'name': 'サンシャインシティ' if index == 0 else (f'ビル{index}' if index % 10 == 0 else None),
+            'measuredHeight': rng.uniform(3, 120),
+            'geometry': box(lng, lat, lng + size, lat + size),
+        })
+    return gpd.GeoDataFrame(records, geometry='geometry', crs='EPSG:4326')
+
+
+def synthetic_shops(buildings, count, seed=0):
+    '''建物の中心に置いた店舗（ホットペッパーのAPIの応答と同じ形式）。'''
+    rng = random.Random(seed)
+    centroids = buildings.geometry.representative_point()
+    picks = rng.sample(range(len(buildings)), min(count, len(buildings)))
+    return [{'id': f'J{index:08d}', 'name': f'店舗{index}', 'lat': centroids.iloc[pick].y,
+             'lng': centroids.iloc[pick].x, 'genre': {'code': 'G009'}}
+            for index, pick in enumerate(picks)]
+
+
+def synthetic_flood_depth(size):
+    '''起伏のある浸水深（m、浸水しないセルはNaN）の2次元配列。'''
+    import numpy as np
+
+    rows, cols = np.mgrid[0:size, 0:size]
+    depth = (np.sin(cols / (size / 20)) * np.cos(rows / (size / 16)) * 6).astype(np.float32)
+    depth[depth <= 0] = np.nan
+    return depth
+
+
+def synthetic_shelters(graph_size, count, path, seed=0):
+    '''合成グラフの範囲に散らばせた避難所のCSV（指定緊急避難場所データと同じ列名）を書き出す。'''
+    rng = random.Random(seed)
+    lines = ['共通ID,施設・場所名,緯度,経度']
+    for index in range(count):
+        lat = ORIGIN[0] + rng.uniform(0, graph_size * NODE_SPACING[0])
+        lng = ORIGIN[1] + rng.uniform(0, graph_size * NODE_SPACING[1])
+        lines.append(f'S{index:04d},避難所{index},{lat},{lng}')
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+class StubFetcher:
+    def __init__(self, shops):
+        self.shops = shops
+
+    def shops_within(self, lat, lng, range_code=5, genre=None):
+        return list(self.shops)
+
+
+def install_fixtures(graph_size, building_count, shop_count, flood_size, shelter_count):
+    '''合成データをストアに登録し、ネットワーク・データセットを読む関数をスタブに置き換える。'''
+    import building_store
+    import flood_raster
+    import graph_store
+    import poi_fetcher
+    import shelter_analysis
+
+    if flood_size:
+        west, south, east, north = flood_raster.FLOOD_VIEW_BBOX
+        flood_raster.create(synthetic_flood_depth(flood_size), (west - 0.01, south - 0.01, east + 0.01, north + 0.01))
+
+    graph_store.default_store.put(synthetic_graph(graph_size), PLACE, 'walk')
+    if shelter_count:
+        synthetic_shelters(graph_size, shelter_count, shelter_analysis.SHELTER_PATH)
+
+    buildings = synthetic_buildings(building_count)
+    fetcher = StubFetcher(synthetic_shops(buildings, shop_count))
+    # タイルストアは使わず、クラウドデータセットの代わりに合成の建物を返す
+    building_store.default_store.available = lambda: False
+    building_store.area_gdf_from_landmark = lambda landmark, min_size=(1000, 1000), **kwargs: buildings.copy()
+    poi_fetcher.get_fetcher = lambda: fetcher
+
+
+def load_tools():
+    '''ツールの名前から実行する関数を返す辞書。'''
+    import main_string_query
+    import tools
+
+    runners = {name: getattr(tools, name).invoke for name in CASES if hasattr(tools, name)}
+    for name in CASES:
+        if name not in runners and name in main_string_query.registry:
+            runners[name] = lambda args, name=name: main_string_query.registry.call(name, args)
+    return runners
+
+
+### 計測
+def measure(run, args, rounds, warmup, memory=True):
+    '''
+    ツールを rounds 回実行し、段階ごとの処理時間（秒）とメモリのピーク（バイト）のリストを返す。
+    最初の warmup 回（グラフの派生データの作成など）は計測に含めない。
+    memory が真の場合は tracemalloc でメモリを計測する（その分、処理時間は長くなる）。
+    '''
+    import timing
+
+    for _ in range(warmup):
+        run(dict(args))
+
+    results = dict()
+    for _ in range(rounds):
+        if memory:
+            tracemalloc.start()
+        try:
+            with timing.collect() as spans:
+                start = time.perf_counter()
+                run(dict(args))
+                total = time.perf_counter() - start
+        finally:
+            if memory:
+                tracemalloc.stop()
+
+        stages = {'total': (total, 0)}
+        for span in spans:
+            for child in span.walk():
+                if child.name == 'tool':
+                    stages['total'] = (total, child.peak_memory or 0)
+                    continue
+                # 同じ段階が複数回ある場合（serialize を2回に分けている場合など）は合計する
+                duration, peak = stages.get(child.name, (0, 0))
+                stages[child.name] = (duration + child.duration, max(peak, child.peak_memory or 0))
+        for name, (duration, peak) in stages.items():
+            results.setdefault(name, {'seconds': [], 'peak_memory': []})
+            results[name]['seconds'].append(duration)
+            results[name]['peak_memory'].append(peak)
+    return results
+
+
+def summarize(results):
+    return {name: {'median': statistics.median(values['seconds']),
+                   'min': min(values['seconds']),
+                   'peak_memory': max(values['peak_memory'])}
+            for name, values in results.items()}
+
+
+def compare(summary, baseline, threshold):
+    '''基準より threshold 倍以上遅くなった (ツール, 段階, 基準, 今回) のリスト。'''
+    regressions = []
+    for tool, stages in summary.items():
+        for name, result in stages.items():
+            previous = baseline.get(tool, dict()).get(name)
+            # 1ms未満の段階は誤差が大きいため比較しない
+            if previous is None or previous['median'] < 0.001:
+                continue
+            if result['median'] > previous['median'] * threshold:
+                regressions.append((tool, name, previous['median'], result['median']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='地理空間ツールの段階ごとの処理時間とメモリを計測する')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--graph-size', type=int, default=60, help='合成グラフの一辺のノード数')
+    parser.add_argument('--buildings', type=int, default=2000)
+    parser.add_argument('--shops', type=int, default=200)
+    parser.add_argument('--flood-size', type=int, default=2000, help='合成の浸水深のグリッドの一辺のセル数（0なら作らない）')
+    parser.add_argument('--shelters', type=int, default=20, help='合成の避難所の件数（0なら作らない）')
+    parser.add_argument('--tools', nargs='+', default=list(CASES))
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--threshold', type=float, default=1.5, help='遅くなったとみなす基準との比')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--no-memory', action='store_true', help='メモリを計測しない（処理時間だけを正確に測る）')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    # レイヤーは一時ディレクトリに書き出す（モジュールのimport前に設定する）
+    output_dir = tempfile.mkdtemp(prefix='bench_tools_')
+    os.environ['LAYER_OUTPUT_PATH'] = output_dir + os.sep
+    os.environ.setdefault('GRAPH_CACHE_DIR', os.path.join(output_dir, 'graphs'))
+    os.environ.setdefault('POI_CACHE_DIR', os.path.join(output_dir, 'hotpepper'))
+    os.environ['FLOOD_RASTER_DIR'] = os.path.join(output_dir, 'flood')
+    os.environ['SHELTER_PATH'] = os.path.join(output_dir, 'shelters.csv')
+    sys.path.insert(0, os.path.abspath(SCRIPT_DIR))
+
+    install_fixtures(args.graph_size, args.buildings, args.shops, args.flood_size, args.shelters)
+    runners = load_tools()
+
+    tool_cases = cases(args.graph_size)
+    summary = dict()
+    for name in args.tools:
+        if name not in runners:
+            print(f'{name}: skipped (not found)', file=sys.stderr)
+            continue
+        summary[name] = summarize(measure(runners[name], tool_cases[name], args.rounds, args.warmup,
+                                        memory=not args.no_memory))
+
+    if args.json:
+        print(json.dumps(summary, indent=2, ensure_ascii=False))
+    else:
+        print(f'{"tool":<22}{"stage":<12}{"median ms":>12}{"min ms":>10}{"peak KiB":>12}')
+        for tool, stages in summary.items():
+            for name, result in sorted(stages.items(), key=lambda item: item[0] != 'total'):
+                print(f'{tool:<22}{name:<12}{result["median"] * 1000:>12.2f}'
+                      f'{result["min"] * 1000:>10.2f}{result["peak_memory"] / 1024:>12.1f}')
+
+    if args.save_baseline:
+        parameters = {'graph_size': args.graph_size, 'buildings': args.buildings, 'shops': args.shops,
+                      'flood_size': args.flood_size, 'shelters': args.shelters, 'rounds': args.rounds,
+                      'memory': not args.no_memory}
+        # 同じ条件の基準があれば、計測したツールの行だけを置き換える
+        results = summary
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as file:
+                previous = json.load(file)
+            if previous.get('parameters') == parameters:
+                results = {**previous['results'], **summary}
+        baseline = {'parameters': parameters, 'results': results}
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(baseline, file, indent=2, ensure_ascii=False)
+        print(f'Saved baseline to {args.baseline}')
+
+    if args.compare:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+        regressions = compare(summary, baseline['results'], args.threshold)
+        for tool, name, previous, current in regressions:
+            print(f'REGRESSION {tool}/{name}: {previous * 1000:.2f} ms -> {current * 1000:.2f} ms')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
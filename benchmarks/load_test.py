@@ -0,0 +1,346 @@
+'''
+Flask APIの負荷試験。ファシリテーションのクエリと録音（load_corpus.json）を同時に送り、
+エンドポイントごとの応答時間の分布（p50・p90・p99・ヒストグラム）・エラー率・スループットを
+同時接続数ごとに計測する（同時接続数を増やしたときの飽和曲線を見て、ワーカー数を決める）。
+
+各接続は前の応答を受け取ってから次のリクエストを送る（クローズドループ）。
+/upload は 202 の後、/jobs/<job_id> が done / error になるまでを1リクエストの応答時間とする。
+
+--spawn-server を付けると、Vertex AI・Speech-to-Textの代わりにローカルの偽物
+（LLM_BACKEND=fake, ASR_RECOGNIZER=fake）を使うFlask APIを起動して計測する。
+偽物の応答時間は --llm-latency・--asr-latency で指定する。
+
+    python benchmarks/load_test.py --spawn-server --concurrency 1 2 4 8 16 --requests 50
+    python benchmarks/load_test.py --url http://localhost:5000 --endpoints string-query --duration 30
+'''
+import argparse
+import itertools
+import json
+import math
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCRIPT_DIR = os.path.join(ROOT_DIR, 'audio_to_geodata')
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'load_corpus.json')
+
+ENDPOINTS = ('string-query', 'run-python', 'upload')
+
+# ジョブの状態を確認する間隔（秒）
+POLL_INTERVAL = 0.05
+
+# ヒストグラムの区間の境界（秒）
+HISTOGRAM_BOUNDS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+
+
+class Result:
+    '''1件のリクエストの結果。'''
+
+    def __init__(self, endpoint, seconds, status, error=None):
+        self.endpoint = endpoint
+        self.seconds = seconds
+        self.status = status
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+### リクエスト
+def _request(url, data=None, headers=None, method=None, timeout=120):
+    '''(ステータスコード, JSON) を返す。HTTPエラーの場合もボディをJSONとして読む。'''
+    request = urllib.request.Request(url, data=data, headers=headers or dict(), method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read() or b'null')
+    except urllib.error.HTTPError as e:
+        body = e.read()
+        try:
+            return e.code, json.loads(body or b'null')
+        except ValueError:
+            return e.code, {'error': body.decode('utf-8', 'replace')}
+
+
+def _post_json(url, payload, session, timeout):
+    headers = {'Content-Type': 'application/json'}
+    if session:
+        headers['X-Session-Id'] = session
+    return _request(url, json.dumps(payload).encode('utf-8'), headers, 'POST', timeout)
+
+
+class LoadClient:
+    '''コーパスのクエリ・録音を順に送るクライアント（スレッド間で共有する）。'''
+
+    def __init__(self, base_url, corpus, sessions=True, timeout=120):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.sessions = sessions
+        self._string_queries = itertools.cycle(corpus['string_queries'])
+        self._transcripts = itertools.cycle(corpus['transcripts'])
+        self._audio = itertools.cycle([self._read(path) for path in corpus['audio']])
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read(path):
+        with open(os.path.join(ROOT_DIR, path), 'rb') as file:
+            return os.path.basename(path), file.read()
+
+    def _next(self, items):
+        with self._lock:
+            return next(items)
+
+    def _session(self):
+        # セッションごとのレイヤーストアに書かせ、共有の出力先を上書きし合わないようにする
+        return uuid.uuid4().hex if self.sessions else None
+
+    def send(self, endpoint):
+        start = time.perf_counter()
+        try:
+            status, error = getattr(self, '_' + endpoint.replace('-', '_'))()
+        except Exception as e:
+            status, error = None, f'{type(e).__name__}: {e}'
+        return Result(endpoint, time.perf_counter() - start, status, error)
+
+    def _string_query(self):
+        status, body = _post_json(self.base_url + '/run-python-string-query',
+                                  {'query': self._next(self._string_queries)}, self._session(), self.timeout)
+        return status, None if status == 200 else (body or dict()).get('error', f'HTTP {status}')
+
+    def _run_python(self):
+        # /run-python は transcript を文字起こし済みのテキストとして main.py に渡す
+        status, body = _post_json(self.base_url + '/run-python',
+                                  {'transcript': self._next(self._transcripts)},
+                                  self._session(), self.timeout)
+        return status, None if status == 200 else (body or dict()).get('error', f'HTTP {status}')
+
+    def _upload(self):
+        name, audio = self._next(self._audio)
+        headers = {'Content-Type': 'audio/mp4'}
+        session = self._session()
+        if session:
+            headers['X-Session-Id'] = session
+        status, body = _request(self.base_url + '/upload', audio, headers, 'POST', self.timeout)
+        if status != 202:
+            return status, (body or dict()).get('error', f'HTTP {status}')
+
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            status, job = _request(self.base_url + body['status_url'], timeout=self.timeout)
+            if status != 200:
+                return status, (job or dict()).get('error', f'HTTP {status}')
+            if job['status'] == 'done':
+                return status, None
+            if job['status'] == 'error':
+                return status, job['error']
+            time.sleep(POLL_INTERVAL)
+        return None, f'Job timed out: {name}'
+
+
+### 計測
+def run_level(client, endpoints, concurrency, requests=None, duration=None):
+    '''
+    concurrency 本の接続からリクエストを送り続け、結果のリストと経過時間（秒）を返す。
+    requests 件（接続あたり）送るか、duration 秒経つまで続ける。エンドポイントは順番に使う。
+    '''
+    deadline = time.monotonic() + duration if duration else None
+    endpoint_cycle = itertools.cycle(endpoints)
+    lock = threading.Lock()
+    results = []
+
+    def connection():
+        sent = 0
+        while (deadline is None and sent < requests) or (deadline is not None and time.monotonic() < deadline):
+            with lock:
+                endpoint = next(endpoint_cycle)
+            result = client.send(endpoint)
+            with lock:
+                results.append(result)
+            sent += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(connection) for _ in range(concurrency)]:
+            future.result()
+    return results, time.perf_counter() - start
+
+
+def percentile(values, q):
+    '''最近傍順位法によるパーセンタイル（values は昇順）。'''
+    if not values:
+        return None
+    return values[min(max(int(math.ceil(q / 100 * len(values))) - 1, 0), len(values) - 1)]
+
+
+def histogram(values, bounds=HISTOGRAM_BOUNDS):
+    '''区間の上限（秒、最後は None）と件数のリスト。'''
+    counts = [0] * (len(bounds) + 1)
+    for value in values:
+        counts[next((index for index, bound in enumerate(bounds) if value <= bound), len(bounds))] += 1
+    return list(zip(list(bounds) + [None], counts))
+
+
+def summarize(results, elapsed):
+    '''エンドポイントごと（と all）の件数・エラー率・スループット・応答時間の分布。'''
+    summary = dict()
+    groups = {'all': results}
+    for result in results:
+        groups.setdefault(result.endpoint, []).append(result)
+    for endpoint, group in groups.items():
+        latencies = sorted(result.seconds for result in group if result.ok)
+        errors = [result for result in group if not result.ok]
+        summary[endpoint] = {
+            'requests': len(group),
+            'errors': len(errors),
+            'error_rate': len(errors) / len(group) if group else 0.0,
+            'throughput': (len(group) - len(errors)) / elapsed if elapsed else 0.0,
+            'mean': statistics.fmean(latencies) if latencies else None,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+            'histogram': histogram(latencies),
+            'error_samples': sorted({result.error.strip().splitlines()[-1][:200] for result in errors})[:5],
+        }
+    return summary
+
+
+### 表示
+def _ms(value):
+    return '-' if value is None else f'{value * 1000:.0f}'
+
+
+def print_level(concurrency, summary):
+    print(f'\n== concurrency {concurrency}')
+    print(f'{"endpoint":<14}{"reqs":>6}{"err%":>7}{"req/s":>8}{"p50 ms":>9}{"p90 ms":>9}{"p99 ms":>9}{"max ms":>9}')
+    for endpoint, stats in summary.items():
+        print(f'{endpoint:<14}{stats["requests"]:>6}{stats["error_rate"] * 100:>7.1f}{stats["throughput"]:>8.2f}'
+              f'{_ms(stats["p50"]):>9}{_ms(stats["p90"]):>9}{_ms(stats["p99"]):>9}{_ms(stats["max"]):>9}')
+    for endpoint, stats in summary.items():
+        if endpoint == 'all' or not stats['requests']:
+            continue
+        print(f'  {endpoint} latency histogram')
+        width = max(count for _, count in stats['histogram']) or 1
+        for bound, count in stats['histogram']:
+            label = f'<= {bound:g}s' if bound is not None else f'>  {HISTOGRAM_BOUNDS[-1]:g}s'
+            print(f'    {label:>9} {count:>5} {"#" * round(40 * count / width)}')
+        for sample in stats['error_samples']:
+            print(f'  error: {sample}')
+
+
+def print_saturation(levels):
+    '''同時接続数ごとのスループットとp99（飽和曲線）。'''
+    print('\n== saturation (all endpoints)')
+    print(f'{"concurrency":>11}{"req/s":>9}{"p50 ms":>9}{"p99 ms":>9}{"err%":>7}')
+    peak = max(level['summary']['all']['throughput'] for level in levels) or 1
+    for level in levels:
+        stats = level['summary']['all']
+        print(f'{level["concurrency"]:>11}{stats["throughput"]:>9.2f}{_ms(stats["p50"]):>9}'
+              f'{_ms(stats["p99"]):>9}{stats["error_rate"] * 100:>7.1f} {"#" * round(30 * stats["throughput"] / peak)}')
+
+
+### 偽物を使うサーバーの起動
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def spawn_server(workers, llm_latency, asr_latency, llm_cache=False, timeout=120, transcripts=()):
+    '''
+    ローカルの偽物（LLM・音声認識）を使うFlask APIを起動し、(プロセス, URL) を返す。
+    レイヤーとキャッシュは一時ディレクトリに書く。
+    偽物の音声認識は、録音ごとに transcripts から1つを選んで返す。
+    '''
+    port = _free_port()
+    work_dir = tempfile.mkdtemp(prefix='load_test_')
+    env = dict(os.environ,
+               LLM_BACKEND='fake', ASR_RECOGNIZER='fake',
+               FAKE_LLM_LATENCY=str(llm_latency), ASR_FAKE_LATENCY=str(asr_latency),
+               ASR_FAKE_TRANSCRIPTS='|'.join(transcripts),
+               QUERY_WORKERS=str(workers),
+               LLM_CACHE='1' if llm_cache else '0',
+               LLM_CACHE_PATH=os.path.join(work_dir, 'llm_cache.sqlite'),
+               LAYER_OUTPUT_PATH=work_dir + os.sep,
+               LAYER_STORE_SPILL_DIR=os.path.join(work_dir, 'layer_store'))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port), '--no-reload', '--with-threads'],
+        cwd=SCRIPT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('Server exited: ' + process.stderr.read().decode('utf-8', 'replace')[-2000:])
+        try:
+            with urllib.request.urlopen(url + '/backend-test', timeout=1):
+                return process, url
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('Server did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Flask APIの負荷試験')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--requests', type=int, default=20, help='同時接続数ごとの1接続あたりのリクエスト数')
+    parser.add_argument('--duration', type=float, help='同時接続数ごとの計測時間（秒）。指定すると --requests は使わない')
+    parser.add_argument('--corpus', default=CORPUS_PATH)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--no-sessions', action='store_true', help='セッションIDを付けずに送る（共有の出力先に書く）')
+    parser.add_argument('--spawn-server', action='store_true', help='偽物のLLM・音声認識を使うサーバーを起動する')
+    parser.add_argument('--workers', type=int, default=2, help='--spawn-server のクエリワーカー数')
+    parser.add_argument('--llm-latency', type=float, default=0.8, help='--spawn-server の偽物のLLMの応答時間（秒）')
+    parser.add_argument('--asr-latency', type=float, default=0.01, help='--spawn-server の偽物の認識器のチャンクごとの処理時間（秒）')
+    parser.add_argument('--llm-cache', action='store_true', help='--spawn-server で関数呼び出しのキャッシュを使う')
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding='utf-8') as file:
+        corpus = json.load(file)
+
+    server = None
+    url = args.url
+    if args.spawn_server:
+        server, url = spawn_server(args.workers, args.llm_latency, args.asr_latency, args.llm_cache, args.timeout,
+                                   corpus['transcripts'])
+        print(f'Started server at {url} (workers={args.workers}, llm_latency={args.llm_latency}s)')
+
+    try:
+        client = LoadClient(url, corpus, sessions=not args.no_sessions, timeout=args.timeout)
+        # ワーカーの起動待ちなどを計測に含めないよう、最初に1件ずつ送る
+        for endpoint in args.endpoints:
+            client.send(endpoint)
+
+        levels = []
+        for concurrency in args.concurrency:
+            results, elapsed = run_level(client, args.endpoints, concurrency, args.requests, args.duration)
+            summary = summarize(results, elapsed)
+            levels.append({'concurrency': concurrency, 'elapsed': elapsed, 'summary': summary})
+            print_level(concurrency, summary)
+        print_saturation(levels)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump({'url': url, 'endpoints': args.endpoints, 'levels': levels}, file, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
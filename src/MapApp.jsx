@@ -5,15 +5,16 @@ import {
   PointLight,
 } from "@deck.gl/core";
 import { DataFilterExtension, _TerrainExtension as TerrainExtension } from '@deck.gl/extensions';
-import { Tile3DLayer } from "@deck.gl/geo-layers";
+import { MVTLayer, Tile3DLayer } from "@deck.gl/geo-layers";
 import { GeoJsonLayer } from "@deck.gl/layers";
 import DeckGL from "@deck.gl/react";
 import * as d3 from "d3";
 import maplibregl from "maplibre-gl";
 import "maplibre-gl/dist/maplibre-gl.css";
-import React, { useMemo, useState } from "react";
+import React, { useEffect, useMemo, useState } from "react";
 import { createRoot } from "react-dom/client";
 import { Map } from "react-map-gl";
+import { loadBinaryLayer } from "./binaryLayers.js";
 
 export const lightingEffect = new LightingEffect({
   ambientLight: new AmbientLight({
@@ -89,8 +90,13 @@ export default function App({
   lines = "./lines.json",
   baseGeoJsonData = "./basemap.json",      // ベースマップ
   siteGeoJsonData = './site.json',         // 対象敷地
+  buildingGeoJsonData = "./building.json", // ツールが書き出した建物
+  buildingBinaryData = "./building.bin",   // 同じ建物のバイナリ属性（LAYER_FORMATS=geojson,binary の場合）
   floodingGeoJsonData = "./flooding.json", // 浸水想定範囲
   sheltersGeoJsonData = "./shelters.json", // 避難所
+  shelterCatchmentsGeoJsonData = "./shelter_catchments.json", // 避難所ごとの割り当て範囲
+  buildingTiles = "http://localhost:5050/tiles/buildings/{z}/{x}/{y}.pbf", // 建物のベクトルタイル
+  buildingTileJson = "http://localhost:5050/tiles/buildings.json",         // 建物のタイルセットの有無の確認に使う
   
   mapStyle = "https://basemaps.cartocdn.com/gl/dark-matter-nolabels-gl-style/style.json",
   initialBuildingOpacity = 0.8,
@@ -144,6 +150,31 @@ export default function App({
 
   const [credits, setCredits] = useState('');
 
+  // 建物のバイナリ属性があればパースせずに描画し、なければGeoJSONを読む
+  const [buildingData, setBuildingData] = useState(null);
+  useEffect(() => {
+    if (!buildingBinaryData) {
+      setBuildingData(buildingGeoJsonData);
+      return;
+    }
+    loadBinaryLayer(buildingBinaryData)
+      .then(setBuildingData)
+      .catch(() => setBuildingData(buildingGeoJsonData));
+  }, [buildingBinaryData, buildingGeoJsonData]);
+
+  // 建物のタイルセットがあれば表示範囲のタイルだけを読み、なければGeoJSONのベースマップを読む
+  // （確認が終わるまではどちらも読まない）
+  const [tilesAvailable, setTilesAvailable] = useState(null);
+  useEffect(() => {
+    if (!buildingTiles) {
+      setTilesAvailable(false);
+      return;
+    }
+    fetch(buildingTileJson)
+      .then((response) => setTilesAvailable(response.ok))
+      .catch(() => setTilesAvailable(false));
+  }, [buildingTiles, buildingTileJson]);
+
   const layers = [
     new Tile3DLayer({
         id: 'google-3d-tiles',
@@ -168,7 +199,7 @@ export default function App({
         },
         operation: 'terrain+draw'
     }),
-    baseGeoJsonData && new GeoJsonLayer({
+    tilesAvailable === false && baseGeoJsonData && new GeoJsonLayer({
       id: 'basegeojson-layer',
       data: baseGeoJsonData, // 読み込まれたGeoJSONデータを渡す
       extensions: [new DataFilterExtension({filterSize: 1}), new TerrainExtension()],
@@ -181,6 +212,30 @@ export default function App({
       getElevation: (f) => f.properties.measuredHeight || 0, // 高さを設定
       getLineColor: [0, 0, 0, 255], // 辺の色
     }),
+    tilesAvailable && new MVTLayer({
+      id: 'building-tiles-layer',
+      data: buildingTiles, // 表示範囲のタイルだけを読み込む
+      minZoom: 14,
+      maxZoom: 16,
+      pickable: true,
+      stroked: false,
+      filled: true,
+      extruded: true,
+      getFillColor: [255, 255, 255, 100],
+      getElevation: (f) => f.properties.measuredHeight || 0, // 高さを設定
+      extensions: [new TerrainExtension()],
+    }),
+    buildingData && new GeoJsonLayer({
+      id: 'building-layer',
+      data: buildingData, // loadBinaryLayer の結果（{points, lines, polygons}）またはGeoJSONのURL
+      pickable: true,
+      stroked: false,
+      filled: true,
+      extruded: true,
+      getFillColor: [255, 255, 0, 200],
+      getElevation: (f) => f.properties.measuredHeight || 0, // 高さを設定
+      extensions: [new TerrainExtension()],
+    }),
     siteGeoJsonData && new GeoJsonLayer({
       id: 'sitegeojson-layer',
       data: siteGeoJsonData, // 読み込まれたGeoJSONデータを渡す
@@ -204,6 +259,21 @@ export default function App({
       getElevation: (f) => f.properties.measuredHeight || 0, // 高さを設定
       extensions: [new TerrainExtension()],
     }),
+    shelterCatchmentsGeoJsonData && new GeoJsonLayer({
+      id: 'shelter-catchments-layer',
+      data: shelterCatchmentsGeoJsonData, // 範囲どうしは重なるため、薄く塗って輪郭を描く
+      pickable: true,
+      stroked: true,
+      filled: true,
+      getFillColor: (f) => {
+        const colorObj = d3.color(ordinalColorScale(f.properties.shelter_id));
+        return [colorObj.r, colorObj.g, colorObj.b, 40];
+      },
+      getLineColor: [255, 124, 0, 200],
+      getLineWidth: 2,
+      lineWidthUnits: 'pixels',
+      extensions: [new TerrainExtension()],
+    }),
     sheltersGeoJsonData && new GeoJsonLayer({
       id: "icon",
       data: "./shelters.json",
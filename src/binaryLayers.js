@@ -0,0 +1,94 @@
+// audio_to_geodata/binary_layers.py が書き出す .bin を deck.gl のバイナリデータに変換する
+// 座標・属性はファイルの ArrayBuffer をそのまま参照する型付き配列になる（コピーしない）
+
+const MAGIC = "DGLB";
+const VERSION = 1;
+const ALIGNMENT = 8;
+
+const TYPED_ARRAYS = {
+  float64: Float64Array,
+  float32: Float32Array,
+  uint32: Uint32Array,
+  int32: Int32Array,
+  uint8: Uint8Array,
+};
+
+// バイト列をヘッダーと型付き配列（{value, size}）に分ける
+export function parseBinaryLayer(buffer) {
+  const view = new DataView(buffer);
+  const magic = new TextDecoder().decode(new Uint8Array(buffer, 0, 4));
+  if (magic !== MAGIC) {
+    throw new Error("not a binary layer");
+  }
+  const version = view.getUint32(4, true);
+  if (version !== VERSION) {
+    throw new Error(`unsupported binary layer version: ${version}`);
+  }
+  const headerLength = view.getUint32(8, true);
+  const header = JSON.parse(
+    new TextDecoder().decode(new Uint8Array(buffer, 12, headerLength)),
+  );
+  const base = Math.ceil((12 + headerLength) / ALIGNMENT) * ALIGNMENT;
+
+  const arrays = {};
+  for (const entry of header.buffers) {
+    const TypedArray = TYPED_ARRAYS[entry.dtype];
+    arrays[entry.name] = {
+      value: new TypedArray(buffer, base + entry.offset, entry.count),
+      size: entry.size,
+    };
+  }
+  return { header, arrays };
+}
+
+// GeoJsonLayer の data に渡せる {points, lines, polygons} を作る
+function toBinaryFeatures(header, arrays) {
+  const data = {};
+  for (const family of ["points", "lines", "polygons"]) {
+    const numericProps = {};
+    const result = {
+      type: header.types[family],
+      properties: header.properties[family],
+      numericProps,
+    };
+    const prefix = `${family}.`;
+    for (const [name, array] of Object.entries(arrays)) {
+      if (!name.startsWith(prefix)) continue;
+      const key = name.slice(prefix.length);
+      if (key.startsWith("numericProps.")) {
+        numericProps[key.slice("numericProps.".length)] = array;
+      } else {
+        result[key] = array;
+      }
+    }
+    data[family] = result;
+  }
+  return data;
+}
+
+// LineLayer の data に渡せる {length, attributes} を作る（数値以外の列は columns に入る）
+function toBinaryRecords(header, arrays) {
+  const columns = { ...header.columns };
+  for (const [name, array] of Object.entries(arrays)) {
+    columns[name] = array.value;
+  }
+  return {
+    length: header.length,
+    attributes: {
+      ...(arrays.from && { getSourcePosition: arrays.from }),
+      ...(arrays.to && { getTargetPosition: arrays.to }),
+    },
+    columns,
+  };
+}
+
+export async function loadBinaryLayer(url) {
+  const response = await fetch(url);
+  if (!response.ok) {
+    throw new Error(`failed to fetch ${url}: ${response.status}`);
+  }
+  const { header, arrays } = parseBinaryLayer(await response.arrayBuffer());
+  return header.kind === "features"
+    ? toBinaryFeatures(header, arrays)
+    : toBinaryRecords(header, arrays);
+}